@@ -0,0 +1,458 @@
+import weakref
+from array import array
+import ast
+from ast import Node, NodeClass, location_start, location_end
+
+
+#
+# Flat AST representation for very large programs. An `Arena` stores the nodes
+# of a program in a few `array` buffers rather than as one object per node:
+#
+# - every node has an integer id, which indexes the per-node arrays: the kind
+#   of node (an index into `classes`), where its fields start in `fields`,
+#   its location (in the packed form of `ast.SourceMap`, split over several
+#   arrays) and the `ty` and `definition` annotations of later phases;
+#
+# - `fields` holds the children of each node in the order of the `children`
+#   declaration of its class, each encoded as an int with a two-bit tag: a
+#   node id, None, a list of nodes (an index into `items`, which holds the
+#   length of the list followed by the node ids), or any other value (an
+#   index into the `constants` table, in which names, numbers, types and
+#   operators are stored once).
+#
+# The phases after desugaring traverse an arena through views: objects of a
+# subclass of each node class, with properties that read the children and
+# annotations of a node from the arena, so that `isinstance` checks and the
+# visit methods of `ASTVisitor` and `ASTTransformer` apply to them as usual.
+# Views are created on access and cached only as long as they are referenced,
+# e.g., as the definition of a variable or as a key in a dictionary of IRGen,
+# so that the same node is always the same view object while it is in use.
+#
+# The arrays are never changed after a node has been added, except for the
+# annotations. Children that a transformer replaces (like IRGen does with the
+# values it generates) are stored in the view object.
+#
+# `flatten` converts an `ast.Program` into an arena and returns a view of the
+# program, `unflatten` converts a view back into a tree of node objects, and
+# `parse` builds an arena directly from the declarations of the descent parser,
+# desugaring them one at a time, so that the node objects of the whole
+# program never exist at the same time (see the --flat-ast option of main.py).
+#
+
+
+NODE, NONE, LIST, CONST = range(4)
+
+# all node classes by kind code, and the other way around
+classes = []
+kinds = {}
+
+
+def register_classes(cls):
+    for subclass in cls.__subclasses__():
+        if subclass not in kinds:
+            kinds[subclass] = len(classes)
+            classes.append(subclass)
+            register_classes(subclass)
+
+
+register_classes(Node)
+
+
+start_bits = ast.line_bits + ast.offset_bits
+length_mask = (1 << ast.length_bits) - 1
+
+
+class Arena(object):
+    def __init__(self):
+        self.kinds = array('B')
+        self.field_start = array('I')
+        self.fields = array('q')
+        self.items = array('q')
+        self.constants = []
+        self.constant_ids = {}
+
+        # locations: file id (0 for locations that are stored as tuples in
+        # `tuple_locations`), line and offset of the start and end, and the
+        # length at the end, see `ast.SourceMap`
+        self.loc_file = array('I')
+        self.loc_start = array('Q')
+        self.loc_end = array('Q')
+        self.loc_length = array('I')
+        self.tuple_locations = {}
+        self.sources = {}
+
+        # annotations: type codes into `types` (0 for None), definitions as
+        # node ids (-1 for None) and the iteration variables of loops
+        self.ty = array('H')
+        self.types = [None]
+        self.type_ids = {None: 0}
+        self.definition = array('i')
+        self.iters = {}
+
+        self.source = None
+        self.view_cache = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def add(self, root):
+        '''
+        Add node `root` and all nodes below it to the arena, and return its
+        id. Nodes that occur more than once in the tree (desugaring shares
+        some) are stored once.
+        '''
+        memo = {}
+        pending = []
+        rootid = self.node_id(root, memo, pending)
+        fields = self.fields
+        items = self.items
+
+        while pending:
+            node, nid = pending.pop()
+            self.field_start[nid] = len(fields)
+
+            for name in node.__class__.children:
+                value = getattr(node, name)
+
+                if isinstance(value, Node):
+                    fields.append(self.node_id(value, memo, pending) << 2)
+                elif isinstance(value, list):
+                    fields.append(len(items) << 2 | LIST)
+                    items.append(len(value))
+                    items.extend([self.node_id(item, memo, pending)
+                                  for item in value])
+                elif value is None:
+                    fields.append(NONE)
+                else:
+                    fields.append(self.constant(value) << 2 | CONST)
+
+            definition = getattr(node, 'definition', None)
+            if definition is not None:
+                self.definition[nid] = self.node_id(definition, memo, pending)
+
+            if getattr(node, 'iter', None) is not None:
+                self.iters[nid] = self.node_id(node.iter, memo, pending)
+
+        return rootid
+
+    def node_id(self, node, memo, pending):
+        nid = memo.get(id(node))
+
+        if nid is None:
+            nid = memo[id(node)] = len(self.kinds)
+            self.kinds.append(kinds[node.__class__])
+            self.field_start.append(0)
+            self.add_location(node._location)
+            self.ty.append(self.type_id(getattr(node, 'ty', None)))
+            self.definition.append(-1)
+            pending.append((node, nid))
+
+        return nid
+
+    def add_location(self, location):
+        if location.__class__ is int:
+            fid = location >> ast.file_shift
+            if fid not in self.sources:
+                self.sources[fid] = ast.source_maps[fid]
+
+            end = location & ast.end_mask
+            self.loc_file.append(fid)
+            self.loc_start.append(location >> ast.start_shift &
+                                  (1 << start_bits) - 1)
+            self.loc_end.append(end >> ast.length_bits)
+            self.loc_length.append(end & length_mask)
+        else:
+            self.tuple_locations[len(self.loc_file)] = location
+            self.loc_file.append(0)
+            self.loc_start.append(0)
+            self.loc_end.append(0)
+            self.loc_length.append(0)
+
+    def constant(self, value):
+        # operators define __eq__ but are unhashable, and True == 1 == 1.0
+        key = (value.__class__,
+               value.op if isinstance(value, ast.Operator) else value)
+        index = self.constant_ids.get(key)
+
+        if index is None:
+            index = self.constant_ids[key] = len(self.constants)
+            self.constants.append(value)
+
+        return index
+
+    def type_id(self, ty):
+        code = self.type_ids.get(ty)
+
+        if code is None:
+            code = self.type_ids[ty] = len(self.types)
+            self.types.append(ty)
+
+        return code
+
+    def add_program(self, decls, location):
+        '''
+        Add a `Program` node for the declarations with ids `decls`, which
+        have been added already, and return its id.
+        '''
+        nid = len(self.kinds)
+        self.kinds.append(kinds[ast.Program])
+        self.field_start.append(len(self.fields))
+        self.add_location(location)
+        self.ty.append(0)
+        self.definition.append(-1)
+
+        self.fields.append(len(self.items) << 2 | LIST)
+        self.items.append(len(decls))
+        self.items.extend(decls)
+        return nid
+
+    def location(self, nid):
+        fid = self.loc_file[nid]
+
+        if not fid:
+            return self.tuple_locations[nid]
+
+        return fid << ast.file_shift | \
+               self.loc_start[nid] << ast.start_shift | \
+               self.loc_end[nid] << ast.length_bits | self.loc_length[nid]
+
+    def field(self, nid, index):
+        value = self.fields[self.field_start[nid] + index]
+        tag = value & 3
+
+        if tag == NODE:
+            return self.view(value >> 2)
+        if tag == CONST:
+            return self.constants[value >> 2]
+        if tag == LIST:
+            start = value >> 2
+            end = start + 1 + self.items[start]
+            return [self.view(item) for item in self.items[start + 1:end]]
+        return None
+
+    def view(self, nid):
+        '''
+        Return the view of node `nid`.
+        '''
+        view = self.view_cache.get(nid)
+
+        if view is None:
+            view = views[self.kinds[nid]].__new__(views[self.kinds[nid]])
+            view.arena = self
+            view.id = nid
+            view.replaced = None
+            self.view_cache[nid] = view
+
+        return view
+
+    def nbytes(self):
+        '''
+        Memory used by the arrays of the arena, excluding the constants.
+        '''
+        return sum(len(a) * a.itemsize for a in (
+            self.kinds, self.field_start, self.fields, self.items,
+            self.loc_file, self.loc_start, self.loc_end, self.loc_length,
+            self.ty, self.definition))
+
+
+#
+# Views
+#
+
+
+def child_property(name, index):
+    def get(self):
+        if self.replaced is not None and name in self.replaced:
+            return self.replaced[name]
+        return self.arena.field(self.id, index)
+
+    def set(self, value):
+        if self.replaced is None:
+            self.replaced = {}
+        self.replaced[name] = value
+
+    return property(get, set)
+
+
+def get_location(self):
+    return self.arena.location(self.id)
+
+
+def get_ty(self):
+    return self.arena.types[self.arena.ty[self.id]]
+
+
+def set_ty(self, ty):
+    self.arena.ty[self.id] = self.arena.type_id(ty)
+
+
+def get_definition(self):
+    nid = self.arena.definition[self.id]
+    return None if nid < 0 else self.arena.view(nid)
+
+
+def set_definition(self, definition):
+    self.arena.definition[self.id] = definition.id
+
+
+def get_iter(self):
+    nid = self.arena.iters.get(self.id)
+    return None if nid is None else self.arena.view(nid)
+
+
+def get_source(self):
+    return self.arena.source
+
+
+def iter_children(self):
+    return tuple((name, getattr(self, name))
+                 for name in self.__class__.children)
+
+
+annotations = dict(
+    _location=property(get_location),
+    ty=property(get_ty, set_ty),
+    definition=property(get_definition, set_definition),
+    iter=property(get_iter),
+    source=property(get_source),
+)
+
+
+def make_view_class(cls):
+    namespace = dict(__slots__=('arena', 'id', 'replaced', '__weakref__'),
+                     iter_children=iter_children)
+
+    for index, name in enumerate(cls.children):
+        namespace[name] = child_property(name, index)
+
+    for name, prop in annotations.items():
+        if hasattr(cls, name):
+            namespace[name] = prop
+
+    return NodeClass(cls.__name__, (cls,), namespace)
+
+
+# view classes by kind code
+views = [make_view_class(cls) for cls in classes]
+
+
+#
+# Conversion
+#
+
+
+def flatten(tree):
+    '''
+    Store `ast.Program` `tree` in a new arena and return a view of it.
+    '''
+    arena = Arena()
+    arena.source = tree.source
+    return arena.view(arena.add(tree))
+
+
+def unflatten(view):
+    '''
+    Convert the node of view `view` and everything below it back into node
+    objects, and return the new node.
+    '''
+    arena = view.arena
+    memo = {}
+    pending = []
+
+    def node(nid):
+        obj = memo.get(nid)
+
+        if obj is None:
+            cls = classes[arena.kinds[nid]]
+            obj = memo[nid] = cls.__new__(cls)
+            obj._location = arena.location(nid)
+            pending.append(nid)
+
+        return obj
+
+    root = node(view.id)
+
+    while pending:
+        nid = pending.pop()
+        obj = memo[nid]
+        cls = obj.__class__
+        start = arena.field_start[nid]
+
+        for index, name in enumerate(cls.children):
+            value = arena.fields[start + index]
+            tag = value & 3
+
+            if tag == NODE:
+                value = node(value >> 2)
+            elif tag == CONST:
+                value = arena.constants[value >> 2]
+            elif tag == LIST:
+                first = (value >> 2) + 1
+                value = [node(item) for item in
+                         arena.items[first:first + arena.items[first - 1]]]
+            else:
+                value = None
+
+            setattr(obj, name, value)
+
+        if hasattr(cls, 'ty'):
+            obj.ty = arena.types[arena.ty[nid]]
+        if hasattr(cls, 'definition'):
+            definition = arena.definition[nid]
+            obj.definition = None if definition < 0 else node(definition)
+        if hasattr(cls, 'iter'):
+            obj.iter = node(arena.iters[nid]) if nid in arena.iters else None
+        if hasattr(cls, 'source'):
+            obj.source = arena.source
+
+    return root
+
+
+def parse(fname, src, header_decls=(), transform=None):
+    '''
+    Parse FenneC source code `src` from file `fname` into a new arena, with
+    the descent parser, and return a view of the program. Declarations in
+    `header_decls` (see `pch.declarations`) are added before the parsed ones.
+    If given, `transform` is applied to every declaration before it is added,
+    and may return a replacement like an `ASTTransformer`.
+    '''
+    from parser import create_lexer
+    import descent
+
+    arena = Arena()
+    parser = descent.Parser(create_lexer(fname), src)
+    arena.source = parser.source
+    decls = []
+    first = last = None
+
+    if parser.type == '$end':
+        parser.error()
+
+    def add(decl):
+        nonlocal first, last
+        if transform is not None:
+            decl = transform(decl) or decl
+        if first is None:
+            first = location_start(decl._location)
+        last = location_end(decl._location)
+        decls.append(arena.add(decl))
+
+    for decl in header_decls:
+        add(decl)
+
+    try:
+        for decl in parser.declarations():
+            add(decl)
+    except RecursionError:
+        # nested too deeply for the descent parser, parse the whole program
+        # with PLY instead, see `parser.parse`
+        from parser import parse as parse_tree
+        import pch
+        tree = parse_tree(fname, src, engine='ply')
+        pch.prepend(tree, list(header_decls))
+        if transform is not None:
+            transform(tree)
+        return flatten(tree)
+
+    location = parser.source.location(parser.lexer.fname, first, last)
+    return arena.view(arena.add_program(decls, location))
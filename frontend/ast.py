@@ -1,5 +1,19 @@
+import re
 import builtins
+import weakref
 from abc import ABCMeta
+from array import array
+from bisect import bisect_left
+from functools import wraps
+from itertools import count
+
+
+# Types and operators have small integer codes, so that later phases can look
+# up what to do with them in tables indexed by the codes, rather than comparing
+# their names. All array types have the same type code. The operator codes are
+# the indices in `Operator.ops`, and operators are also classified by kind.
+BOOL, CHAR, INT, FLOAT, VOID, ARRAY = range(6)
+ARITHMETIC, EQUALITY, RELATIONAL, LOGICAL = range(4)
 
 
 class Type(object):
@@ -10,12 +24,14 @@ class Type(object):
     `ArrayType`.
     '''
     base_types = frozenset(['bool', 'char', 'int', 'void', 'float'])
+    codes = dict(bool=BOOL, char=CHAR, int=INT, float=FLOAT, void=VOID)
     int_bits = 32
     cache = {}
 
     def __init__(self, name):
         assert name in self.base_types
         self.name = name
+        self.code = self.codes[name]
 
     def __str__(self):
         return self.name
@@ -23,12 +39,22 @@ class Type(object):
     def __repr__(self):
         return str(self)
 
+    def __reduce__(self):
+        # types are compared by identity, so unpickling must not create copies
+        return Type.get, (str(self),)
+
     @classmethod
     def get(cls, name):
-        if name.endswith('[]'):
-            return cls.cache.setdefault(name, ArrayType(cls.get(name[:-2])))
+        ty = cls.cache.get(name)
+
+        if ty is None:
+            if name.endswith('[]'):
+                ty = ArrayType(cls.get(name[:-2]))
+            else:
+                ty = cls(name)
+            cls.cache[name] = ty
 
-        return cls.cache.setdefault(name, cls(name))
+        return ty
 
     def is_array(self):
         return False
@@ -37,6 +63,7 @@ class Type(object):
 class ArrayType(Type):
     def __init__(self, base):
         self.base = base
+        self.code = ARRAY
 
     def __str__(self):
         return str(self.base) + '[]'
@@ -58,14 +85,20 @@ class Operator(object):
     ops_equality = '== !='.split()
     ops_relational = '< > <= >='.split()
     ops_logical = '&& || !'.split()
-    ops_all = frozenset(ops_arithmetic + ops_equality + ops_relational +
-                        ops_logical)
+    ops = ops_arithmetic + ops_equality + ops_relational + ops_logical
+    ops_all = frozenset(ops)
+    kinds = dict([(op, ARITHMETIC) for op in ops_arithmetic] +
+                 [(op, EQUALITY) for op in ops_equality] +
+                 [(op, RELATIONAL) for op in ops_relational] +
+                 [(op, LOGICAL) for op in ops_logical])
 
     cache = {}
 
     def __init__(self, op):
         assert op in self.ops_all
         self.op = op
+        self.code = self.ops.index(op)
+        self.kind = self.kinds[op]
 
     def __str__(self):
         return self.op
@@ -79,21 +112,29 @@ class Operator(object):
     def __ne__(self, other):
         return self.op != other
 
+    def __reduce__(self):
+        return Operator.get, (self.op,)
+
     @classmethod
     def get(cls, sign):
-        return cls.cache.setdefault(sign, cls(sign))
+        op = cls.cache.get(sign)
+
+        if op is None:
+            op = cls.cache[sign] = cls(sign)
+
+        return op
 
     def is_arithmetic(self):
-        return self.op in self.ops_arithmetic
+        return self.kind == ARITHMETIC
 
     def is_equality(self):
-        return self.op in self.ops_equality
+        return self.kind == EQUALITY
 
     def is_relational(self):
-        return self.op in self.ops_relational
+        return self.kind == RELATIONAL
 
     def is_logical(self):
-        return self.op in self.ops_logical
+        return self.kind == LOGICAL
 
 
 class ASTError(BaseException):
@@ -103,7 +144,354 @@ class ASTError(BaseException):
     pass
 
 
-class Node(object):
+# Printing a node formats the strings of its children first, which recurses as
+# deep as the tree, and copies the strings of all nodes below it into its own,
+# which takes time quadratic in the depth of the tree. So that trees of any
+# depth can be printed in linear time, the outermost `str` or `repr` call
+# instead formats all nodes below it bottom-up (children before their parents)
+# with an explicit stack, and the nested calls return a short placeholder for
+# each node rather than its string. This gives a template per node, which only
+# contains its own text, and the templates are expanded into the final string
+# in one pass at the end. `NodeClass` applies this to the `__str__` method of
+# every node class.
+#
+# `Block.__str__` indents the code of its statements by adding a tab after
+# every newline, which then only applies to the newlines in its own template,
+# so the expansion adds the tab to the newlines in the templates of the nodes
+# below the block.
+printing = {}
+placeholder = re.compile('\0([0-9]+)\0')
+
+
+def nonrecursive(method):
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self):
+        memo = printing.get(name)
+
+        if memo is not None:
+            refs, templates = memo
+            ref = refs.get(id(self))
+            if ref is None:
+                template = method(self)
+                ref = refs[id(self)] = '\0%d\0' % len(templates)
+                templates.append((self, template))
+            return ref
+
+        # `repr` does not print the contents of nested blocks
+        skip = Block if name == '__repr__' else ()
+        nodes = []
+        stack = [self]
+
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack += node
+            elif isinstance(node, Node) and \
+                    (node is self or not isinstance(node, skip)):
+                nodes.append(node)
+                stack += [child for _, child in node.iter_children()]
+
+        memo = printing[name] = {}, []
+        try:
+            for node in reversed(nodes):
+                ref = getattr(node, name)()
+            return expand_templates(memo[1], int(ref[1:-1]))
+        finally:
+            del printing[name]
+
+    return wrapper
+
+
+def expand_templates(templates, index):
+    '''
+    Return the expansion of template number `index` in `templates`, i.e., its
+    text with the placeholders replaced by the expansion of the templates that
+    they refer to (see above).
+    '''
+    parts = []
+    stack = [(index, '')]
+
+    while stack:
+        text, indent = stack.pop()
+
+        if text.__class__ is int:
+            node, text = templates[text]
+            pieces = placeholder.split(text)
+            inner = indent + '    ' if isinstance(node, Block) else indent
+            stack += [(int(piece), inner) if i % 2 else (piece, indent)
+                      for i, piece in reversed(list(enumerate(pieces)))]
+        elif indent:
+            parts.append(text.replace('\n', '\n' + indent))
+        else:
+            parts.append(text)
+
+    return ''.join(parts)
+
+
+# Source locations are (filename, ystart, xstart, yend, xend) tuples, but the
+# parsers store them in nodes in a packed form: a single int that holds the id
+# of the file name and the line and offset into the parsed source of the
+# start and end of the node, as laid out below. The columns are only computed
+# from the offsets when `Node.location` is read, which mostly happens when an
+# error is printed. The line offsets that this needs, and the file names, are
+# kept by the `SourceMap` of the parse, which the parsed `Program` refers to.
+#
+# Locations that do not come from the parser, or that do not fit in the
+# packed form, are stored as tuples, and `Node.at` accepts either form.
+length_bits = 24  # xend is the column at the end offset plus the length - 1
+offset_bits = 32
+line_bits = 24
+end_shift = 0
+start_shift = length_bits + offset_bits + line_bits
+file_shift = start_shift + offset_bits + line_bits
+end_mask = (1 << start_shift) - 1
+start_mask = (1 << file_shift) - 1 - end_mask
+
+# source maps by file id, the `Program` of each parse keeps its map alive
+source_maps = weakref.WeakValueDictionary()
+file_ids = count(1)
+
+newline = re.compile('\n')
+
+# line markers with line numbers that do not fit in the packed form together
+# with the lines of the source itself
+long_line_marker = re.compile(r'#\s\d{7}')
+
+
+def source_column(newlines, pos):
+    '''
+    Return the column of position `pos` in the source, given the sorted list
+    of offsets of all newlines in the source that `parse` builds. This finds
+    the last newline before the position with a binary search rather than
+    scanning the input backwards with rfind for every production.
+    '''
+    i = bisect_left(newlines, pos) - 1
+    last_cr = max(newlines[i], 1) if i >= 0 else 1
+    return pos - last_cr
+
+
+class SourceMap(object):
+    '''
+    Builds the locations of nodes while parsing source code `src`, packed if
+    possible, and expands packed locations again. A location is made from a
+    start and an end part (see `start`, `end` and `location_start`), which
+    are ints in the packed form and (line, column) tuples otherwise.
+    '''
+    def __init__(self, src):
+        self.newlines = array('L', [m.start() for m in newline.finditer(src)])
+        self.packed = len(src) < 1 << offset_bits and \
+                      len(self.newlines) < 1 << (line_bits - 1) and \
+                      not long_line_marker.search(src)
+        self.ids = {}
+        self.names = {}
+
+    def file(self, fname):
+        '''
+        Packed id of file name `fname`.
+        '''
+        bits = self.ids.get(fname)
+
+        if bits is None:
+            fid = next(file_ids)
+            source_maps[fid] = self
+            self.names[fid] = fname
+            bits = self.ids[fname] = fid << file_shift
+
+        return bits
+
+    def start(self, lineno, pos):
+        if self.packed:
+            return (lineno << offset_bits | pos) << start_shift
+        return lineno, source_column(self.newlines, pos)
+
+    def end(self, lineno, pos, length):
+        if self.packed and length < 1 << length_bits:
+            return ((lineno << offset_bits | pos) << length_bits) | length
+        return lineno, source_column(self.newlines, pos) + length - 1
+
+    def location(self, fname, start, end):
+        '''
+        Location in file `fname` from start part `start` to end part `end`.
+        '''
+        if start.__class__ is int and end.__class__ is int:
+            return self.file(fname) | start | end
+
+        return (fname,) + self.expand_start(start) + self.expand_end(end)
+
+    def expand_start(self, start):
+        if start.__class__ is not int:
+            return start
+
+        start >>= start_shift
+        return (start >> offset_bits & (1 << line_bits) - 1,
+                source_column(self.newlines, start & (1 << offset_bits) - 1))
+
+    def expand_end(self, end):
+        if end.__class__ is not int:
+            return end
+
+        length = end & (1 << length_bits) - 1
+        end >>= length_bits
+        return (end >> offset_bits & (1 << line_bits) - 1,
+                source_column(self.newlines, end & (1 << offset_bits) - 1) +
+                length - 1)
+
+    def expand(self, location):
+        return (self.names[location >> file_shift],) + \
+               self.expand_start(location & start_mask) + \
+               self.expand_end(location & end_mask)
+
+
+def location_start(location):
+    '''
+    Start part of a location in either form, see `SourceMap`.
+    '''
+    if location.__class__ is int:
+        return location & start_mask
+    return location[1:3]
+
+
+def location_end(location):
+    if location.__class__ is int:
+        return location & end_mask
+    return location[3:]
+
+
+def expand_location(location):
+    if location.__class__ is not int:
+        return location
+
+    source = source_maps.get(location >> file_shift)
+    assert source is not None, \
+           'location of a node whose parsed Program has been freed'
+    return source.expand(location)
+
+
+# The `__slots__`, constructor and `iter_children` method of each node class
+# are generated from its `children` and `types` declarations when the class is
+# created, rather than storing the attributes of every node in a `__dict__` and
+# looking up the declarations for every constructed node. Attributes that are
+# not children, like the `location` or the types and definitions that later
+# phases add to nodes, must therefore be declared as well: the `attributes` of
+# a node class map their names to the initial value that the constructor
+# assigns. Subclasses inherit the children and attributes of their bases.
+def generate_init(cls, attributes):
+    params = ['self']
+    lines = []
+
+    for name in cls.children:
+        if cls.types[name].endswith('?'):
+            params.append(name + '=None')
+        else:
+            assert not params[-1].endswith('=None'), \
+                   'optional child before %s.%s' % (cls.__name__, name)
+            params.append(name)
+
+        lines.append('self.%s = %s' % (name, name))
+
+    for name in attributes:
+        lines.append('self.%s = initial_%s' % (name, name))
+
+    namespace = dict(('initial_' + name, value)
+                     for name, value in attributes.items())
+    exec('def __init__(%s):\n    %s\n' %
+         (', '.join(params), '\n    '.join(lines)), namespace)
+    return namespace['__init__']
+
+
+def generate_iter_children(cls):
+    items = ''.join("('%s', self.%s), " % (name, name)
+                    for name in cls.children)
+    namespace = {}
+    exec('def iter_children(self):\n    return (%s)\n' % items, namespace)
+    return namespace['iter_children']
+
+
+# `Node.verify` checks every node with a validator function that is compiled
+# from the `types` declaration of its class on first use and cached in
+# `validators`, rather than parsing the type strings and looking up the type
+# names for every child of every node. A validator only tests whether the
+# children are valid and returns the nodes among them; when they are not, it
+# calls `verify_child`, which interprets the declaration and raises an error
+# that says what is wrong.
+validators = {}
+
+
+def compile_validator(cls):
+    lines = []
+    namespace = {}
+
+    for name in cls.children:
+        ty = cls.types[name]
+        optional = ty.endswith('?')
+        ty = ty.rstrip('?')
+        many = ty[-1] if ty[-1] in '*+' else None
+        ty = ty.rstrip('*+')
+        namespace['t_' + ty] = \
+                globals()[ty] if ty in globals() else getattr(builtins, ty)
+        is_node = issubclass(namespace['t_' + ty], Node)
+        check = 'isinstance(%%s, t_%s)' % ty
+        fail = 'self.verify_child(%r)' % name
+
+        lines.append('child = self.%s' % name)
+        indent = ''
+        if optional:
+            lines.append('if child is not None:')
+            indent = '    '
+
+        if many is None:
+            lines.append(indent + 'if not %s: %s' % (check % 'child', fail))
+            if is_node:
+                lines.append(indent + 'nodes.append(child)')
+        else:
+            lines.append(indent + 'if not isinstance(child, list)%s: %s' % (
+                         ' or not child' if many == '+' else '', fail))
+            lines.append(indent + 'for item in child:')
+            lines.append(indent + '    if not %s: %s' % (check % 'item', fail))
+            if is_node:
+                lines.append(indent + 'nodes += child')
+
+    exec('def validate(self):\n    nodes = []\n    %s\n    return nodes\n' %
+         '\n    '.join(lines), namespace)
+    validators[cls] = namespace['validate']
+    return validators[cls]
+
+
+class NodeClass(type):
+    '''
+    Metaclass of `Node` that generates the slots and methods of node classes
+    from their declarations, and makes printing them non-recursive.
+    '''
+    def __new__(meta, name, bases, namespace):
+        inherited = set()
+        for base in bases:
+            for cls in base.__mro__:
+                inherited.update(cls.__dict__.get('__slots__', ()))
+
+        names = list(namespace.get('children', [])) + \
+                list(namespace.get('attributes', {}))
+        namespace['__slots__'] = tuple(namespace.get('__slots__', ())) + \
+                tuple(n for n in names if n not in inherited)
+
+        if '__str__' in namespace and inherited:
+            namespace['__str__'] = nonrecursive(namespace['__str__'])
+
+        cls = super().__new__(meta, name, bases, namespace)
+
+        if 'children' in namespace or 'attributes' in namespace:
+            attributes = {}
+            for base in reversed(cls.__mro__):
+                attributes.update(base.__dict__.get('attributes', {}))
+
+            cls.__init__ = generate_init(cls, attributes)
+            cls.iter_children = generate_iter_children(cls)
+
+        return cls
+
+
+class Node(object, metaclass=NodeClass):
     '''
     Base class for all AST nodes. It contains a bunch of magic you should not
     care about or read. Just read the README and look at the node definitions
@@ -113,27 +501,34 @@ class Node(object):
 
     children = []
     types = {}
-
-    def __init__(self, *args, **kwargs):
-        for i, name in enumerate(self.__class__.children):
-            if i < len(args):
-                value = args[i]
-            elif name in kwargs:
-                value = kwargs[name]
-            elif self.__class__.types[name].endswith('?'):
-                value = None
-            else:
-                raise RuntimeError('missing initalizer %s for %s' %
-                                   (name, self.__class__.__name__))
-
-            setattr(self, name, value)
-
-        self.location = (None, 0, 0, 0, 0)
-        self.iter = None
+    attributes = dict(_location=(None, 0, 0, 0, 0))
+
+    @property
+    def location(self):
+        location = self._location
+        if location.__class__ is int:
+            return expand_location(location)
+        return location
+
+    @location.setter
+    def location(self, location):
+        self._location = location
+
+    def __getstate__(self):
+        # packed locations refer to the source map of the parse, which is not
+        # pickled along
+        state = {}
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        state['_location'] = self.location
+        return None, state
 
     def __str__(self):
         return repr(self)
 
+    @nonrecursive
     def __repr__(self):
         s = '<%s' % self.__class__.__name__
 
@@ -143,71 +538,96 @@ class Node(object):
 
         return s + '>'
 
-    def iter_children(self):
-        for name in self.__class__.children:
-            child = getattr(self, name)
-            yield name, child
-
-    def verify(self):
+    def verify(self, depth=None):
+        '''
+        Check the children of this node and of all nodes below it against the
+        `types` declarations of their classes, raising `ASTError` for the
+        first mismatch. If `depth` is given, only the nodes at most `depth`
+        levels below this one are checked.
+        '''
+        # use an explicit stack rather than recursion so that deeply nested
+        # trees can be verified, in pre-order: all children of a node are
+        # checked before the nodes below them
+        if depth is not None:
+            nodes = [self]
+            for level in range(depth + 1):
+                nodes = [child for node in nodes
+                         for child in (validators.get(node.__class__) or
+                                       compile_validator(node.__class__))(node)]
+            return
+
+        stack = [self]
+        get = validators.get
+
+        while stack:
+            node = stack.pop()
+            cls = node.__class__
+            stack += reversed((get(cls) or compile_validator(cls))(node))
+
+    def verify_child(self, name):
+        '''
+        Check the type of child attribute `name`, and return the nodes in it
+        that must be verified next.
+        '''
         myname = self.__class__.__name__
+        child = getattr(self, name)
+        ty = self.types[name]
+
+        if ty.endswith('?'):
+            ty = ty[:-1]
+        elif child is None:
+            raise ASTError('non-optional child %s.%s has value None: %s' %
+                           (myname, name, repr(self)))
+
+        if ty.endswith('*'):
+            if not isinstance(child, list):
+                print(repr(self))
+                raise ASTError('%s.%s should have type %s: %s' %
+                               (myname, name, ty, child))
+            ty = ty[:-1]
+
+        if ty.endswith('+'):
+            if not isinstance(child, list):
+                raise ASTError('%s.%s should have type %s: %s' %
+                               (myname, name, ty, child))
+            if len(child) == 0:
+                raise ASTError('%s.%s should not be empty: %s' %
+                               (myname, name, repr(self)))
+            ty = ty[:-1]
 
-        for name in self.__class__.children:
-            child = getattr(self, name)
-            ty = self.types[name]
+        cls = globals()[ty] if ty in globals() else getattr(builtins, ty)
 
-            if ty.endswith('?'):
-                ty = ty[:-1]
-            elif child is None:
-                raise ASTError('non-optional child %s.%s has value None: %s' %
-                               (myname, name, repr(self)))
+        if isinstance(child, list):
+            for i, node in enumerate(child):
+                if not isinstance(node, cls):
+                    raise ASTError('%s.%s[%d] should have type %s (found %s): %s' %
+                                   (myname, name, i, ty, type(node).__name__, repr(self)))
+        elif not isinstance(child, cls) and child is not None:
+            raise ASTError('%s.%s should have type %s (found %s): %s' %
+                           (myname, name, ty, type(child).__name__, repr(self)))
 
-            if ty.endswith('*'):
-                if not isinstance(child, list):
-                    print(repr(self))
-                    raise ASTError('%s.%s should have type %s: %s' %
-                                   (myname, name, ty, child))
-                ty = ty[:-1]
-
-            if ty.endswith('+'):
-                if not isinstance(child, list):
-                    raise ASTError('%s.%s should have type %s: %s' %
-                                   (myname, name, ty, child))
-                if len(child) == 0:
-                    raise ASTError('%s.%s should not be empty: %s' %
-                                   (myname, name, repr(self)))
-                ty = ty[:-1]
-
-            cls = globals()[ty] if ty in globals() else getattr(builtins, ty)
-
-            if isinstance(child, list):
-                for i, node in enumerate(child):
-                    if not isinstance(node, cls):
-                        raise ASTError('%s.%s[%d] should have type %s (found %s): %s' %
-                                       (myname, name, i, ty, type(node).__name__, repr(self)))
-            elif not isinstance(child, cls) and child is not None:
-                raise ASTError('%s.%s should have type %s (found %s): %s' %
-                               (myname, name, ty, type(child).__name__, repr(self)))
-
-            if isinstance(child, Node):
-                child.verify()
-            elif isinstance(child, list):
-                for node in child:
-                    if isinstance(node, Node):
-                        node.verify()
+        if isinstance(child, Node):
+            return [child]
+        elif isinstance(child, list):
+            return [node for node in child if isinstance(node, Node)]
+        return []
 
     def at(self, location):
         '''
         Call this with either a location tuple:
         (filename, ystart, xstart, yend, xend)
-        or with another `Node` object to copy the location attribute onto this
-        node. Returns the current node to allow method chaining.
+        or a packed location (see `SourceMap`), or with another `Node` object
+        to copy the location attribute onto this node. Returns the current node
+        to allow method chaining.
         '''
         if isinstance(location, Node):
-            self.location = location.location
-            if hasattr(location, 'ty'):
+            self._location = location._location
+            if getattr(location, 'ty', None) is not None:
                 self.ty = location.ty
+        elif location.__class__ is int:
+            self._location = location
         else:
-            self.location = tuple(location)
+            self._location = tuple(location)
         return self
 
 
@@ -234,6 +654,7 @@ class Node(object):
 class Program(Node):
     children = ['decls']
     types = dict(decls='Declaration+')
+    attributes = dict(source=None)
 
     def __str__(self):
         return '\n\n'.join(map(str, self.decls))
@@ -335,6 +756,7 @@ class If(Statement):
 class While(Statement):
     children = ['cond', 'loopbody', 'doWhile']
     types = dict(cond='Expression', loopbody='Block', doWhile='bool')
+    attributes = dict(iter=None)
 
     def __str__(self):
         s = 'while ({0.cond}) {0.loopbody}'.format(self)
@@ -417,14 +839,18 @@ class ExprStatement(Statement):
 class Expression(Node):
     __metaclass__ = ABCMeta
 
+    attributes = dict(ty=None)
+
 
 class Reference:
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
 
 class VarUse(Expression, Reference):
     children = ['name', 'index']
     types = dict(name='str', index='Expression?')
+    attributes = dict(definition=None)
 
     def __str__(self):
         if self.index is not None:
@@ -459,6 +885,7 @@ class UnaryOp(Expression):
 class FunCall(Expression):
     children = ['name', 'args']
     types = dict(name='str', args='Expression*')
+    attributes = dict(definition=None)
 
     def __str__(self):
         return '%s(%s)' % (self.name, ', '.join(map(str, self.args)))
@@ -0,0 +1,1269 @@
+#!/usr/bin/env python3
+import sys
+import os
+import re
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+#
+# Performance benchmarks for the frontend. Run `./bench.py` (or `make bench`)
+# to run all benchmarks, or `./bench.py NAME...` to run a selection. Use
+# `./bench.py --list` to see which benchmarks exist.
+#
+# A benchmark is a function decorated with `@benchmark(name)`. It receives the
+# parsed command-line arguments and prints its results using `report`. A
+# benchmark that detects a performance regression (rather than just measuring)
+# raises `Regression`, which makes bench.py exit with a nonzero status.
+#
+
+
+root_path = os.path.dirname(os.path.abspath(__file__))
+benchmarks = {}
+
+
+class Regression(Exception):
+    pass
+
+
+def benchmark(name):
+    def register(fn):
+        benchmarks[name] = fn
+        return fn
+    return register
+
+
+def measure(fn, repeat):
+    '''
+    Call `fn` `repeat` times and return the best and mean wall-clock time in
+    seconds.
+    '''
+    times = []
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times), sum(times) / len(times)
+
+
+def report(label, best, mean=None, extra=''):
+    s = '  %-40s %9.2f ms' % (label, best * 1000)
+    if mean is not None:
+        s += ' (mean %.2f ms)' % (mean * 1000)
+    print(s + (' ' + extra if extra else ''))
+
+
+def python(code, env=None):
+    '''
+    Run a snippet of Python code in a fresh interpreter in the frontend
+    directory, to measure costs that are paid once per compiler invocation.
+    '''
+    subprocess.run([sys.executable, '-c', code], cwd=root_path, env=env,
+                   check=True)
+
+
+def corpus():
+    '''
+    Return the sources of all test programs as a list of (path, source) pairs.
+    '''
+    sources = []
+
+    for path in sorted(glob.glob(root_path + '/test/**/*.fc', recursive=True)):
+        if not path.endswith('-expect.fc'):
+            with open(path) as f:
+                sources.append((path, f.read()))
+
+    return sources
+
+
+def synthetic_program(nfuncs, seed=0):
+    '''
+    Generate a valid FenneC program with `nfuncs` functions containing loops,
+    conditionals and calls, for benchmarks that need larger inputs than the
+    test programs.
+    '''
+    lines = ['extern int printf(char[] format, ...);', '']
+
+    for i in range(nfuncs):
+        lines += [
+            'int f%d(int n) {' % i,
+            '    int s = %d;' % (seed + i),
+            '    for (int i = 0 to n) {',
+            '        if (i > n / 2) {',
+            '            s = s + i * 2;',
+            '        } else {',
+            '            s = s - 1;',
+            '        }',
+            '    }',
+            '    while (s > 100) {',
+            '        s = s / 2;',
+            '    }',
+            '    return s%s;' % (' + f%d(n - 1)' % (i - 1) if i else ''),
+            '}',
+            '',
+        ]
+
+    lines += [
+        'int main() {',
+        '    printf("%%d\\n", f%d(10));' % (nfuncs - 1),
+        '    return 0;',
+        '}',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def tokenize(lexer, src):
+    lexer.input(src)
+    ntokens = 0
+    while lexer.token():
+        ntokens += 1
+    return ntokens
+
+
+#
+# Benchmarks
+#
+
+
+@benchmark('parser-startup')
+def bench_parser_startup(args):
+    '''
+    Startup cost of `parser.create_parser` in a fresh process, with an empty
+    (cold) and populated (warm) LALR table cache.
+    '''
+    import cache
+    import parser
+
+    cachedir = tempfile.mkdtemp(prefix='fennec-bench-')
+    env = dict(os.environ, FENNEC_CACHE_DIR=cachedir)
+    env.pop('FENNEC_NO_CACHE', None)
+    code = 'import parser; parser.create_parser(debug=False)'
+
+    def cold():
+        shutil.rmtree(cachedir, ignore_errors=True)
+        python(code, env)
+
+    def warm():
+        python(code, env)
+
+    def inproc_cold():
+        shutil.rmtree(cachedir, ignore_errors=True)
+        parser.create_parser(debug=False)
+
+    def inproc_warm():
+        parser.create_parser(debug=False)
+
+    saved = cache.enabled, cache.directory
+    cache.enabled, cache.directory = True, cachedir
+
+    try:
+        report('fresh process, import parser only',
+               *measure(lambda: python('import parser', env), args.repeat))
+        report('fresh process, cold cache', *measure(cold, args.repeat))
+        python(code, env)
+        report('fresh process, warm cache', *measure(warm, args.repeat))
+        report('create_parser, cold cache', *measure(inproc_cold, args.repeat))
+        inproc_warm()
+        report('create_parser, warm cache', *measure(inproc_warm, args.repeat))
+    finally:
+        cache.enabled, cache.directory = saved
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+
+@benchmark('lexer-startup')
+def bench_lexer_startup(args):
+    '''
+    Lexer construction time (uncached, from the cached lexer table, and cloned
+    from the master lexer) separately from tokenization time.
+    '''
+    import cache
+    import lexer
+    import ply.lex as lex
+    from util import LocationError
+
+    cachedir = tempfile.mkdtemp(prefix='fennec-bench-')
+    env = dict(os.environ, FENNEC_CACHE_DIR=cachedir)
+    env.pop('FENNEC_NO_CACHE', None)
+    code = 'import lexer; lexer.create_lexer("x")'
+
+    saved = cache.enabled, cache.directory
+    cache.enabled, cache.directory = True, cachedir
+
+    try:
+        report('fresh process, import lexer only',
+               *measure(lambda: python('import lexer', env), args.repeat))
+        python(code, env)
+        report('fresh process, create_lexer', *measure(
+            lambda: python(code, env), args.repeat))
+
+        # purge the regex cache of the `re` module so that each construction
+        # compiles the lexer regexes like a fresh process would
+        report('lex.lex, validated from rules', *measure(
+            lambda: re.purge() or lex.lex(module=lexer), args.repeat))
+        lexer.build_lexer()
+        report('build_lexer, cached table', *measure(
+            lambda: re.purge() or lexer.build_lexer(), args.repeat))
+        lexer.create_lexer('x')
+        report('create_lexer, cloned from master', *measure(
+            lambda: lexer.create_lexer('x'), args.repeat))
+    finally:
+        cache.enabled, cache.directory = saved
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+    # only time tokenization of files that the lexer accepts (e.g., no
+    # unpreprocessed #include directives)
+    sources = []
+    for path, src in corpus():
+        try:
+            tokenize(lexer.create_lexer(path), src)
+            sources.append(src)
+        except (LocationError, NotImplementedError):
+            pass
+
+    src = '\n'.join(sources)
+    ntokens = tokenize(lexer.create_lexer('x'), src)
+    best, mean = measure(lambda: tokenize(lexer.create_lexer('x'), src),
+                         args.repeat)
+    report('tokenize test corpus (%d tokens)' % ntokens, best, mean,
+           '%.0f tokens/s' % (ntokens / best))
+
+
+@benchmark('lexer-throughput')
+def bench_lexer_throughput(args):
+    '''
+    Tokenization throughput in MB/s on synthetic inputs dominated by block
+    comments, by string literals, and on a synthetic program.
+    '''
+    import lexer
+
+    code = synthetic_program(200)
+    license = '/*\n' + ' * Permission is hereby granted, free of charge, ' \
+              'to any person obtaining a copy\n' * 40 + ' */\n'
+    strings = ''.join('char[] s%d = "%s\\n";\n' %
+                      (i, 'The quick brown fox jumps over the lazy dog. ' * 20)
+                      for i in range(100))
+
+    comments = ''.join(license + 'int x%d = 1;\n' % i for i in range(100))
+
+    inputs = (
+        ('comment-heavy', comments),
+        ('string-heavy', strings),
+        ('synthetic program', code),
+    )
+
+    for label, src in inputs:
+        src = src * max(1, 2000000 // len(src))
+        best, mean = measure(lambda: tokenize(lexer.create_lexer('x'), src),
+                             args.repeat)
+        report('%s, %.1f MB' % (label, len(src) / 1e6), best, mean,
+               '%.1f MB/s' % (len(src) / 1e6 / best))
+
+
+@benchmark('lexer-engines')
+def bench_lexer_engines(args):
+    '''
+    Tokens per second of the PLY lexer versus the re.finditer-based ScanLexer
+    engine, on the test corpus and on a large synthetic program.
+    '''
+    import lexer
+    from util import LocationError
+
+    sources = []
+    for path, src in corpus():
+        try:
+            tokenize(lexer.create_lexer(path), src)
+            sources.append(src)
+        except (LocationError, NotImplementedError):
+            pass
+
+    inputs = (
+        ('test corpus', '\n'.join(sources)),
+        ('synthetic program', synthetic_program(2000)),
+    )
+
+    for label, src in inputs:
+        ntokens = tokenize(lexer.create_lexer('x'), src)
+        baseline = None
+
+        for engine in lexer.engines:
+            best, mean = measure(
+                lambda: tokenize(lexer.create_lexer('x', engine), src),
+                args.repeat)
+            baseline = baseline or best
+            report('%s, %s (%d tokens)' % (label, engine, ntokens), best, mean,
+                   '%.0f tokens/s (speedup %.2fx)' %
+                   (ntokens / best, baseline / best))
+
+
+@benchmark('preprocess')
+def bench_preprocess(args):
+    '''
+    Per-file latency of the built-in preprocessor versus running cpp in a
+    subprocess, for test and example programs with and without directives.
+    '''
+    import preprocessor
+    from parser import run_cpp
+
+    include_paths = [root_path + '/test', root_path + '/../runtime']
+    with_directives = []
+    without_directives = []
+
+    examples = []
+    for path in sorted(glob.glob(root_path + '/../examples/*.fc')):
+        with open(path) as f:
+            examples.append((path, f.read()))
+
+    for path, src in corpus() + examples:
+        paths = include_paths + [os.path.dirname(path)]
+        try:
+            preprocessor.preprocess(path, src, paths)
+        except preprocessor.Unsupported:
+            continue
+
+        if preprocessor.has_directives(src):
+            with_directives.append((path, src, paths))
+        else:
+            without_directives.append((path, src, paths))
+
+    def run_all(pp, files):
+        for path, src, paths in files:
+            pp(path, src, paths)
+
+    for label, files in (('with directives', with_directives),
+                         ('without directives', without_directives)):
+        for name, pp in (('built-in', preprocessor.preprocess),
+                         ('cpp', run_cpp)):
+            best, mean = measure(lambda: run_all(pp, files), args.repeat)
+            report('%s, %d files %s' % (name, len(files), label),
+                   best / len(files), mean / len(files), 'per file')
+
+
+@benchmark('pch')
+def bench_pch(args):
+    '''
+    Time to preprocess and parse the example programs, which include
+    runtime/cstdlib.fh, with and without precompiled headers.
+    '''
+    import pch
+    from parser import run_preprocessor, parse
+
+    include_paths = [root_path + '/../runtime']
+    examples = []
+    for path in sorted(glob.glob(root_path + '/../examples/*.fc')):
+        with open(path) as f:
+            examples.append((path, f.read()))
+
+    def run_all(use_pch):
+        for path, src in examples:
+            precompiled = [] if use_pch else None
+            tree = parse(path, run_preprocessor(path, src, include_paths,
+                                                precompiled=precompiled))
+            pch.insert(tree, path, precompiled)
+
+    run_all(True)
+    for label, use_pch in (('textual inclusion', False),
+                           ('precompiled headers', True)):
+        best, mean = measure(lambda: run_all(use_pch), args.repeat)
+        report('%d examples, %s' % (len(examples), label),
+               best / len(examples), mean / len(examples), 'per file')
+
+
+@benchmark('preprocess-cache')
+def bench_preprocess_cache(args):
+    '''
+    Per-file latency of preprocessing test and example programs with
+    directives on a preprocessor cache miss versus a hit, with the built-in
+    preprocessor and with cpp.
+    '''
+    import cache
+    import preprocessor
+    from parser import preprocess
+    from util import FatalError
+
+    include_paths = [root_path + '/test', root_path + '/../runtime']
+    files = []
+
+    for path in sorted(glob.glob(root_path + '/../examples/*.fc')):
+        with open(path) as f:
+            files.append((path, f.read()))
+
+    files = [(path, src, include_paths + [os.path.dirname(path)])
+             for path, src in corpus() + files
+             if preprocessor.has_directives(src)]
+
+    saved_directory = cache.directory
+    cache.directory = tempfile.mkdtemp(prefix='fennec-bench-')
+
+    def run_all(use_cpp):
+        for path, src, paths in files:
+            try:
+                preprocess(path, src, paths, use_cpp, [])
+            except FatalError:
+                pass  # tests for preprocessor errors
+
+    def clear():
+        for name in os.listdir(cache.directory):
+            if name.startswith('preprocess-'):
+                os.remove(os.path.join(cache.directory, name))
+
+    try:
+        for name, use_cpp in (('built-in', False), ('cpp', True)):
+            def miss():
+                clear()
+                run_all(use_cpp)
+
+            def hit():
+                run_all(use_cpp)
+
+            for label, fn in (('miss', miss), ('hit', hit)):
+                best, mean = measure(fn, args.repeat)
+                report('%s, %d files, cache %s' % (name, len(files), label),
+                       best / len(files), mean / len(files), 'per file')
+    finally:
+        shutil.rmtree(cache.directory, ignore_errors=True)
+        cache.directory = saved_directory
+
+
+@benchmark('parse-scaling')
+def bench_parse_scaling(args):
+    '''
+    Parse time per megabyte of synthetic programs of 0.5 to 2 MB, formatted
+    normally and with all code on a single line. Computing source locations
+    must not make parse time grow faster than the input.
+    '''
+    from parser import parse
+
+    # parsing megabytes of code takes seconds, limit the repetitions
+    repeat = min(args.repeat, 3)
+
+    for layout in ('many lines', 'single line'):
+        per_mb = []
+
+        for nfuncs in (2000, 4000, 8000):
+            src = synthetic_program(nfuncs)
+            if layout == 'single line':
+                src = src.replace('\n', ' ')
+
+            mb = len(src) / 1e6
+            best, mean = measure(lambda: parse('<bench>', src), repeat)
+            report('%.1f MB, %s' % (mb, layout), best, mean,
+                   '(%.0f ms/MB)' % (best / mb * 1000))
+            per_mb.append(best / mb)
+
+        if per_mb[-1] > 2 * per_mb[0]:
+            raise Regression('parsing a %s program of 2 MB takes %.1fx longer '
+                             'per MB than one of 0.5 MB' %
+                             (layout.split()[0], per_mb[-1] / per_mb[0]))
+
+
+@benchmark('parser-engines')
+def bench_parser_engines(args):
+    '''
+    Parse throughput of the PLY parser versus the recursive-descent parser in
+    descent.py, with each lexer engine, on the test corpus and on a large
+    synthetic program.
+    '''
+    import lexer
+    import parser
+    from util import LocationError, FatalError
+
+    include_paths = [root_path + '/test']
+    sources = []
+    for path, src in corpus():
+        try:
+            src = parser.run_preprocessor(path, src, include_paths +
+                                          [os.path.dirname(path)])
+            parser.parse(path, src)
+            sources.append(src)
+        except (EOFError, LocationError, FatalError, NotImplementedError):
+            pass
+
+    inputs = (
+        ('test corpus', '\n'.join(sources)),
+        ('synthetic program', synthetic_program(2000)),
+    )
+    saved_engine = lexer.default_engine
+
+    try:
+        for label, src in inputs:
+            mb = len(src) / 1e6
+            baseline = None
+
+            for lexer_engine in lexer.engines:
+                lexer.default_engine = lexer_engine
+
+                for engine in parser.engines:
+                    best, mean = measure(
+                        lambda: parser.parse('x', src, engine=engine),
+                        args.repeat)
+                    baseline = baseline or best
+                    report('%s, %s + %s lexer' % (label, engine, lexer_engine),
+                           best, mean, '%.2f MB/s (speedup %.2fx)' %
+                           (mb / best, baseline / best))
+    finally:
+        lexer.default_engine = saved_engine
+
+
+# modules that must not be imported when the compiler stops before IR
+# generation, see `load_codegen` in main.py
+codegen_modules = ('llvmlite', 'irgen', 'pkg_resources')
+
+
+@benchmark('import-time')
+def bench_import_time(args):
+    '''
+    Breakdown of the time spent importing main.py (python -X importtime), the
+    startup time of --dump-after for each phase, and a check that phases
+    before IR generation do not import llvmlite.
+    '''
+    # -X importtime lines look like "import time: self | cumulative | name",
+    # with the name indented by two spaces per nesting level, and nested
+    # imports are listed before the module that imports them
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import main'], cwd=root_path, check=True,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    children = []
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        seconds = int(fields[1]) / 1e6
+
+        if depth == 1:
+            children.append((seconds, name.strip()))
+        elif depth == 0:
+            if name.strip() == 'main':
+                break
+            children = []
+
+    report('import main', seconds)
+    for seconds, name in sorted(children, reverse=True)[:10]:
+        report('  import ' + name, seconds)
+
+    # run the compiler in a fresh process up to each phase, and list the
+    # codegen modules that it imported (ignoring modules that were already
+    # loaded by the interpreter itself, e.g., through sitecustomize)
+    infile = os.path.join(tempfile.mkdtemp(prefix='fennec-bench-'), 'prog.fc')
+    with open(infile, 'w') as f:
+        f.write(synthetic_program(1))
+
+    code = '''if 1:
+        import sys
+        before = set(sys.modules)
+        import main
+        try:
+            main.main(sys.argv[1:])
+        except SystemExit:
+            pass
+        loaded = set(m.split('.')[0] for m in set(sys.modules) - before)
+        print(' '.join(sorted(loaded & set(%r))), file=sys.stderr)
+        ''' % (codegen_modules,)
+
+    def run(phase):
+        argv = [infile, '--dump-after', phase]
+        return subprocess.run([sys.executable, '-c', code] + argv,
+                              cwd=root_path, check=True,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE,
+                              universal_newlines=True).stderr.split()
+
+    try:
+        unexpected = []
+
+        for phase in ('parser', 'typecheck', 'irgen'):
+            best, mean = measure(lambda: run(phase), args.repeat)
+            loaded = run(phase)
+            report('fresh process, --dump-after ' + phase, best, mean)
+
+            if phase != 'irgen' and loaded:
+                unexpected.append('%s (--dump-after %s)' %
+                                  (', '.join(loaded), phase))
+    finally:
+        shutil.rmtree(os.path.dirname(infile), ignore_errors=True)
+
+    if unexpected:
+        raise Regression('codegen modules imported before IR generation: ' +
+                         '; '.join(unexpected))
+
+
+@benchmark('parallel-scaling')
+def bench_parallel_scaling(args):
+    '''
+    Wall-clock time of compiling a synthetic corpus of source files with
+    main.py -j N, for N from 1 to the number of CPUs.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='fennec-bench-')
+    infiles = []
+
+    for i in range(32):
+        infiles.append(os.path.join(tmpdir, 'prog%d.fc' % i))
+        with open(infiles[-1], 'w') as f:
+            f.write(synthetic_program(30, seed=i))
+
+    ncpus = os.cpu_count() or 1
+    jobs = sorted(set([1, ncpus] + [2 ** i for i in range(1, 8)
+                                    if 2 ** i < ncpus]))
+
+    def run(njobs):
+        subprocess.run([sys.executable, 'main.py', '-j', str(njobs)] + infiles,
+                       cwd=root_path, check=True, stdout=subprocess.DEVNULL)
+
+    try:
+        baseline = None
+        for njobs in jobs:
+            best, mean = measure(lambda: run(njobs), args.repeat)
+            baseline = baseline or best
+            report('%d files, -j %d' % (len(infiles), njobs), best, mean,
+                   '(speedup %.2fx)' % (baseline / best))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+@benchmark('traversal')
+def bench_traversal(args):
+    '''
+    Time spent traversing the AST of a large synthetic program in each phase
+    after parsing, and in a no-op ASTVisitor that only dispatches to the
+    default visit method.
+    '''
+    from parser import parse
+    from util import ASTVisitor
+    from desugar import Desugarer
+    from context import ContextAnalysis
+    from typecheck import TypeChecker
+    from irgen import IRGen
+
+    src = synthetic_program(2000)
+    phases = (
+        ('no-op ASTVisitor', ASTVisitor),
+        ('desugar', Desugarer),
+        ('context', ContextAnalysis),
+        ('typecheck', TypeChecker),
+        ('irgen', lambda: IRGen('bench')),
+    )
+    times = dict((label, []) for label, make_visitor in phases)
+    totals = []
+
+    # the phases modify the AST, so every repetition parses the program again
+    # (which is not timed)
+    for i in range(min(args.repeat, 3)):
+        tree = parse('<bench>', src)
+        total = 0
+
+        for label, make_visitor in phases:
+            visitor = make_visitor()
+            start = time.perf_counter()
+            visitor.visit(tree)
+            times[label].append(time.perf_counter() - start)
+            total += times[label][-1]
+
+        totals.append(total)
+
+    for label, make_visitor in phases:
+        report(label, min(times[label]),
+               sum(times[label]) / len(times[label]))
+    report('all phases', min(totals), sum(totals) / len(totals))
+
+
+@benchmark('verify')
+def bench_verify(args):
+    '''
+    Time spent verifying the AST after parsing and after each phase that
+    transforms or annotates it, at each --verify level, as a fraction of the
+    time it takes to compile a large synthetic program to LLVM IR.
+    '''
+    from parser import parse
+    from desugar import Desugarer
+    from context import ContextAnalysis
+    from typecheck import TypeChecker
+    from irgen import IRGen
+    from main import shallow_verify_depth
+
+    src = synthetic_program(2000)
+    levels = (('full', None), ('shallow', shallow_verify_depth))
+    phases = (Desugarer, ContextAnalysis, TypeChecker)
+    compile_times = []
+    verify_times = dict((level, []) for level, depth in levels)
+
+    for i in range(min(args.repeat, 3)):
+        verified = dict((level, 0) for level, depth in levels)
+
+        def verify(tree):
+            for level, depth in levels:
+                start = time.perf_counter()
+                tree.verify(depth)
+                verified[level] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        tree = parse('<bench>', src)
+        total = time.perf_counter() - start
+        verify(tree)
+
+        for make_visitor in phases:
+            start = time.perf_counter()
+            make_visitor().visit(tree)
+            total += time.perf_counter() - start
+            verify(tree)
+
+        start = time.perf_counter()
+        str(IRGen('bench').visit(tree))
+        compile_times.append(total + time.perf_counter() - start)
+
+        for level, depth in levels:
+            verify_times[level].append(verified[level])
+
+    compile_time = min(compile_times)
+    report('compile without verify', compile_time,
+           sum(compile_times) / len(compile_times))
+
+    for level, depth in levels:
+        times = verify_times[level]
+        report('verify (%s)' % level, min(times), sum(times) / len(times),
+               extra='%.1f%% of compile time' %
+               (100 * min(times) / (compile_time + min(times))))
+
+
+@benchmark('fused-analysis')
+def bench_fused_analysis(args):
+    '''
+    Time spent desugaring, analysing the context of and type checking a large
+    synthetic program in three passes and in the fused single pass of
+    semantic.py (--fused-analysis).
+    '''
+    from parser import parse
+    from desugar import Desugarer
+    from context import ContextAnalysis
+    from typecheck import TypeChecker
+    from semantic import SemanticAnalysis
+
+    def separate(tree):
+        Desugarer().visit(tree)
+        ContextAnalysis().visit(tree)
+        TypeChecker().visit(tree)
+
+    def fused(tree):
+        SemanticAnalysis().visit(tree)
+
+    src = synthetic_program(2000)
+    baseline = None
+
+    for label, analyse in (('three passes', separate), ('fused', fused)):
+        # the passes modify the AST, so every repetition parses the program
+        # again (which is not timed)
+        times = []
+        for i in range(min(args.repeat, 3)):
+            tree = parse('<bench>', src)
+            start = time.perf_counter()
+            analyse(tree)
+            times.append(time.perf_counter() - start)
+
+        best = min(times)
+        report(label, best, sum(times) / len(times),
+               '' if baseline is None else '(speedup %.2fx)' % (baseline / best))
+        baseline = baseline or best
+
+
+def nested_blocks_program(depth, uses):
+    '''
+    Return a program with blocks nested `depth` deep, in which each block
+    defines a variable and the innermost one uses a global `uses` times.
+    '''
+    blocks = ''.join('{ int v%d = %d; ' % (i, i) for i in range(depth))
+    body = 'int x = 0;\n' + 'x = x + g;\n' * uses
+    return 'int g = 1;\nint main() {\n%s%s%s\nreturn 0;\n}\n' % (
+            blocks, body, '}' * depth)
+
+
+def wide_globals_program(nglobals):
+    '''
+    Return a program with `nglobals` global variables that are all used by
+    one function.
+    '''
+    return ''.join('int g%d = %d;\n' % (i, i) for i in range(nglobals)) + \
+           'int main() {\nint x = 0;\n' + \
+           ''.join('x = x + g%d;\n' % i for i in range(nglobals)) + \
+           'return x;\n}\n'
+
+
+@benchmark('scopes')
+def bench_scopes(args):
+    '''
+    Time spent in context analysis on programs that look up names from deeply
+    nested blocks, and that define many globals.
+    '''
+    from parser import parse
+    from desugar import Desugarer
+    from context import ContextAnalysis
+
+    programs = (
+        ('nested blocks, depth 10', nested_blocks_program(10, 20000)),
+        ('nested blocks, depth 100', nested_blocks_program(100, 20000)),
+        ('nested blocks, depth 1000', nested_blocks_program(1000, 20000)),
+        ('20000 globals', wide_globals_program(20000)),
+    )
+
+    for label, src in programs:
+        # context analysis annotates the AST, but does not change it
+        tree = parse('<bench>', src)
+        Desugarer().visit(tree)
+        best, mean = measure(lambda: ContextAnalysis().visit(tree),
+                             args.repeat)
+        report(label, best, mean)
+
+
+def expression_program(nstatements):
+    '''
+    Return a program with one function of `nstatements` assignments of
+    arithmetic, relational and logical expressions.
+    '''
+    statements = (
+        'i = (i + %d) * j - (j % 7) / (i - %d);',
+        'f = -f * 1.5 - (f + 2.0) / %d.0;',
+        'b = (i < j) && (f >= 2.0) || !(i == %d) && b != (j > %d);',
+        'c = c + \'a\' - (c * \'b\') % \'c\'; j = j + %d % 13;',
+    )
+    body = ''.join(statements[n % len(statements)].replace('%d', str(n)) +
+                   '\n' for n in range(nstatements))
+    return 'int main() {\nint i = 1;\nint j = 2;\nfloat f = 1.0;\n' \
+           'bool b = true;\nchar c = \'x\';\n%sreturn i;\n}\n' % body
+
+
+@benchmark('expressions')
+def bench_expressions(args):
+    '''
+    Time spent type checking and generating IR for a function with many
+    arithmetic, relational and logical expressions.
+    '''
+    from parser import parse
+    from desugar import Desugarer
+    from context import ContextAnalysis
+    from typecheck import TypeChecker
+    from irgen import IRGen
+
+    src = expression_program(4000)
+    phases = (('typecheck', TypeChecker), ('irgen', lambda: IRGen('bench')))
+    times = dict((label, []) for label, make_visitor in phases)
+
+    # the phases modify the AST, so every repetition parses the program again
+    # (which is not timed)
+    for i in range(min(args.repeat, 3)):
+        tree = parse('<bench>', src)
+        Desugarer().visit(tree)
+        ContextAnalysis().visit(tree)
+
+        for label, make_visitor in phases:
+            start = time.perf_counter()
+            make_visitor().visit(tree)
+            times[label].append(time.perf_counter() - start)
+
+    for label, make_visitor in phases:
+        report(label, min(times[label]),
+               sum(times[label]) / len(times[label]))
+
+
+def control_flow_program(nstatements):
+    '''
+    Return a program with one function of `nstatements` if-statements, loops
+    with breaks and continues, logical operators and returns, which all add
+    basic blocks to the function. IRGen names a new block after the current
+    one, up to a maximum length (see `IRGen.max_prefix_length`); the returns
+    keep the names short as well (the code after them is still compiled).
+    '''
+    statements = (
+        'if (i > %d && j < %d) { i = i - 1; } else { j = j + 1; }',
+        'while (i < %d) { i = i + 1; if (i == j) { break; } }',
+        'while (j > %d) { j = j - 1; if (j == i || i > 3) { continue; } }',
+        'return %d;',
+    )
+    body = ''.join(statements[n % len(statements)].replace('%d', str(n)) +
+                   '\n' for n in range(nstatements))
+    return 'int main() {\nint i = 1;\nint j = 2;\n%sreturn i;\n}\n' % body
+
+
+@benchmark('control-flow')
+def bench_control_flow(args):
+    '''
+    Time spent generating IR for functions with many control flow statements,
+    which must not grow quadratically with the number of basic blocks (see
+    `irgen.BlockOrder`).
+    '''
+    from parser import parse
+    from desugar import Desugarer
+    from context import ContextAnalysis
+    from typecheck import TypeChecker
+    from irgen import IRGen
+
+    for nstatements in (2500, 10000, 20000):
+        src = control_flow_program(nstatements)
+        times = []
+
+        # IR generation modifies the AST, so every repetition parses the
+        # program again (which is not timed)
+        for i in range(min(args.repeat, 3)):
+            tree = parse('<bench>', src)
+            Desugarer().visit(tree)
+            ContextAnalysis().visit(tree)
+            TypeChecker().visit(tree)
+
+            start = time.perf_counter()
+            IRGen('bench').visit(tree)
+            times.append(time.perf_counter() - start)
+
+        report('irgen, %d statements' % nstatements, min(times),
+               sum(times) / len(times))
+
+
+@benchmark('ir-output')
+def bench_ir_output(args):
+    '''
+    Time spent in each stage of writing the generated IR as text or bitcode
+    (formatting it, parsing and verifying it with LLVM, reformatting it and
+    writing it), and in the old and new output paths of `main.save_module`,
+    which no longer reformats text output and can skip verification.
+    '''
+    from parser import parse
+    from desugar import Desugarer
+    from context import ContextAnalysis
+    from typecheck import TypeChecker
+    from irgen import IRGen
+    import llvmlite.binding as llvm
+
+    tree = parse('<bench>', synthetic_program(2000))
+    for visitor in (Desugarer, ContextAnalysis, TypeChecker):
+        visitor().visit(tree)
+    module = IRGen('bench').visit(tree)
+
+    text = str(module)
+    mod = llvm.parse_assembly(text)
+
+    def write(data, mode):
+        with open(os.devnull, mode) as f:
+            f.write(data)
+
+    stages = (
+        ('format', lambda: str(module)),
+        ('parse', lambda: llvm.parse_assembly(text)),
+        ('verify', mod.verify),
+        ('reformat', lambda: str(mod)),
+        ('bitcode', mod.as_bitcode),
+        ('write text', lambda: write(text, 'w')),
+        ('write bitcode', lambda: write(mod.as_bitcode(), 'wb')),
+    )
+    repeat = min(args.repeat, 3)
+    best = {}
+
+    for label, fn in stages:
+        best[label], mean = measure(fn, repeat)
+        report(label, best[label], mean)
+
+    # the output paths are sums of the best stage times (writing bitcode
+    # includes converting the module to bitcode)
+    paths = (
+        ('text, old', ('format', 'parse', 'verify', 'reformat',
+                       'write text')),
+        ('text, new', ('format', 'parse', 'verify', 'write text')),
+        ('text, new with --no-verify-ir', ('format', 'write text')),
+        ('bitcode', ('format', 'parse', 'verify', 'write bitcode')),
+        ('bitcode with --no-verify-ir', ('format', 'parse', 'write bitcode')),
+    )
+
+    for label, path in paths:
+        report(label, sum(best[stage] for stage in path))
+
+
+def chain_program(depth):
+    '''
+    Return a program with a chain of `depth` binary operators in one
+    expression, which parses to an AST that is about `depth` nodes deep.
+    '''
+    return 'int main() {\n    int a = 1;\n    return a%s;\n}\n' % (
+            ' + a' * depth)
+
+
+@benchmark('deep-traversal')
+def bench_deep_traversal(args):
+    '''
+    Time spent in each phase with the iterative and the recursive traversal,
+    on a large synthetic program and on a chain of binary operators that is
+    shallow enough for the recursive traversal, and with the iterative
+    traversal on a chain of 100000 operators.
+    '''
+    from parser import parse
+    from util import ASTVisitor, ASTTransformer
+    from desugar import Desugarer
+    from context import ContextAnalysis
+    from typecheck import TypeChecker
+    from irgen import IRGen
+
+    phases = (
+        ('desugar', Desugarer),
+        ('context', ContextAnalysis),
+        ('typecheck', TypeChecker),
+        ('irgen', lambda: IRGen('bench')),
+    )
+
+    def run(src, repeat):
+        times = dict((label, []) for label, make_visitor in phases)
+
+        # the phases modify the AST, so every repetition parses the program
+        # again (which is not timed)
+        for i in range(repeat):
+            tree = parse('<bench>', src)
+
+            for label, make_visitor in phases:
+                visitor = make_visitor()
+                start = time.perf_counter()
+                visitor.visit(tree)
+                times[label].append(time.perf_counter() - start)
+
+        return times
+
+    programs = (
+        ('synthetic', synthetic_program(2000)),
+        ('chain-300', chain_program(300)),
+    )
+
+    for name, src in programs:
+        for recursive in (False, True):
+            ASTVisitor.recursive = ASTTransformer.recursive = recursive
+            try:
+                times = run(src, min(args.repeat, 3))
+            finally:
+                ASTVisitor.recursive = ASTTransformer.recursive = False
+
+            mode = 'recursive' if recursive else 'iterative'
+            for label, make_visitor in phases:
+                report('%s %s %s' % (name, label, mode), min(times[label]),
+                       sum(times[label]) / len(times[label]))
+
+    # the recursive traversal runs out of stack on this one
+    times = run(chain_program(100000), 1)
+    for label, make_visitor in phases:
+        report('chain-100000 %s iterative' % label, min(times[label]))
+
+
+
+@benchmark('ast-nodes')
+def bench_ast_nodes(args):
+    '''
+    Memory used per AST node and the number of nodes constructed per second,
+    for the nodes of a large synthetic program and for constructing the most
+    common expression nodes directly.
+    '''
+    import tracemalloc
+    import ast
+    from parser import parse
+
+    def count_nodes(tree):
+        n = 0
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack += node
+            elif isinstance(node, ast.Node):
+                n += 1
+                stack += [child for name, child in node.iter_children()]
+        return n
+
+    # parse once before measuring so that the parser tables are loaded
+    src = synthetic_program(2000)
+    nnodes = count_nodes(parse('<bench>', src))
+
+    tracemalloc.start()
+    try:
+        tree = parse('<bench>', src)
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+        del tree
+
+    best, mean = measure(lambda: parse('<bench>', src), args.repeat)
+    report('parse synthetic program', best, mean,
+           '%.0f bytes/node, %d nodes' % (size / nnodes, nnodes))
+
+    # construct n `a + 1`-shaped expressions, which is 3 nodes each
+    n = 100000
+    plus = ast.Operator.get('+')
+    location = ('<bench>', 1, 1, 1, 1)
+
+    def construct():
+        return [ast.BinaryOp(ast.VarUse('a').at(location), plus,
+                             ast.IntConst(1).at(location)).at(location)
+                for i in range(n)]
+
+    tracemalloc.start()
+    try:
+        nodes = construct()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+        del nodes
+
+    best, mean = measure(construct, args.repeat)
+    report('construction', best, mean, '%.0f bytes/node, %.2fM nodes/s' %
+           (size / (3 * n), 3 * n / best / 1e6))
+
+
+
+@benchmark('locations')
+def bench_locations(args):
+    '''
+    Memory used per AST node and parse time for a large synthetic program with
+    each parser engine, and the time it takes to read the location of every
+    node afterwards.
+    '''
+    import tracemalloc
+    import ast
+    from parser import parse, engines
+
+    def all_nodes(tree):
+        nodes = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack += node
+            elif isinstance(node, ast.Node):
+                nodes.append(node)
+                stack += [child for name, child in node.iter_children()]
+        return nodes
+
+    def read_locations(nodes):
+        for node in nodes:
+            node.location
+
+    src = synthetic_program(8000)
+
+    for engine in engines:
+        # parse once before measuring so that the parser tables are loaded
+        nnodes = len(all_nodes(parse('<bench>', src, engine=engine)))
+
+        tracemalloc.start()
+        try:
+            tree = parse('<bench>', src, engine=engine)
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+        nodes = all_nodes(tree)
+        best, mean = measure(lambda: parse('<bench>', src, engine=engine),
+                             min(args.repeat, 3))
+        report('parse %s' % engine, best, mean, '%.0f bytes/node, %d nodes' %
+               (size / nnodes, nnodes))
+
+        best, mean = measure(lambda: read_locations(nodes), args.repeat)
+        report('read all locations (%s)' % engine, best, mean)
+        del tree, nodes
+
+
+
+# size of the generated source for the flat-ast benchmark, in bytes, and of
+# the smaller one that is also compiled to LLVM IR (the IR of the large one
+# does not fit in memory)
+flat_ast_size = 50 * 1024 * 1024
+flat_ast_irgen_size = 2 * 1024 * 1024
+
+flat_ast_script = '''
+import sys, time, resource
+from parser import parse
+from desugar import Desugarer
+from context import ContextAnalysis
+from typecheck import TypeChecker
+
+mode, path, irgen = sys.argv[1], sys.argv[2], sys.argv[3] == 'irgen'
+with open(path) as f:
+    src = f.read()
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+start = time.perf_counter()
+if mode == 'flat':
+    import arena
+    tree = arena.parse(path, src, transform=Desugarer().visit)
+else:
+    tree = parse(path, src, engine='descent')
+    Desugarer().visit(tree)
+ContextAnalysis().visit(tree)
+TypeChecker().visit(tree)
+if irgen:
+    from irgen import IRGen
+    str(IRGen('bench').visit(tree))
+
+print(time.perf_counter() - start,
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+'''
+
+
+@benchmark('flat-ast')
+def bench_flat_ast(args):
+    '''
+    Peak memory use and time of parsing, desugaring, context analysis and type
+    checking a generated 50 MB source with the tree of node objects and with
+    the flat AST (--flat-ast), each in a fresh interpreter, and of compiling a
+    2 MB source to LLVM IR.
+    '''
+    nfuncs = 1
+    while len(synthetic_program(nfuncs)) < 4096:
+        nfuncs *= 2
+    func_size = len(synthetic_program(nfuncs)) / nfuncs
+
+    tmpdir = tempfile.mkdtemp(prefix='fennec-bench-')
+    try:
+        for size, irgen in ((flat_ast_size, 'typecheck'),
+                            (flat_ast_irgen_size, 'irgen')):
+            path = os.path.join(tmpdir, 'flat.fc')
+            with open(path, 'w') as f:
+                f.write(synthetic_program(int(size / func_size)))
+
+            for mode in ('tree', 'flat'):
+                out = subprocess.run(
+                        [sys.executable, '-c', flat_ast_script, mode, path,
+                         irgen], cwd=root_path, check=True,
+                        stdout=subprocess.PIPE, universal_newlines=True).stdout
+                seconds, rss = out.split()
+                report('%d MB to %s (%s)' % (size >> 20, irgen, mode),
+                       float(seconds), extra='peak RSS +%d MB' %
+                       (int(rss) >> 10))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('names', nargs='*', metavar='NAME',
+            help='benchmarks to run (default all)')
+    argparser.add_argument('-l', '--list', action='store_true',
+            help='list available benchmarks and exit')
+    argparser.add_argument('-r', '--repeat', type=int, default=5,
+            help='number of repetitions per measurement (default 5)')
+    args = argparser.parse_args()
+
+    if args.list:
+        for name, fn in benchmarks.items():
+            print('%-20s %s' % (name, ' '.join(fn.__doc__.split())))
+        sys.exit(0)
+
+    status = 0
+
+    for name in args.names or benchmarks:
+        if name not in benchmarks:
+            print('Error: no such benchmark: %s' % name, file=sys.stderr)
+            sys.exit(1)
+
+        print(name + ':')
+        try:
+            benchmarks[name](args)
+        except Regression as e:
+            print('Regression: %s' % e, file=sys.stderr)
+            status = 1
+
+    sys.exit(status)
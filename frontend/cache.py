@@ -0,0 +1,129 @@
+import os
+import sys
+import hashlib
+import binascii
+from contextlib import contextmanager
+
+
+#
+# On-disk cache for derived data such as parser tables. Entries are stored as
+# files whose names contain a hash of everything they were derived from, so
+# that a changed input automatically results in a different file and stale
+# entries are never read. Files are written under a temporary name first and
+# then renamed into place, which makes them safe to share between concurrent
+# compiler processes: a reader either sees a complete entry or no entry at all.
+#
+# Entries that are not bounded in number, such as preprocessed sources, are
+# evicted in least-recently-used order when their total size exceeds a limit:
+# `touch` marks an entry as used by updating its modification time, and
+# `evict` removes the entries that were used longest ago.
+#
+# The cache is stored in __pycache__ next to the compiler sources by default.
+# Set FENNEC_CACHE_DIR to use a different directory, and set FENNEC_NO_CACHE
+# (or pass --no-cache to main.py) to disable caching altogether.
+#
+
+
+enabled = not os.getenv('FENNEC_NO_CACHE')
+directory = os.getenv('FENNEC_CACHE_DIR') or \
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+
+
+def digest(*parts):
+    '''
+    Hash a sequence of strings/bytes into a short hexadecimal cache key.
+    '''
+    h = hashlib.sha1()
+
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+
+    return h.hexdigest()[:16]
+
+
+def path(name):
+    '''
+    Return the path of the cache entry called `name`, or None if caching is
+    disabled or the cache directory cannot be created.
+    '''
+    if not enabled:
+        return None
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+
+    return os.path.join(directory, name)
+
+
+def temp_name(filename):
+    '''
+    Return a unique temporary file name in the same directory as `filename`,
+    which can be renamed to `filename` atomically.
+    '''
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, '.%s.%d.%s.tmp' %
+            (basename, os.getpid(), binascii.hexlify(os.urandom(4)).decode()))
+
+
+@contextmanager
+def atomic(filename):
+    '''
+    Context manager that yields a fresh temporary file name in the same
+    directory as `filename`. The caller creates the temporary file, which is
+    then atomically renamed to `filename` when the block exits without an
+    exception. Failing to install the file only produces a warning, since the
+    caller then simply does not get a cached copy.
+    '''
+    tmpname = temp_name(filename)
+
+    try:
+        yield tmpname
+        os.replace(tmpname, filename)
+    except OSError as e:
+        print('Warning: could not write %s: %s' % (filename, e),
+              file=sys.stderr)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def touch(filename):
+    '''
+    Mark the cache entry `filename` as recently used, see `evict`.
+    '''
+    try:
+        os.utime(filename)
+    except OSError:
+        pass
+
+
+def evict(prefix, max_size):
+    '''
+    Remove the least recently used cache entries whose names start with
+    `prefix` until their total size is at most `max_size` bytes.
+    '''
+    entries = []
+
+    try:
+        for entry in os.scandir(directory):
+            if entry.name.startswith(prefix):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        return
+
+    total = sum(size for mtime, size, path in entries)
+
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import sys
+import os
+import server
+
+
+#
+# Thin client for the compile server (see server.py). It accepts the same
+# arguments as main.py and behaves identically: the server runs the compiler in
+# the client's working directory, and the client prints the compiler's output
+# and exits with its exit status. If no server of the current user is running,
+# the client runs the compiler itself. Once the request has been sent, the
+# client does not fall back: that would compile the file twice, and print its
+# output twice.
+#
+
+
+if __name__ == '__main__':
+    try:
+        sock = server.connect(server.default_socket_path())
+    except OSError:
+        import main
+        main.main()
+
+    try:
+        status = server.request(sock, ('compile', sys.argv[1:], os.getcwd()))
+    except (OSError, EOFError, ValueError) as e:
+        print('Error: lost connection to the compile server: %s' % e,
+              file=sys.stderr)
+        status = 1
+
+    sys.exit(status)
@@ -6,30 +6,55 @@ class ContextAnalysis(ASTVisitor):
     This traversal implements the scoping rules from the Language Reference.
     `add_to_scope` and `find_in_scope` implement the stack structure of scoping
     levels.
+
+    Rather than a dictionary per scope, which makes looking up a name take as
+    long as the scopes are deep, the scopes share one symbol table that maps
+    each name to the stack of its visible definitions, innermost last, as
+    (scope level, node) pairs. Each scope keeps an undo log of the names it
+    defined, which `close_scope` pops from the symbol table again.
     '''
 
+    def reset_scopes(self):
+        self.symbols = {}
+        self.scopes = [[]]
+
+    def open_scope(self):
+        self.scopes.append([])
+
+    def close_scope(self):
+        symbols = self.symbols
+
+        for name in self.scopes.pop():
+            bindings = symbols[name]
+            bindings.pop()
+            if not bindings:
+                del symbols[name]
+
     def add_to_scope(self, node):
-        curscope = self.scopes[-1]
+        level = len(self.scopes)
+        bindings = self.symbols.setdefault(node.name, [])
 
-        if node.name in curscope:
+        if bindings and bindings[-1][0] == level:
             raise BackrefError(
                     node.location, 'Error: redefinition of %s' % node.name,
-                    curscope[node.name].location, 'Note: defined earlier here')
+                    bindings[-1][1].location, 'Note: defined earlier here')
 
-        curscope[node.name] = node
+        bindings.append((level, node))
+        self.scopes[-1].append(node.name)
         #print('scope[%s] = %s' % (node.name, repr(node)))
 
     def find_in_scope(self, node):
-        for scope in reversed(self.scopes):
-            if node.name in scope:
-                #print('%s -> %s' % (node.name, repr(scope[node.name])))
-                node.definition = scope[node.name]
-                return
+        bindings = self.symbols.get(node.name)
+
+        if bindings:
+            #print('%s -> %s' % (node.name, repr(bindings[-1][1])))
+            node.definition = bindings[-1][1]
+            return
 
         raise NodeError(node, 'Error: %s is undefined' % node.name)
 
     def visitProgram(self, node):
-        self.scopes = [{}]
+        self.reset_scopes()
         self.fundefs = []
 
         # collect globals
@@ -38,19 +63,18 @@ class ContextAnalysis(ASTVisitor):
         # visit function bodies after collecting all functions and globals so
         # that their names are in the global scope
         for fundef in self.fundefs:
-            self.scopes.append({})
+            self.open_scope()
             # put function name and parameters in the same scope as local vars so
             # that they cannot shadow each other
             self.add_to_scope(fundef)
             self.visit(fundef._type.params)
             self.visit(fundef.body.statements)
-            self.scopes.pop()
+            self.close_scope()
 
     def visitGlobalDec(self, node):
         self.add_to_scope(node)
 
-    def visitGlobalDef(self, node):
-        self.visit_children(node)
+    def leaveGlobalDef(self, node):
         self.add_to_scope(node)
 
     def visitFunDec(self, node):
@@ -62,27 +86,24 @@ class ContextAnalysis(ASTVisitor):
         self.add_to_scope(node)
         self.fundefs.append(node)
 
-    def visitBlock(self, node):
+    def enterBlock(self, node):
         # start a new scope for each block
-        self.scopes.append({})
-        self.visit_children(node)
-        self.scopes.pop()
+        self.open_scope()
+
+    def leaveBlock(self, node):
+        self.close_scope()
 
     def visitParam(self, node):
         self.add_to_scope(node)
 
-    def visitVarDef(self, node):
-        self.visit_children(node)
+    def leaveVarDef(self, node):
         self.add_to_scope(node)
 
-    def visitArrayDef(self, node):
-        self.visit_children(node)
+    def leaveArrayDef(self, node):
         self.add_to_scope(node)
 
-    def visitVarUse(self, node):
+    def enterVarUse(self, node):
         self.find_in_scope(node)
-        self.visit_children(node)
 
-    def visitFunCall(self, node):
+    def enterFunCall(self, node):
         self.find_in_scope(node)
-        self.visit_children(node)
@@ -0,0 +1,483 @@
+import ast
+from lexer import token_error
+from parser import precedence, block
+
+
+#
+# Hand-written recursive-descent parser, an alternative to the PLY parser in
+# parser.py for large inputs (select it with `parse(..., engine='descent')` or
+# the --parser option of main.py). PLY's table-driven parsing loop creates a
+# `YaccProduction` and calls a rule function for every reduction, whereas this
+# parser consumes tokens directly and uses precedence climbing (Pratt parsing)
+# for expressions, with operator precedence taken from the `precedence` table
+# in parser.py.
+#
+# It produces exactly the same AST as the PLY parser, with the same locations
+# and the same syntax errors, which runtests.py checks for every test (see
+# `parser.compare_engines`). This requires some care:
+#
+# - Like PLY, the parser always reads one token ahead. A node is created at
+#   the point where PLY would reduce its production, which is after reading
+#   the token that follows it, except for `funheader_varargs` where PLY reduces
+#   without reading ahead. This matters for the file name in locations, which
+#   is taken from the lexer and changes after line markers.
+#
+# - A syntax error is reported at the first token that cannot continue the
+#   input, which is also where the LR parser detects it.
+#
+# - Assignments are only allowed to a variable or to an index expression that
+#   is not enclosed in parentheses, like the `index ASSIGN expr` production.
+#
+# Input that is nested too deeply for Python's recursion limit is parsed with
+# the PLY parser instead, see `parser.parse`.
+#
+
+
+# binary operators by token type, with the precedence level of each operator
+# (higher binds more strongly); all of them are left-associative
+levels = dict((token, level) for level, (assoc, *tokens) in
+              enumerate(precedence) for token in tokens)
+binary_operators = dict((token, levels[token]) for token in (
+    'OR', 'AND', 'EQ', 'NE', 'LT', 'GT', 'LE', 'GE',
+    'PLUS', 'MINUS', 'TIMES', 'DIVIDE', 'MODULO'))
+unary_operators = ('NOT', 'MINUS', 'INV')
+assert all(levels[op] < levels['UMINUS'] for op in binary_operators)
+assert levels['UMINUS'] < levels['LBRACKET']
+
+constants = {
+    'BOOLCONST': lambda value: ast.BoolConst(value == 'true'),
+    'CHARCONST': ast.CharConst,
+    'INTCONST': lambda value: ast.IntConst(int(value)),
+    'FLOATCONST': lambda value: ast.FloatConst(float(value)),
+    'HEXCONST': lambda value: ast.HexConst(int(value[2:], 16)),
+}
+
+
+class Parser:
+    def __init__(self, lexer, src):
+        self.lexer = lexer
+        self.lexer.input(src)
+        self.source = ast.SourceMap(src)
+        self.next_token = lexer.token
+
+        # current token and its type, '$end' at the end of the input
+        self.tok = None
+        self.type = None
+
+        # whether the last parsed expression is an `index` that can be
+        # assigned to
+        self.is_index = False
+
+        self.advance()
+
+    def advance(self):
+        '''
+        Consume the current token and read the next one. Returns the consumed
+        token.
+        '''
+        tok = self.tok
+        self.tok = self.next_token()
+        self.type = '$end' if self.tok is None else self.tok.type
+        return tok
+
+    def expect(self, toktype):
+        if self.type != toktype:
+            self.error()
+        return self.advance()
+
+    def error(self):
+        tok = self.tok
+        if tok is None:
+            raise EOFError()
+        if not hasattr(tok, 'lexer'):
+            tok.lexer = self.lexer
+        raise token_error(tok, 'Syntax error at \'%s\'' % tok.value)
+
+    #
+    # Locations, see `parser.loc`
+    #
+
+    def start(self, tok):
+        return self.source.start(tok.lineno, tok.lexpos)
+
+    def end(self, tok):
+        return self.source.end(tok.lineno, tok.lexpos, len(tok.value))
+
+    def token_loc(self, tok):
+        '''
+        Location of a single token, the most common case.
+        '''
+        return self.source.location(self.lexer.fname, self.start(tok),
+                                    self.end(tok))
+
+    def span(self, first, last):
+        '''
+        Location from the start of node `first` to the end of node `last`.
+        '''
+        return self.source.location(self.lexer.fname,
+                                    ast.location_start(first._location),
+                                    ast.location_end(last._location))
+
+    def loc(self, start, end):
+        '''
+        Location from the start of `start` to the end of `end`, each of which
+        is either a token or a node.
+        '''
+        first = ast.location_start(start._location) \
+                if isinstance(start, ast.Node) else self.start(start)
+        last = ast.location_end(end._location) \
+               if isinstance(end, ast.Node) else self.end(end)
+        return self.source.location(self.lexer.fname, first, last)
+
+    #
+    # Declarations
+    #
+
+    def program(self):
+        if self.type == '$end':
+            self.error()
+
+        decls = list(self.declarations())
+        return ast.Program(decls).at(self.span(decls[0], decls[-1]))
+
+    def declarations(self):
+        '''
+        Generate the declarations of the program one at a time, see
+        `arena.parse`.
+        '''
+        while self.type != '$end':
+            yield self.declaration()
+
+    def declaration(self):
+        if self.type == 'EXTERN':
+            self.advance()
+            _type = self.type_()
+            name = self.expect('ID')
+
+            if self.type == 'SEMICOL':
+                self.advance()
+                return ast.GlobalDec(_type, name.value).at(
+                    self.token_loc(name))
+
+            if self.type != 'LPAREN':
+                self.error()
+            funtype = self.funheader(_type, name, True)
+            self.expect('SEMICOL')
+            return ast.FunDec(name.value, funtype).at(self.span(funtype,
+                                                                funtype))
+
+        static = self.type == 'STATIC'
+        if static:
+            self.advance()
+
+        _type = self.type_()
+        name = self.expect('ID')
+
+        if self.type == 'ASSIGN':
+            self.advance()
+            value = self.expr()
+            self.expect('SEMICOL')
+            return ast.GlobalDef(static, _type, name.value, value).at(
+                self.token_loc(name))
+
+        if self.type != 'LPAREN':
+            self.error()
+        funtype = self.funheader(_type, name, False)
+        self.expect('LBRACE')
+        body = ast.Block(self.statements())
+        self.expect('RBRACE')
+        return ast.FunDef(static, name.value, funtype, body).at(
+            self.span(funtype, funtype))
+
+    def funheader(self, return_type, name, extern):
+        '''
+        Parse the parameter list of a function, starting at the opening
+        parenthesis. Varargs are only allowed in extern declarations.
+        '''
+        self.advance()
+        params = []
+        varargs = False
+
+        if extern and self.type == 'DOTS':
+            self.advance()
+            varargs = True
+        elif self.type != 'RPAREN':
+            params.append(self.param())
+            while self.type == 'COMMA':
+                self.advance()
+                if extern and self.type == 'DOTS':
+                    self.advance()
+                    varargs = True
+                    break
+                params.append(self.param())
+
+        if self.type != 'RPAREN':
+            self.error()
+
+        if varargs:
+            # PLY reduces `funheader_varargs` without reading ahead
+            funtype = ast.FunType(return_type, params, True).at(
+                self.token_loc(name))
+            self.advance()
+        else:
+            self.advance()
+            funtype = ast.FunType(return_type, params, False).at(
+                self.token_loc(name))
+
+        return funtype
+
+    def param(self):
+        _type = self.type_()
+        name = self.expect('ID')
+        return ast.Param(_type, name.value).at(self.token_loc(name))
+
+    def type_(self):
+        _type = ast.Type.get(self.expect('TYPE').value)
+        while self.type == 'BRACKETS':
+            self.advance()
+            _type = ast.ArrayType.get(_type)
+        return _type
+
+    #
+    # Statements
+    #
+
+    def statements(self):
+        '''
+        Parse statements up to the closing brace of a block.
+        '''
+        stats = []
+        while self.type != 'RBRACE':
+            stats.append(self.statement())
+        return stats
+
+    def statement(self):
+        toktype = self.type
+
+        if toktype == 'ID':
+            name = self.advance()
+
+            if self.type in ('ASSIGN', 'MODIFY'):
+                op = self.advance()
+                value = self.expr()
+                end = self.expect('SEMICOL')
+                ref = ast.VarUse(name.value).at(self.token_loc(name))
+                return self.assignment(ref, op, value).at(self.loc(name, end))
+
+            expr = self.binary(self.postfix(self.identifier(name)), 0)
+            return self.expr_statement(expr)
+
+        if toktype == 'LBRACE':
+            start = self.advance()
+            stats = self.statements()
+            end = self.expect('RBRACE')
+            return ast.Block(stats).at(self.loc(start, end))
+
+        if toktype == 'TYPE':
+            _type = self.type_()
+
+            if self.type == 'ID':
+                name = self.advance()
+                self.expect('ASSIGN')
+                value = self.expr()
+                self.expect('SEMICOL')
+                return ast.VarDef(_type, name.value, value).at(
+                    self.token_loc(name))
+
+            self.expect('LBRACKET')
+            size = self.expr()
+            self.expect('RBRACKET')
+            name = self.expect('ID')
+            self.expect('SEMICOL')
+            return ast.ArrayDef(ast.ArrayType.get(_type), size,
+                                name.value).at(self.token_loc(name))
+
+        if toktype == 'IF':
+            start = self.advance()
+            self.expect('LPAREN')
+            cond = self.expr()
+            end = self.expect('RPAREN')
+            yesbody = self.statement()
+            nobody = None
+            if self.type == 'ELSE':
+                self.advance()
+                nobody = block(self.statement())
+            return ast.If(cond, block(yesbody), nobody).at(self.loc(start, end))
+
+        if toktype == 'WHILE':
+            start = self.advance()
+            self.expect('LPAREN')
+            cond = self.expr()
+            end = self.expect('RPAREN')
+            loopbody = block(self.statement())
+            return ast.While(cond, loopbody, False).at(self.loc(start, end))
+
+        if toktype == 'DO':
+            start = self.advance()
+            loopbody = block(self.statement())
+            self.expect('WHILE')
+            self.expect('LPAREN')
+            cond = self.expr()
+            self.expect('RPAREN')
+            self.expect('SEMICOL')
+            return ast.While(cond, loopbody, True).at(self.token_loc(start))
+
+        if toktype == 'FOR':
+            self.advance()
+            self.expect('LPAREN')
+            vartype = self.type_()
+            varname = self.expect('ID')
+            self.expect('ASSIGN')
+            _from = self.expr()
+            self.expect('TO')
+            to = self.expr()
+            self.expect('RPAREN')
+            loopbody = block(self.statement())
+            return ast.For(vartype, varname.value, _from, to, loopbody)
+
+        if toktype in ('BREAK', 'CONTINUE'):
+            start = self.advance()
+            self.expect('SEMICOL')
+            node = ast.Break() if toktype == 'BREAK' else ast.Continue()
+            return node.at(self.token_loc(start))
+
+        if toktype == 'RETURN':
+            start = self.advance()
+            if self.type == 'SEMICOL':
+                self.advance()
+                return ast.Return(None).at(self.token_loc(start))
+            value = self.expr()
+            self.expect('SEMICOL')
+            return ast.Return(value).at(self.loc(start, value))
+
+        return self.expr_statement(self.expr())
+
+    def expr_statement(self, expr):
+        '''
+        Finish a statement that starts with expression `expr`: either an
+        assignment to an index expression or an expression statement.
+        '''
+        if self.is_index and self.type in ('ASSIGN', 'MODIFY'):
+            op = self.advance()
+            value = self.expr()
+            end = self.expect('SEMICOL')
+            return self.assignment(expr, op, value).at(self.loc(expr, end))
+
+        end = self.expect('SEMICOL')
+        return ast.ExprStatement(expr).at(self.loc(expr, end))
+
+    def assignment(self, ref, op, value):
+        if op.type == 'ASSIGN':
+            return ast.Assignment(ref, value)
+        return ast.Modification(ref, ast.Operator.get(op.value[:-1]), value)
+
+    #
+    # Expressions
+    #
+
+    def expr(self, min_level=0):
+        return self.binary(self.unary(), min_level)
+
+    def binary(self, lhs, min_level):
+        '''
+        Parse binary operators with at least precedence level `min_level`
+        following the operand `lhs`.
+        '''
+        while True:
+            level = binary_operators.get(self.type)
+            if level is None or level < min_level:
+                return lhs
+
+            op = self.advance()
+            rhs = self.expr(level + 1)
+            lhs = ast.BinaryOp(lhs, ast.Operator.get(op.value), rhs).at(
+                self.span(lhs, rhs))
+            self.is_index = False
+
+    def unary(self):
+        # unary operators bind more strongly than all binary operators, and
+        # less strongly than indexing
+        if self.type in unary_operators:
+            op = self.advance()
+            value = self.unary()
+            node = ast.UnaryOp(ast.Operator.get(op.value), value).at(
+                self.loc(op, value))
+            self.is_index = False
+            return node
+
+        return self.postfix(self.primary())
+
+    def postfix(self, base):
+        while self.type == 'LBRACKET':
+            self.advance()
+            index = self.expr()
+            end = self.expect('RBRACKET')
+            location = self.loc(base, end)
+
+            if isinstance(base, ast.VarUse) and base.index is None:
+                base.index = index
+                base.at(location)
+            else:
+                base = ast.Index(base, index).at(location)
+
+            self.is_index = True
+
+        return base
+
+    def primary(self):
+        toktype = self.type
+        self.is_index = False
+
+        if toktype == 'ID':
+            return self.identifier(self.advance())
+
+        if toktype == 'LPAREN':
+            self.advance()
+            expr = self.expr()
+            self.expect('RPAREN')
+            self.is_index = False
+            return expr
+
+        if toktype in constants:
+            tok = self.advance()
+            return constants[toktype](tok.value).at(self.token_loc(tok))
+
+        if toktype == 'STRINGCONST':
+            tok = self.advance()
+            node = ast.StringConst(tok.value)
+            pos = tok.lexpos - 1
+            return node.at(self.source.location(self.lexer.fname,
+                    self.source.start(tok.lineno, pos),
+                    self.source.end(tok.lineno, pos, len(str(node)))))
+
+        self.error()
+
+    def identifier(self, name):
+        '''
+        Parse a variable use or function call starting with identifier token
+        `name`, which has been consumed already.
+        '''
+        self.is_index = False
+
+        if self.type != 'LPAREN':
+            return ast.VarUse(name.value).at(self.token_loc(name))
+
+        self.advance()
+        args = []
+
+        if self.type != 'RPAREN':
+            args.append(self.expr())
+            while self.type == 'COMMA':
+                self.advance()
+                args.append(self.expr())
+
+        self.expect('RPAREN')
+        self.is_index = False
+        return ast.FunCall(name.value, args).at(self.token_loc(name))
+
+
+def parse(lexer, src):
+    parser = Parser(lexer, src)
+    tree = parser.program()
+    tree.source = parser.source
+    return tree
@@ -20,18 +20,18 @@ class Desugarer(ASTTransformer):
         varcache[name] += 1
         return name if not occurrences else name + str(occurrences + 1)
 
-    def visitFunDef(self, node):
+    def enterFunDef(self, node):
         self.varcache_stack.append({})
-        self.visit_children(node)
+
+    def leaveFunDef(self, node):
         self.varcache_stack.pop()
 
-    def visitModification(self, m):
+    def leaveModification(self, m):
         # from: lhs op= rhs
         # to:   lhs = lhs op rhs
-        self.visit_children(m)
         return Assignment(m.ref, BinaryOp(m.ref, m.op, m.value)).at(m)
         
-    def visitFor(self, f):
+    def leaveFor(self, f):
         '''
         from:   for (type id = init to end) {
                     ...
@@ -49,10 +49,8 @@ class Desugarer(ASTTransformer):
         assert isinstance(f.loopbody, Block)
         assert str(f.vartype) == "int"
         
-        self.visit_children(f)
-        
         ref = VarUse(f.varname)
-        whilebody = Block(f.loopbody.statements + [self.visitModification(Modification(ref, Operator.get('+'), IntConst(1)))])
+        whilebody = Block(f.loopbody.statements + [self.leaveModification(Modification(ref, Operator.get('+'), IntConst(1)))])
         whilecond = BinaryOp(ref, Operator.get('<'), f.to)
         whileblock = While(whilecond, whilebody, False)
         # update the iter property of the AST node to distinguish between while and for loops
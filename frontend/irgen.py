@@ -3,6 +3,74 @@ from util import ASTTransformer
 import ast
 
 
+# IR types of the base types, and IRBuilder methods for the arithmetic
+# operators on integer and floating point operands, indexed by their codes
+# (see ast.py)
+base_types = [None] * ast.ARRAY
+base_types[ast.BOOL] = ir.IntType(1)
+base_types[ast.CHAR] = ir.IntType(8)
+base_types[ast.INT] = ir.IntType(ast.Type.int_bits)
+base_types[ast.FLOAT] = ir.DoubleType()
+base_types[ast.VOID] = ir.VoidType()
+
+
+def instruction_table(instructions):
+    return [instructions.get(op) for op in ast.Operator.ops]
+
+
+int_instructions = instruction_table({
+    '+': ir.IRBuilder.add, '-': ir.IRBuilder.sub, '*': ir.IRBuilder.mul,
+    '/': ir.IRBuilder.sdiv, '%': ir.IRBuilder.srem
+})
+float_instructions = instruction_table({
+    '+': ir.IRBuilder.fadd, '-': ir.IRBuilder.fsub, '*': ir.IRBuilder.fmul,
+    '/': ir.IRBuilder.fdiv, '%': ir.IRBuilder.frem
+})
+
+# operators that are not translated to a single instruction
+AND, OR, NOT, NE, MINUS = [ast.Operator.get(op).code
+                           for op in ('&&', '||', '!', '!=', '-')]
+
+
+class BlockOrder(object):
+    '''
+    Order of the basic blocks of a function during IR generation, as a doubly
+    linked list, so that a block can be inserted before another one in
+    constant time. llvmlite keeps the blocks of a function in a list, which
+    makes `Function.insert_basic_block` take time linear in the number of
+    blocks (and finding the position of the other block as well), so large
+    functions would take quadratic time. Instead, blocks are appended to the
+    function when they are created and put in order by `IRGen.visitFunDef`
+    when the function is complete.
+    '''
+    def __init__(self, entry):
+        self.prev = {entry: None}
+        self.next = {entry: None}
+        self.first = self.last = entry
+
+    def append(self, block):
+        self.prev[block] = self.last
+        self.next[block] = None
+        self.next[self.last] = block
+        self.last = block
+
+    def insert(self, block, before):
+        prev = self.prev[before]
+        self.prev[block] = prev
+        self.next[block] = before
+        self.prev[before] = block
+        if prev is None:
+            self.first = block
+        else:
+            self.next[prev] = block
+
+    def blocks(self):
+        block = self.first
+        while block is not None:
+            yield block
+            block = self.next[block]
+
+
 class IRGen(ASTTransformer):
     '''
     This traversal transforms an `ast.Program` into an `llvmlite.ir.Module`.
@@ -17,9 +85,18 @@ class IRGen(ASTTransformer):
 
     Use `self.visit` and `self.visit_before` to traverse into child nodes, using
     the latter when you have appended new blocks in which the children must be
-    created (see `visitIf` for an example).
+    created (see `visitIf` for an example). `visit_before` is a generator, so
+    methods that use it are generators as well, which the traversal runs
+    without recursing (see util.py), so that if-statements, loops and logical
+    operators can be nested arbitrarily deep.
     '''
 
+    # new blocks are named after the current block, so that names reflect the
+    # nesting of statements, but names longer than this start over from the
+    # name of the function's entry block, so that they do not grow with the
+    # nesting depth or with the number of statements in a sequence
+    max_prefix_length = 100
+
     def __init__(self, module_name):
         self.module = ir.Module(module_name)
         self.module.triple = binding.get_default_triple()
@@ -27,6 +104,7 @@ class IRGen(ASTTransformer):
         self.target_data = binding.create_target_data(self.module.data_layout)
         self.builder = None
         self.terminating_return = None
+        self.block_order = None
         self.insert_blocks = []
         self.fns = {}
         self.vars = {}
@@ -52,8 +130,7 @@ class IRGen(ASTTransformer):
         self.vars[node] = g
         return g
 
-    def visitGlobalDef(self, node):
-        self.visit_children(node)
+    def leaveGlobalDef(self, node):
         g = ir.GlobalVariable(self.module, self.getty(node._type), node.name)
         g.linkage = 'internal' if node.static else 'available_externally'
         g.initializer = node.value
@@ -71,6 +148,7 @@ class IRGen(ASTTransformer):
         self.fns[node] = fn
         entry = fn.append_basic_block('entry')
         self.builder = ir.IRBuilder(entry)
+        self.block_order = BlockOrder(entry)
 
         # add parameter names and add them to the scope, create a local alloca
         # for non-array params (i.e. those passed by value)
@@ -98,8 +176,11 @@ class IRGen(ASTTransformer):
             assert str(node._type.return_type) == 'void'
             self.builder.ret_void()
 
+        fn.blocks = list(self.block_order.blocks())
+
         self.builder = None
         self.terminating_return = None
+        self.block_order = None
 
         return fn
 
@@ -130,7 +211,7 @@ class IRGen(ASTTransformer):
         # first add the necessary basic blocks so that we can insert jumps to
         # them, use `visit_before` to make sure that any new basic blocks added
         # for statements in the 'if' body are inserted before the 'else' body
-        prefix = self.builder.block.name
+        prefix = self.block_prefix()
         bif = self.add_block(prefix + '.if')
         if node.nobody:
             belse = self.add_block(prefix + '.else')
@@ -139,25 +220,25 @@ class IRGen(ASTTransformer):
             belse = bend = self.add_block(prefix + '.endif')
 
         # insert instructions for the predicate condition before the 'if' block
-        cond = self.visit_before(node.cond, bif)
+        cond = yield from self.visit_before(node.cond, bif)
         self.builder.cbranch(cond, bif, belse)
 
         # insert instructions for the 'if' block before the 'else' block
         self.builder.position_at_start(bif)
-        self.visit_before(node.yesbody, belse)
+        yield from self.visit_before(node.yesbody, belse)
         self.builder.branch(bend)
 
         # insert instructions for the 'else' block before the end block
         if node.nobody:
             self.builder.position_at_start(belse)
-            self.visit_before(node.nobody, bend)
+            yield from self.visit_before(node.nobody, bend)
             self.builder.branch(bend)
 
         # go to the end block to emit further instructions
         self.builder.position_at_start(bend)
 
     def visitWhile(self, node):
-        prefix = self.builder.block.name
+        prefix = self.block_prefix()
 
         # create blocks in the correct order, the order changes if it's a do-while loop
         if not node.doWhile:
@@ -180,7 +261,7 @@ class IRGen(ASTTransformer):
 
         # insert instructions to check the condition after the 'whilecond' block
         self.builder.position_at_start(bwhilecond)
-        cond = self.visit_before(node.cond, baftercond)
+        cond = yield from self.visit_before(node.cond, baftercond)
         self.builder.cbranch(cond, bwhilebody, bend)
 
         # push ending block of this loop to loops stack
@@ -191,7 +272,7 @@ class IRGen(ASTTransformer):
 
         # insert instructions of the loop body
         self.builder.position_at_start(bwhilebody)
-        self.visit_before(node.loopbody, bafterbody)
+        yield from self.visit_before(node.loopbody, bafterbody)
         self.builder.branch(bwhilecond)
 
         # pop ending block of this loop from loops stack
@@ -200,9 +281,7 @@ class IRGen(ASTTransformer):
 
         self.builder.position_at_start(bend)
 
-    def visitReturn(self, node):
-        self.visit_children(node)
-
+    def leaveReturn(self, node):
         b = self.builder
         ret = b.ret_void() if node.value is None else b.ret(node.value)
 
@@ -218,7 +297,7 @@ class IRGen(ASTTransformer):
         assert len(self.loops) > 0
         self.builder.branch(self.loops[-1][0])
         self.builder.position_at_start(self.add_block(
-            self.builder.block.name + '.post_break'))
+            self.block_prefix() + '.post_break'))
 
     def visitContinue(self, node):
         assert len(self.loops) > 0
@@ -232,17 +311,20 @@ class IRGen(ASTTransformer):
             self.visitAssignment(ast.Assignment(iter, value))
         
         self.builder.branch(self.loops[-1][1])
-        self.builder.position_at_start(self.add_block(self.builder.block.name + '.post_continue'))
+        self.builder.position_at_start(self.add_block(self.block_prefix() + '.post_continue'))
 
-    def visitVarDef(self, node):
+    def enterVarDef(self, node):
         ty=self.getty(node._type)
-        self.vars[node]=alloca=self.builder.alloca(ty, name=node.name)
-        self.builder.store(self.visit(node.value), alloca)
+        self.vars[node]=self.builder.alloca(ty, name=node.name)
+
+    def leaveVarDef(self, node):
+        alloca=self.vars[node]
+        self.builder.store(node.value, alloca)
         return alloca
 
-    def visitArrayDef(self, node):
+    def leaveArrayDef(self, node):
         ty=self.getty(node._type.base)
-        size=self.visit(node.size)
+        size=node.size
         self.vars[node]=alloca=self.builder.alloca(ty, size, node.name)
 
         # zero-initialize using memset
@@ -261,9 +343,8 @@ class IRGen(ASTTransformer):
             self.memset=self.module.declare_intrinsic('llvm.memset', args)
         return self.memset
 
-    def visitVarUse(self, node):
+    def leaveVarUse(self, node):
         isarray=node.ty.is_array()
-        self.visit_children(node)
         ptr=self.vars[node.definition]
         name=node.name
 
@@ -281,67 +362,60 @@ class IRGen(ASTTransformer):
 
         return self.builder.load(ptr, name)
 
-    def visitIndex(self, node):
-        self.visit_children(node)
+    def leaveIndex(self, node):
         ptr=self.builder.gep(node.base, [node.index])
         return self.builder.load(ptr)
 
-    def visitUnaryOp(self, node):
-        # logical operators don't exist in LLVM
-        if node.op == '!':
-            eq = ast.Operator.get('==')
-            false=self.makebool(False)
-            return self.visit(ast.BinaryOp(node.value, eq, false).at(node))
+    def leaveUnaryOp(self, node):
+        # logical operators don't exist in LLVM, compare to false instead
+        if node.op.code == NOT:
+            false=self.visitBoolConst(self.makebool(False))
+            return self.builder.icmp_signed('==', node.value, false)
 
-        if node.op == '-':
-            if str(node.ty) == 'float':
+        if node.op.code == MINUS:
+            if node.ty.code == ast.FLOAT:
                 # for floating point unary negation the following transformation is used: -x = 0 - x 
                 zerofloat = ir.Constant(self.getty(node.ty), 0)
-                return self.builder.fsub(zerofloat, self.visit(node.value))
+                return self.builder.fsub(zerofloat, node.value)
             else:
-                return self.builder.neg(self.visit(node.value))
+                return self.builder.neg(node.value)
 
         assert node.op == '~'
-        return self.builder.not_(self.visit(node.value))
-
-    def visitBinaryOp(self, node):
-        op=node.op
-        b=self.builder
-        ltype=node.lhs.ty
+        return self.builder.not_(node.value)
 
-        # logical operators don't exist in LLVM
-        if op == '&&':
+    def enterBinaryOp(self, node):
+        # logical operators don't exist in LLVM, generate control flow before
+        # visiting the operands (the children are skipped if this returns a
+        # value, here a generator that visits them)
+        if node.op.code == AND:
             no=self.makebool(False)
             return self.lazy_conditional(node, node.lhs, node.rhs, no)
 
-        if op == '||':
+        if node.op.code == OR:
             yes=self.makebool(True)
             return self.lazy_conditional(node, node.lhs, yes, node.rhs)
 
-        self.visit_children(node)
+    def leaveBinaryOp(self, node):
+        op=node.op
+        b=self.builder
 
-        # both operands of binary operators must have the same type since FenneC does not support type-casting
-        if str(ltype) == 'float':
-            if op.is_equality() or op.is_relational():
-                if op == '!=':
-                    # unordered comparison returns True for NaN
-                    return b.fcmp_unordered(op.op, node.lhs, node.rhs)
-                else:
-                    return b.fcmp_ordered(op.op, node.lhs, node.rhs)
-
-            callbacks={
-                '+': b.fadd, '-': b.fsub, '*': b.fmul, '/': b.fdiv, '%': b.frem
-            }
+        # the operands have been replaced by their values, operands of type
+        # float are the only ones with a double IR type
+        isfloat=isinstance(node.lhs.type, ir.DoubleType)
 
-        else:
-            if op.is_equality() or op.is_relational():
+        # both operands of binary operators must have the same type since FenneC does not support type-casting
+        if op.kind == ast.EQUALITY or op.kind == ast.RELATIONAL:
+            if not isfloat:
                 return b.icmp_signed(op.op, node.lhs, node.rhs)
 
-            callbacks={
-                '+': b.add, '-': b.sub, '*': b.mul, '/': b.sdiv, '%': b.srem
-            }
+            if op.code == NE:
+                # unordered comparison returns True for NaN
+                return b.fcmp_unordered(op.op, node.lhs, node.rhs)
+            else:
+                return b.fcmp_ordered(op.op, node.lhs, node.rhs)
 
-        return callbacks[op.op](node.lhs, node.rhs)
+        instructions=float_instructions if isfloat else int_instructions
+        return instructions[op.code](b, node.lhs, node.rhs)
 
     def lazy_conditional(self, node, cond, yesval, noval):
         b=self.builder
@@ -350,27 +424,26 @@ class IRGen(ASTTransformer):
         bno=self.add_block('no')
         bend=self.add_block('endcond')
 
-        cond=self.visit_before(cond, byes)
+        cond=yield from self.visit_before(cond, byes)
         b.cbranch(cond, byes, bno)
 
         b.position_at_start(bend)
         phi=b.phi(self.getty(node.ty))
 
         b.position_at_start(byes)
-        yesval=self.visit_before(yesval, bno)
+        yesval=yield from self.visit_before(yesval, bno)
         b.branch(bend)
         phi.add_incoming(yesval, b.block)
 
         b.position_at_start(bno)
-        noval=self.visit_before(noval, bend)
+        noval=yield from self.visit_before(noval, bend)
         b.branch(bend)
         phi.add_incoming(noval, b.block)
 
         b.position_at_end(bend)
         return phi
 
-    def visitFunCall(self, node):
-        self.visit_children(node)
+    def leaveFunCall(self, node):
         return self.builder.call(self.fns[node.definition], node.args)
 
     def visitBoolConst(self, node):
@@ -408,49 +481,44 @@ class IRGen(ASTTransformer):
         return self.builder.gep(s, (self.zero, self.zero), True, name)
 
     def getty(self, ty):
-        if isinstance(ty, ast.ArrayType):
+        if ty.code == ast.ARRAY:
             return ir.PointerType(self.getty(ty.base))
 
-        assert isinstance(ty, ast.Type)
-
-        if str(ty) == 'bool':
-            return ir.IntType(1)
-
-        if str(ty) == 'char':
-            return ir.IntType(8)
+        return base_types[ty.code]
 
-        if str(ty) == 'int':
-            return ir.IntType(ast.Type.int_bits)
-
-        if str(ty) == 'float':
-            return ir.DoubleType()
-
-        assert str(ty) == 'void'
-        return ir.VoidType()
+    def block_prefix(self):
+        name=self.builder.block.name
+        if len(name) > self.max_prefix_length:
+            name=self.block_order.first.name
+        return name
 
     def add_block(self, name='', before=None):
         '''
         Add a new basic block at the current insert point. The insert point is
         either set by `visit_before` or missing, in which case the block is
-        appended at the end of the function.
+        appended at the end of the function. See `BlockOrder`.
         '''
         if not before and self.insert_blocks:
             before=self.insert_blocks[-1]
 
+        block=self.builder.append_basic_block(name)
+
         if before:
-            fn=self.builder.function
-            index=fn.basic_blocks.index(before)
-            return fn.insert_basic_block(index, name)
+            self.block_order.insert(block, before)
+        else:
+            self.block_order.append(block)
 
-        return self.builder.append_basic_block(name)
+        return block
 
     def visit_before(self, node, before_block):
         '''
         Visit an AST node, making sure that all created basic blocks are
-        inserted before the specified block `before_block`.
+        inserted before the specified block `before_block`. This is a
+        generator that yields the node to the traversal, use it as `val =
+        yield from self.visit_before(node, block)`.
         '''
         self.insert_blocks.append(before_block)
-        val=self.visit(node)
+        val=yield node
         self.insert_blocks.pop()
         return val
 
@@ -1,13 +1,20 @@
+import os
+import re
+import copy
+import types
+import ply
 import ply.lex as lex
+from ply.lex import LexToken
+import cache
 from util import LocationError
 from ast import StringConst
 
 
-# define separate states for parsing strings and multi-line comments, since
-# other tokens like keywords have no special meaning there
+# define a separate state for parsing strings that cannot be lexed with a
+# single regular expression (see `t_string` below), since other tokens like
+# keywords have no special meaning there
 states = (
     ('string', 'exclusive'),
-    ('comment', 'exclusive'),
 )
 
 # define literal reserved keywords, these are automatically capitalized and
@@ -84,7 +91,6 @@ t_ignore = ' \t'            # ignore whitespace
 t_ignore_COMMENT = r'//.*'  # single-line comment
 
 t_string_ignore = ''        # don't ignore characters in string constants
-t_comment_ignore = ''       # ... or anything particular in comments
 
 
 #
@@ -110,11 +116,42 @@ def t_number(t):
     return t
 
 
+# get escape sequences from `ast.StringConst`
+reverse_trans = dict((v[-1], chr(k)) for k, v in StringConst.trans.items())
+escape = re.compile(r'\\(.)')
+
+
+def unescape(s):
+    if '\\' not in s:
+        return s
+    return escape.sub(lambda m: reverse_trans.get(m.group(1), m.group(1)), s)
+
+
+# String and character constants are lexed with a single regular expression
+# each, as long as they are on a single line and do not contain octal or
+# hexadecimal escapes. Anything else starts the 'string' state below, which
+# handles one character at a time and produces the appropriate errors. Like in
+# the 'string' state, the position of the token is that of the first character
+# after the opening quote.
+def t_STRINGCONST(t):
+    r'"(?:[^"\\\n]|\\[^\n0-9x])*"'
+    t.lexpos += 1
+    t.value = unescape(t.value[1:-1])
+    return t
+
+
+def t_CHARCONST(t):
+    r"'(?:[^'\\\n]|\\[^\n0-9x])'"
+    t.lexpos += 1
+    t.value = unescape(t.value[1:-1])
+    return t
+
+
 # enter the 'string' state when a " is encountered
 def t_string(t):
     r'"'
     t.lexer.string_start = t.lexer.lexpos
-    t.lexer.string_buf = ''
+    t.lexer.string_buf = []
     t.lexer.string_escape = False
     t.lexer.in_charconst = False
     t.lexer.begin('string')
@@ -125,16 +162,12 @@ def t_string(t):
 def t_char(t):
     r'\''
     t.lexer.string_start = t.lexer.lexpos
-    t.lexer.string_buf = ''
+    t.lexer.string_buf = []
     t.lexer.string_escape = False
     t.lexer.in_charconst = True
     t.lexer.begin('string')
 
 
-# get escape sequences from `ast.StringConst`
-reverse_trans = dict((v[-1], chr(k)) for k, v in StringConst.trans.items())
-
-
 # in the 'string' state, handle escape sequences and maintain a buffer until the
 # closing quote is found, then produce a STRINGCONST or CHARCONST token with the
 # buffer as its value
@@ -143,7 +176,7 @@ def t_string_char(t):
     if t.lexer.string_escape:
         if t.value in reverse_trans:
             # known escape character
-            t.lexer.string_buf += reverse_trans[t.value]
+            t.lexer.string_buf.append(reverse_trans[t.value])
         elif t.value.isdigit():
             # octal
             raise NotImplementedError('octal strings are not supported')
@@ -152,47 +185,51 @@ def t_string_char(t):
             raise NotImplementedError('hexadecimal strings are not supported')
         else:
             # unknown escape character, just ignore it
-            t.lexer.string_buf += t.value
+            t.lexer.string_buf.append(t.value)
 
         t.lexer.string_escape = False
     elif t.value == '\\':
         t.lexer.string_escape = True
     elif not t.lexer.in_charconst and t.value == '"':
         t.lexpos = t.lexer.string_start
-        t.value = t.lexer.string_buf
+        t.value = ''.join(t.lexer.string_buf)
         t.type = 'STRINGCONST'
         t.lexer.begin('INITIAL')
         return t
     elif t.lexer.in_charconst and t.value == '\'':
         assert len(t.lexer.string_buf) == 1
         t.lexpos = t.lexer.string_start
-        t.value = t.lexer.string_buf
+        t.value = t.lexer.string_buf[0]
         t.type = 'CHARCONST'
         t.lexer.begin('INITIAL')
         return t
     elif t.lexer.in_charconst and len(t.lexer.string_buf) > 0:
         raise token_error(t, 'Unexpected %s, expected \'' % t.value[0])
     else:
-        t.lexer.string_buf += t.value
+        t.lexer.string_buf.append(t.value)
 
 
 def t_string_error(t):
     t_error(t)
 
 
+# skip a whole block comment at once, counting the lines in it; the second rule
+# only matches a comment that is not closed before the end of the input
 def t_comment(t):
-    r'/\*'
-    t.lexer.begin('comment')
+    r'/\*[^*]*\*+(?:[^*/][^*]*\*+)*/'
+    count_newlines(t)
 
 
-def t_comment_end(t):
-    r'\*/|.'
-    if t.value == '*/':
-        t.lexer.begin('INITIAL')
+def t_comment_unterminated(t):
+    r'/\*[\s\S]*'
+    count_newlines(t)
 
 
-def t_comment_error(t):
-    t_error(t)
+def count_newlines(t):
+    newlines = t.value.count('\n')
+    if newlines:
+        t.lexer.lineno += newlines
+        t.lexer.last_newline_pos = t.lexpos + t.value.rindex('\n')
 
 
 def t_ANY_newline(t):
@@ -227,14 +264,284 @@ def token_error(t, message):
     return LocationError((t.lexer.fname, line, col, line, col), message)
 
 
-def create_lexer(fname, **kwargs):
-    lexer = lex.lex(**kwargs)
+def lexer_digest():
+    '''
+    Hash everything the lexer tables are generated from: the token list, the
+    lexer states and all `t_` rules in the order in which PLY combines them.
+    '''
+    rules = []
+    for name, rule in globals().items():
+        if not name.startswith('t_'):
+            continue
+        if callable(rule):
+            rules.append((rule.__code__.co_firstlineno, name, rule.__doc__))
+        else:
+            rules.append((0, name, rule))
+
+    parts = [ply.__version__, repr(tokens), repr(states)]
+    for line, name, regex in sorted(rules):
+        parts += [name, regex or '']
+    return cache.digest(*parts)
+
+
+def load_lextab(tabfile):
+    # the table file is a Python module generated by PLY, load it without
+    # going through the import system since the cache is not on the path
+    with open(tabfile) as f:
+        code = compile(f.read(), tabfile, 'exec')
+    module = types.ModuleType(os.path.basename(tabfile)[:-3])
+    exec(code, module.__dict__)
+    return module
+
+
+def build_lexer():
+    '''
+    Build the master lexer, using the cached lexer table (see cache.py) when
+    available. Reading the table skips PLY's reflection-based rule validation
+    and master regex construction. When the table is not cached yet, the lexer
+    is built and validated from the rules and the table is stored.
+    '''
+    tabfile = cache.path('lextab_%s.py' % lexer_digest())
+
+    if tabfile is None:
+        return lex.lex()
+
+    if os.path.exists(tabfile):
+        try:
+            return lex.lex(optimize=True, lextab=load_lextab(tabfile))
+        except Exception:
+            pass  # corrupt cache entry, regenerate it below
+
+    lexer = lex.lex()
+
+    # PLY derives the output file name from the module name, write the table
+    # under a dot-free temporary name first
+    with cache.atomic(tabfile) as tmpname:
+        dirname = os.path.dirname(tmpname)
+        tmpmodule = os.path.basename(tmpname).replace('.', '_')
+        lexer.writetab(tmpmodule, dirname)
+        os.replace(os.path.join(dirname, tmpmodule + '.py'), tmpname)
+
+    return lexer
+
+
+#
+# Alternative tokenizer engine for large inputs. PLY tries the master regex at
+# each position and does several attribute lookups and a function call per
+# token. `ScanLexer` instead runs one combined `re.finditer` scanner over the
+# input, built from the same rules in the same order as PLY's master regex
+# (so the same rule wins at every position), with groups for ignored
+# characters and for errors added. Tokens for string rules are produced
+# directly, and identifiers and newlines are handled inline; all other rules
+# call the same `t_` functions as PLY, through the same interface (`t.lexer`,
+# `lexer.begin`, `lexer.lexpos`). The result is the same stream of `LexToken`
+# objects with the same lexer state (`lineno`, `fname`, `last_newline_pos`)
+# at each token, so that yacc and `token_error` cannot tell the difference.
+#
+# Select the engine with `create_lexer(fname, engine='scan')`, or change
+# `default_engine` to use it for all lexers created without an explicit
+# engine (see the --lexer option of main.py).
+#
+
+
+engines = ('ply', 'scan')
+default_engine = 'ply'
+
+
+class ScanLexer:
+    def __init__(self, master):
+        # per lexer state: (scanner, token types of string rules, other rules),
+        # where other rules maps the group name of each rule to a (function,
+        # token type) pair like in PLY's tables
+        self.scanners = {}
+
+        for state, regexes in master.lexstatere.items():
+            patterns = []
+            simple = {}
+            rules = {}
+
+            for regex, indexfunc in regexes:
+                patterns.append(regex.pattern)
+                for name, index in regex.groupindex.items():
+                    func, toktype = indexfunc[index]
+                    if func is None and toktype is not None:
+                        simple[name] = toktype
+                    else:
+                        rules[name] = func, toktype
+
+            # ignored characters are skipped as part of the next match, and
+            # anything else that no rule matches is an error
+            ignore = master.lexstateignore.get(state, '')
+            if ignore:
+                pattern = '[%s]*(?:%s|(?P<_error>[^%s]))' % (
+                    re.escape(ignore), '|'.join(patterns), re.escape(ignore))
+            else:
+                pattern = r'%s|(?P<_error>[\s\S])' % '|'.join(patterns)
+
+            scanner = re.compile(pattern, regexes[0][0].flags)
+            self.scanners[state] = scanner, simple, rules
+
+        self.errorf = master.lexstateerrorf
+        self.lexstate = 'INITIAL'
+        self.lexdata = None
+        self.lexpos = 0
+
+    def clone(self):
+        return copy.copy(self)
+
+    def begin(self, state):
+        self.lexstate = state
+
+    def input(self, s):
+        self.lexdata = s
+        self.lexpos = 0
+        self.token = self.scan().__next__
+
+    def token(self):
+        raise RuntimeError('No input string given with input()')
+
+    def scan(self):
+        data = self.lexdata
+
+        while True:
+            state = self.lexstate
+            scanner, simple, rules = self.scanners[state]
+
+            for m in scanner.finditer(data, self.lexpos):
+                name = m.lastgroup
+
+                if name in simple:
+                    tok = LexToken()
+                    tok.type = simple[name]
+                    tok.value = m.group(name)
+                    tok.lineno = self.lineno
+                    tok.lexpos = m.start(name)
+                    yield tok
+                    continue
+
+                if name == 't_ID':
+                    tok = LexToken()
+                    tok.value = value = m.group(name)
+                    tok.type = reserved_map.get(value, 'ID')
+                    tok.lineno = self.lineno
+                    tok.lexpos = m.start(name)
+                    yield tok
+                    continue
+
+                start = m.start(name)
+                end = self.lexpos = m.end()
+
+                if name == 't_ANY_newline':
+                    self.lineno += end - start
+                    self.last_newline_pos = end - 1
+                    continue
+
+                tok = LexToken()
+                tok.value = m.group(name)
+                tok.lineno = self.lineno
+                tok.lexpos = start
+                tok.lexer = self
+
+                if name == '_error':
+                    tok.value = data[start:]
+                    tok.type = 'error'
+                    self.lexpos = start
+                    self.errorf[state](tok)
+                    if self.lexpos == start:
+                        raise lex.LexError('Scanning error. Illegal character '
+                                           '\'%s\'' % data[start], data[start:])
+                    break
+
+                func, tok.type = rules[name]
+
+                if func is None:
+                    continue  # ignored token, e.g., a // comment
+
+                tok = func(tok)
+                if tok:
+                    yield tok
+
+                # restart the scanner if the rule changed the lexer state or
+                # position
+                if self.lexstate != state or self.lexpos != end:
+                    break
+            else:
+                break
+
+        # like PLY, return None at the end of the input
+        while True:
+            yield None
+
+
+# master lexers from which all lexers in this process are cloned, so that the
+# lexer tables are only loaded once
+master_lexer = None
+master_scan_lexer = None
+
+
+def create_lexer(fname, engine=None, **kwargs):
+    global master_lexer, master_scan_lexer
+
+    engine = engine or default_engine
+    if engine not in engines:
+        raise ValueError('unknown lexer engine: %s' % engine)
+
+    if kwargs:
+        lexer = lex.lex(**kwargs)
+        if engine == 'scan':
+            lexer = ScanLexer(lexer)
+    else:
+        if master_lexer is None:
+            master_lexer = build_lexer()
+        if engine == 'scan':
+            if master_scan_lexer is None:
+                master_scan_lexer = ScanLexer(master_lexer)
+            lexer = master_scan_lexer.clone()
+        else:
+            lexer = master_lexer.clone()
+
     lexer.lineno = 1
     lexer.last_newline_pos = -1
     lexer.fname = fname
     return lexer
 
 
+def compare_engines(fname, src):
+    '''
+    Tokenize `src` with both lexer engines and return a description of the
+    first difference in the produced tokens, lexer state or errors, or None
+    if they are identical.
+    '''
+    streams = []
+
+    for engine in engines:
+        lexer = create_lexer(fname, engine)
+        lexer.input(src)
+        stream = []
+
+        while True:
+            try:
+                tok = lexer.token()
+            except (LocationError, NotImplementedError, AssertionError) as e:
+                stream.append(('error', type(e).__name__, str(e),
+                               getattr(e, 'location', None)))
+                break
+            if tok is None:
+                stream.append(('end', lexer.lineno, lexer.last_newline_pos))
+                break
+            stream.append((tok.type, tok.value, tok.lineno, tok.lexpos,
+                           lexer.fname, lexer.last_newline_pos))
+
+        streams.append(stream)
+
+    for i, (a, b) in enumerate(zip(*streams)):
+        if a != b:
+            return 'token %d: %s: %r, %s: %r' % (i, engines[0], a,
+                                                 engines[1], b)
+
+    return None
+
+
 if __name__ == '__main__':
     import sys
     lexer = create_lexer('<stdin>')
@@ -2,20 +2,21 @@
 import sys
 import os.path
 import argparse
+import copy
+import io
 import re
-import pkg_resources
-
-pkg_resources.require('ply')
-pkg_resources.require('llvmlite==0.34.*')
-
-import llvmlite.binding as llvm
 
+import cache
+import pch
 from util import LocationError, FatalError
-from parser import preprocess, parse
+from parser import preprocess, parse, get_default_parser
+from parser import engines as parser_engines, default_engine as default_parser_engine
+import lexer
+from lexer import create_lexer
 from desugar import Desugarer
 from context import ContextAnalysis
 from typecheck import TypeChecker
-from irgen import IRGen
+from semantic import SemanticAnalysis
 
 
 all_phases =[
@@ -23,6 +24,30 @@ all_phases =[
 ]
 
 
+# llvmlite and the IR generator are only needed for the last phase. Importing
+# them (and checking the llvmlite version with pkg_resources, which is slow to
+# import itself) takes a large part of the startup time, so it is postponed
+# until the first file reaches IR generation. This makes --dump-after for the
+# earlier phases start faster. See the import-time benchmark in bench.py.
+llvm = None
+IRGen = None
+
+
+def load_codegen():
+    global llvm, IRGen
+
+    if IRGen is None:
+        import pkg_resources
+        pkg_resources.require('llvmlite==0.34.*')
+
+        import llvmlite.binding as llvm
+        from irgen import IRGen
+
+
+class DumpedPhase(Exception):
+    pass
+
+
 def dump(args, prog, phase, print_if_verbose, width=80):
     if args.verbose:
         lfill = rfill = '-' * int((width - len(phase) - 2) / 2)
@@ -35,18 +60,45 @@ def dump(args, prog, phase, print_if_verbose, width=80):
 
     if args.dump_after == phase:
         print(prog)
-        sys.exit(0)
+        raise DumpedPhase()
+
+
+# --verify shallow only checks the program and its declarations, and none of
+# the nodes below those
+shallow_verify_depth = 1
+
+
+def verify(args, tree):
+    '''
+    Verify the AST after a phase, as far as the --verify level asks.
+    '''
+    if args.verify == 'full':
+        tree.verify()
+    elif args.verify == 'shallow':
+        tree.verify(shallow_verify_depth)
 
 
 def save_module(args, module):
-    mod = llvm.parse_assembly(str(module))
-    mod.verify()
+    '''
+    Write the IR of `module` to the output file, as text or as bitcode. The
+    module is formatted as text only once: LLVM parses the text only if the
+    module must be verified or converted to bitcode, and text output is the
+    formatted module itself rather than LLVM's reformatting of it. See the
+    ir-output benchmark in bench.py.
+    '''
+    text = str(module)
+
+    if args.verify_ir or args.emit_bc:
+        mod = llvm.parse_assembly(text)
+        if args.verify_ir:
+            mod.verify()
 
     if args.emit_bc:
-        with os.fdopen(args.outfile.fileno(), 'wb') as f:
-            f.write(mod.as_bitcode())
+        args.outfile.flush()
+        args.outfile.buffer.write(mod.as_bitcode())
     else:
-        args.outfile.write(str(mod))
+        args.outfile.write(text)
+        args.outfile.write('\n')
 
 
 def add_default_include_paths(args):
@@ -74,22 +126,32 @@ def fix_file_args(args):
             args.outfile = sys.stdout
             args.emit_ll = True
         else:
+            # write to a temporary file that is renamed when compilation
+            # succeeds, so that the output is never incomplete (`outname` is
+            # only set once the file exists, see `compile_file`)
             extension = '.bc' if args.emit_bc else '.ll'
-            args.outfile = open(infile_base(args) + extension, 'w')
+            outname = infile_base(args) + extension
+            args.outfile = open(cache.temp_name(outname), 'w')
+            args.outname = outname
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument('--no-cpp', dest='preprocess', action='store_false',
             help='do not run the preprocessor')
-    parser.add_argument('infile', nargs='?',
-            type=argparse.FileType('r'), default=sys.stdin,
-            help='input file to compile (default stdin)')
+    parser.add_argument('--external-cpp', action='store_true',
+            help='run the system\'s cpp instead of the built-in preprocessor')
+    parser.add_argument('--no-pch', dest='pch', action='store_false',
+            help='include .fh headers textually instead of using precompiled '
+                 'headers')
+    parser.add_argument('infiles', nargs='*', metavar='infile',
+            help='input files to compile, - for stdin (default stdin)')
     parser.add_argument('-v', '--verbose', action='store_true',
             help='enable all intermediate dumps and write IR to stdout')
     parser.add_argument('-o', '--outfile', metavar='FILE',
             type=argparse.FileType('w'), default=None,
-            help='output file (defaults to infile with .ll extension)')
+            help='output file (defaults to infile with .ll extension, only '
+                 'allowed with a single infile)')
     parser.add_argument('--emit-bc', action='store_true',
             help='write output as bitcode (produces .bc instead of .ll)')
     parser.add_argument('-d', '--dump-after', choices=all_phases,
@@ -97,43 +159,243 @@ if __name__ == '__main__':
     parser.add_argument('-I', metavar='PATH', dest='include_paths',
             action='append', default=[],
             help='add include path for preprocessor')
-    args = parser.parse_args()
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+            help='do not read or write the on-disk cache (see cache.py)')
+    parser.add_argument('--lexer', choices=lexer.engines,
+            default=lexer.default_engine,
+            help='tokenizer engine, scan is faster on large inputs (default '
+                 '%(default)s, see lexer.py)')
+    parser.add_argument('--parser', choices=parser_engines,
+            default=default_parser_engine,
+            help='parser engine, descent is faster on large inputs (default '
+                 '%(default)s, see descent.py)')
+    parser.add_argument('--flat-ast', action='store_true',
+            help='store the AST in flat arrays after parsing, which uses less '
+                 'memory for very large inputs (uses the descent parser, see '
+                 'arena.py)')
+    parser.add_argument('--fused-analysis', action='store_true',
+            help='desugar, resolve names and check types in a single '
+                 'traversal of the AST (see semantic.py)')
+    parser.add_argument('--verify', choices=('off', 'shallow', 'full'),
+            default='full',
+            help='how much of the AST to check for compiler bugs after each '
+                 'phase: nothing, only the declarations, or all nodes '
+                 '(default %(default)s)')
+    parser.add_argument('--no-verify-ir', dest='verify_ir',
+            action='store_false',
+            help='do not have LLVM verify the generated IR before writing it, '
+                 'which saves parsing it when writing text')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+            help='compile N input files in parallel, 0 means one per CPU '
+                 '(default 1)')
+    args = parser.parse_args(argv)
 
+    if len(args.infiles) > 1 and args.outfile:
+        parser.error('cannot specify -o with multiple input files')
+    if args.jobs < 0:
+        parser.error('number of jobs must be positive')
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    if args.jobs > 1 and '-' in args.infiles:
+        parser.error('cannot read from stdin with -j')
+
+    return args
+
+
+def compile_file(args):
+    '''
+    Compile `args.infile` according to the command-line arguments `args`.
+    Errors are raised as exceptions.
+    '''
     try:
         add_default_include_paths(args)
         fix_file_args(args)
-        origsrc = src = args.infile.read()
+        src = args.origsrc = args.infile.read()
+
+        # precompiled headers are left out of the preprocessed source, so do
+        # not use them when it is printed (see pch.py)
+        precompiled = None
+        if args.pch and not args.verbose and args.dump_after != 'preprocess':
+            precompiled = []
 
         if args.preprocess:
-            src = preprocess(args.infile.name, src, args.include_paths)
+            src = preprocess(args.infile.name, src, args.include_paths,
+                             args.external_cpp, precompiled)
             dump(args, src, 'preprocess', True)
 
-        tree = parse(args.infile.name, src)
-        dump(args, tree, 'parser', True)
-        tree.verify()
+        # the phases after parsing can only be printed separately when they
+        # are not fused
+        fused = args.fused_analysis and not args.verbose and \
+                args.dump_after not in ('desugar', 'context')
 
-        Desugarer().visit(tree)
-        dump(args, tree, 'desugar', True)
-        tree.verify()
+        # the flat AST is desugared while it is built, so the tree is only
+        # printed after desugaring
+        if args.flat_ast and not args.verbose and args.dump_after != 'parser':
+            import arena
+            tree = arena.parse(args.infile.name, src,
+                               pch.declarations(args.infile.name, precompiled),
+                               Desugarer().visit)
+        else:
+            tree = parse(args.infile.name, src, engine=args.parser)
+            pch.insert(tree, args.infile.name, precompiled)
+            dump(args, tree, 'parser', True)
+            verify(args, tree)
 
-        ContextAnalysis().visit(tree)
-        dump(args, tree, 'context', False)
-        tree.verify()
+            if not fused:
+                Desugarer().visit(tree)
+
+        if fused:
+            SemanticAnalysis().visit(tree)
+        else:
+            dump(args, tree, 'desugar', True)
+            verify(args, tree)
+
+            ContextAnalysis().visit(tree)
+            dump(args, tree, 'context', False)
+            verify(args, tree)
+
+            TypeChecker().visit(tree)
 
-        TypeChecker().visit(tree)
         dump(args, tree, 'typecheck', False)
-        tree.verify()
+        verify(args, tree)
 
+        load_codegen()
         module = IRGen(args.infile.name).visit(tree)
         dump(args, module, 'irgen', False)
         save_module(args, module)
 
-    except EOFError:
-        print('Syntax error: unexpected end of file', file=sys.stderr)
-        sys.exit(1)
-    except LocationError as e:
-        e.print(True, origsrc)
-        sys.exit(1)
-    except (IOError, FatalError) as e:
-        print('Error: %s' % e, file=sys.stderr)
-        sys.exit(1)
+        if args.outname:
+            args.outfile.close()
+            os.replace(args.outfile.name, args.outname)
+
+    except DumpedPhase:
+        pass
+    finally:
+        if args.infile not in (None, sys.stdin):
+            args.infile.close()
+        if args.outfile not in (None, sys.stdout):
+            args.outfile.close()
+            if args.outname and os.path.exists(args.outfile.name):
+                os.remove(args.outfile.name)
+
+
+def report_error(args, e, prefix=''):
+    if isinstance(e, EOFError):
+        print(prefix + 'Syntax error: unexpected end of file', file=sys.stderr)
+    elif isinstance(e, LocationError):
+        e.print(True, args.origsrc)
+    else:
+        print(prefix + 'Error: %s' % e, file=sys.stderr)
+
+
+def compile_and_report(args, fname, prefix):
+    '''
+    Compile a single input file `fname` and report any errors, returning True
+    if compilation succeeded.
+    '''
+    # per-file copy of the arguments, since compile_file fills in the
+    # input/output files and the include paths
+    args = copy.copy(args)
+    args.include_paths = list(args.include_paths)
+    args.infile = args.origsrc = args.outname = None
+
+    try:
+        args.infile = sys.stdin if fname == '-' else open(fname)
+        compile_file(args)
+        return True
+    except (EOFError, LocationError, IOError, FatalError) as e:
+        report_error(args, e, prefix)
+        return False
+
+
+#
+# Parallel compilation (-j). Input files are distributed over a pool of worker
+# processes, each of which builds the parser and lexer once when it starts.
+# Workers capture everything that the compiler writes to stdout and stderr and
+# send it back to the main process, which prints it in the order of the input
+# files so that the output does not depend on scheduling.
+#
+
+
+def init_worker(cache_enabled, engine):
+    # workers do not inherit the module-level settings of the main process
+    # when they are spawned rather than forked, so `main` passes them along
+    cache.enabled = cache_enabled
+    lexer.default_engine = engine
+    get_default_parser()
+    create_lexer('<init>')
+
+
+def compile_captured(args, fname, prefix):
+    stdout = io.TextIOWrapper(io.BytesIO(), write_through=True)
+    stderr = io.StringIO()
+    saved_streams = sys.stdout, sys.stderr
+
+    try:
+        sys.stdout, sys.stderr = stdout, stderr
+        success = compile_and_report(args, fname, prefix)
+    finally:
+        sys.stdout, sys.stderr = saved_streams
+
+    return success, stdout.buffer.getvalue(), stderr.getvalue()
+
+
+def compile_parallel(args, infiles, prefixes):
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(args.jobs, initializer=init_worker,
+                             initargs=(cache.enabled, args.lexer)) as pool:
+        futures = [pool.submit(compile_captured, args, fname, prefix)
+                   for fname, prefix in zip(infiles, prefixes)]
+
+        for future in futures:
+            success, out, err = future.result()
+            sys.stdout.flush()
+            sys.stdout.buffer.write(out)
+            sys.stdout.flush()
+            sys.stderr.write(err)
+            yield success
+
+
+def main(argv=None, prog=None):
+    '''
+    Run the compiler with command-line arguments `argv` (defaults to
+    `sys.argv`). Exits through `sys.exit` with status 0 if all input files
+    compiled successfully and 1 otherwise, just like when main.py is executed
+    directly, so that server.py can run it.
+
+    The parser and lexer are built once and reused for all input files (once
+    per worker process with -j). An error in one file is reported and does not
+    stop compilation of the remaining files.
+    '''
+    args = parse_args(argv, prog)
+
+    if not args.cache:
+        cache.enabled = False
+
+    lexer.default_engine = args.lexer
+
+    infiles = args.infiles or ['-']
+
+    # prefix errors without a location with the file name when compiling
+    # multiple files, so that it is clear where they belong
+    prefixes = [fname + ': ' if len(infiles) > 1 else '' for fname in infiles]
+
+    if args.jobs > 1 and len(infiles) > 1:
+        results = compile_parallel(args, infiles, prefixes)
+    else:
+        results = map(compile_and_report, [args] * len(infiles), infiles,
+                      prefixes)
+
+    failed = [fname for fname, success in zip(infiles, results)
+              if not success]
+
+    if len(infiles) > 1 and failed:
+        print('%d of %d files failed to compile: %s' %
+              (len(failed), len(infiles), ' '.join(failed)), file=sys.stderr)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
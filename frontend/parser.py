@@ -1,6 +1,10 @@
+import os
 import subprocess
+import ply
 import ply.yacc as yacc
 import ast
+import cache
+import preprocessor
 from lexer import tokens, create_lexer, token_error
 from util import LocationError, FatalError
 
@@ -35,14 +39,17 @@ def p_program(p):
     p[0] = ast.Program(p[1]).at(loc(p))
 
 
-# use left-recursion because we are building an LR(1) parser
+# use left-recursion because we are building an LR(1) parser, and append to
+# the list of the left-hand side in place rather than copying it so that
+# building a list of n elements takes O(n) time
 def p_declarations(p):
     '''declarations : declaration
                     | declarations declaration'''
     if len(p) == 2:
         p[0] = [p[1]]
     else:
-        p[0] = p[1] + [p[2]]
+        p[0] = p[1]
+        p[0].append(p[2])
 
 
 def p_declaration(p):
@@ -107,13 +114,18 @@ def p_params(p):
     if len(p) == 3:
         p[0] = [ast.Param(p[1], p[2]).at(loc(p, 2))]
     else:
-        p[0] = p[1] + [ast.Param(p[3], p[4]).at(loc(p, 4))]
+        p[0] = p[1]
+        p[0].append(ast.Param(p[3], p[4]).at(loc(p, 4)))
 
 
 def p_statements(p):
     '''statements : statement
                   | statements statement'''
-    p[0] = [p[1]] if len(p) == 2 else p[1] + [p[2]]
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[2])
 
 
 def p_block(p):
@@ -272,7 +284,11 @@ def p_funcall(p):
 def p_exprs(p):
     '''exprs : expr
              | exprs COMMA expr'''
-    p[0] = [p[1]] if len(p) == 2 else p[1] + [p[3]]
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[3])
 
 
 def p_boolconst(p):
@@ -302,11 +318,13 @@ def p_hexconst(p):
 
 def p_stringconst(p):
     '''expr : STRINGCONST'''
+    # the location starts at the opening quote, and spans the string as it is
+    # printed
     p[0] = ast.StringConst(p[1])
-    sloc = list(loc(p))
-    sloc[2] -= 1
-    sloc[4] = sloc[2] + len(str(p[0])) - 1
-    p[0].at(sloc)
+    source = p.parser.source
+    pos = p.lexpos(1) - 1
+    p[0].at(source.location(p.lexer.fname, source.start(p.lineno(1), pos),
+                            source.end(p.lineno(1), pos, len(str(p[0])))))
 
 
 def p_type(p):
@@ -316,7 +334,9 @@ def p_type(p):
         p.last_type_loc = loc(p)
         p[0] = ast.Type.get(p[1])
     else:
-        p.last_type_loc = p.last_type_loc[:3] + loc(p, 2)[3:]
+        p.last_type_loc = p.parser.source.location(p.lexer.fname,
+                ast.location_start(p.last_type_loc),
+                ast.location_end(loc(p, 2)))
         p[0] = ast.ArrayType.get(p[1])
 
 
@@ -332,16 +352,12 @@ def lhs(p):
 
 def loc(p, start=None, end=None):
     '''
-    pack the source location of production rule elements into a location tuple:
-    (filename, line_start, column_start, line_end, column_end).
-    `p` is the production rule, `start` and `end` are the indices in the rule
-    between which to span the source location.
+    pack the source location of production rule elements into a location:
+    (filename, line_start, column_start, line_end, column_end), in the packed
+    form of `ast.SourceMap` if possible. `p` is the production rule, `start`
+    and `end` are the indices in the rule between which to span the source
+    location.
     '''
-    def column(index):
-        pos = p.lexpos(index)
-        last_cr = max(p.parser.input.rfind('\n', 0, pos), 1)
-        return pos - last_cr
-
     def unpack(index, list_index):
         if index < 0:
             index += len(p)
@@ -368,41 +384,234 @@ def loc(p, start=None, end=None):
     start, pstart = unpack(start, 0)
     end, pend = unpack(end, -1)
 
+    source = p.parser.source
+
     if isinstance(pstart, ast.Node):
-        ystart, xstart  = pstart.location[1:3]
+        first = ast.location_start(pstart._location)
     else:
-        ystart = p.lineno(start)
-        xstart = column(start)
+        first = source.start(p.lineno(start), p.lexpos(start))
 
     if isinstance(pend, ast.Node):
-        yend, xend  = pend.location[3:]
+        last = ast.location_end(pend._location)
     else:
-        yend = p.linespan(end)[1]
-        xend = column(end) + len(pend) - 1
+        last = source.end(p.linespan(end)[1], p.lexpos(end), len(pend))
 
-    return p.lexer.fname, ystart, xstart, yend, xend
+    return source.location(p.lexer.fname, first, last)
+
+
+def grammar_digest():
+    '''
+    Hash everything the LALR tables are generated from: the token list, the
+    precedence table and the names and docstrings of all grammar rules. Any
+    change to the grammar produces a different hash and thus a different table
+    cache file.
+    '''
+    rules = sorted((f.__code__.co_firstlineno, name, f.__doc__)
+                   for name, f in globals().items()
+                   if name.startswith('p_') and callable(f))
+    parts = [ply.__version__, repr(tokens), repr(precedence)]
+    for line, name, doc in rules:
+        parts += [name, doc or '']
+    return cache.digest(*parts)
 
 
 def create_parser(**kwargs):
-    # disable parsetab.py creation because it seems to make things slower
-    parser = yacc.yacc(write_tables=False, **kwargs)
+    '''
+    Create a PLY parser, loading the LALR tables from the on-disk cache (see
+    cache.py) if possible. When the tables are not cached yet they are
+    generated and stored, so that subsequent compiler invocations can skip
+    table generation entirely.
+    '''
+    tabfile = cache.path('parsetab-%s.pickle' % grammar_digest())
+
+    # disable parsetab.py creation, we handle caching ourselves
+    if tabfile is None:
+        return yacc.yacc(write_tables=False, **kwargs)
+
+    if tables_readable(tabfile):
+        return yacc.yacc(picklefile=tabfile, **kwargs)
+
+    # PLY writes the generated tables to the pickle file, which is a temporary
+    # file here that is only renamed to the cache entry when it is complete
+    with cache.atomic(tabfile) as tmpname:
+        parser = yacc.yacc(picklefile=tmpname, **kwargs)
+
     return parser
 
 
-def parse(fname, src, debug=False, parser=None):
+def tables_readable(tabfile):
+    '''
+    Check that the cached tables in `tabfile` can be read, before passing the
+    file to PLY. When PLY cannot read its pickle file, or the tables were
+    generated from a different grammar, it regenerates them and rewrites the
+    file in place, so that parallel workers (see -j in main.py) could read a
+    half-written file. The grammar is already part of the file name, so only
+    unreadable (e.g., corrupt) files would be regenerated, and this checks for
+    those without writing anything.
+    '''
+    try:
+        yacc.LRTable().read_pickle(tabfile)
+        return True
+    except Exception:
+        return False
+
+
+# parser used by `parse` when the caller does not pass one, it is created on
+# first use and then kept for the lifetime of the process
+default_parser = None
+
+
+def get_default_parser():
+    global default_parser
+
+    if default_parser is None:
+        default_parser = create_parser(debug=False)
+    return default_parser
+
+
+# parser implementations that `parse` can use: the PLY parser generated from
+# the grammar rules above, or the hand-written parser in descent.py which
+# produces the same AST, see `compare_engines`
+engines = ('ply', 'descent')
+default_engine = 'ply'
+
+
+def parse(fname, src, debug=False, parser=None, engine=None):
     lexer = create_lexer(fname)
+    if (engine or default_engine) == 'descent':
+        import descent
+        try:
+            return descent.parse(lexer, src)
+        except RecursionError:
+            # nested too deeply for a recursive parser, PLY's parser has an
+            # explicit stack
+            lexer = create_lexer(fname)
     if parser is None:
-        parser = create_parser(debug=debug)
+        parser = create_parser(debug=debug) if debug else get_default_parser()
     parser.input = src
-    return parser.parse(src, lexer=lexer, debug=False)
+    parser.source = ast.SourceMap(src)
+    tree = parser.parse(src, lexer=lexer, debug=False)
+    tree.source = parser.source
+    return tree
+
+
+def compare_engines(fname, src):
+    '''
+    Parse `src` with both parser engines and return a description of the
+    first difference in the produced AST (including the locations of all
+    nodes) or in the raised syntax error, or None if they are identical.
+    '''
+    results = []
+
+    for engine in engines:
+        try:
+            tree = parse(fname, src, engine=engine)
+        except EOFError:
+            results.append([('EOFError',)])
+            continue
+        except (LocationError, NotImplementedError, AssertionError) as e:
+            results.append([(type(e).__name__, str(e),
+                             getattr(e, 'location', None))])
+            continue
+
+        # flatten the tree into a list with the type, location and non-node
+        # attributes of every node
+        nodes = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            attrs = []
+            for name, child in node.iter_children():
+                children = child if isinstance(child, list) else [child]
+                if all(isinstance(c, ast.Node) for c in children):
+                    stack.extend(reversed(children))
+                    attrs.append(name)
+                else:
+                    attrs.append((name, str(child)))
+            nodes.append((type(node).__name__, node.location, attrs))
+        results.append(nodes)
+
+    for i, (a, b) in enumerate(zip(*results)):
+        if a != b:
+            return 'node %d: %s: %r, %s: %r' % (i, engines[0], a,
+                                                engines[1], b)
+
+    if len(results[0]) != len(results[1]):
+        return 'different number of nodes'
+
+    return None
+
+
+def preprocess(fname, src, include_paths=[], use_cpp=False, precompiled=None):
+    '''
+    Run the C preprocessor on `src`, the contents of file `fname` (read from
+    the file if `src` is None). The built-in preprocessor in preprocessor.py is
+    used unless `use_cpp` is set or the source uses unsupported features, in
+    which case the system's cpp is run in a subprocess.
+
+    If `precompiled` is a list, precompiled headers are used where possible
+    and added to the list, the caller must insert their declarations into the
+    parsed program with `pch.insert`.
+
+    The result is cached (see ppcache.py) unless caching is disabled or the
+    source has no preprocessor directives at all.
+    '''
+    if src is None:
+        with open(fname) as f:
+            src = f.read()
+
+    if not preprocessor.has_directives(src):
+        entry = None
+    else:
+        import ppcache
+        entry = ppcache.entry_path(fname, src, include_paths, use_cpp,
+                                   precompiled is not None)
+
+    if entry is None:
+        return run_preprocessor(fname, src, include_paths, use_cpp,
+                                precompiled)
+
+    text = ppcache.lookup(entry, precompiled)
+
+    if text is None:
+        dependencies = {}
+        text = run_preprocessor(fname, src, include_paths, use_cpp,
+                                precompiled, dependencies)
+        ppcache.store(entry, text, dependencies, precompiled)
 
+    return text
 
-def preprocess(fname, src, include_paths=[]):
+
+def run_preprocessor(fname, src, include_paths=[], use_cpp=False,
+                     precompiled=None, dependencies=None):
+    if not use_cpp:
+        try:
+            return preprocessor.preprocess(fname, src, include_paths,
+                                           precompiled, dependencies)
+        except preprocessor.Unsupported:
+            if precompiled:
+                del precompiled[:]
+
+    return run_cpp(fname, src, include_paths, dependencies)
+
+
+def run_cpp(fname, src, include_paths=[], dependencies=None):
+    '''
+    Run the system's cpp on `src`. If `dependencies` is a dictionary, the
+    paths of all included files are added to it, mapped to their raw contents,
+    along with paths where included files may have been searched for, mapped
+    to None (see `add_searched_paths`).
+    '''
     args = ['cpp', '-nostdinc', '-C', '-traditional-cpp']
 
     for path in include_paths:
         args.append('-I' + path)
 
+    if dependencies is not None:
+        depfile = cache.temp_name(cache.path('preprocess.d'))
+        args += ['-MD', '-MF', depfile]
+        rule = None
+
     if fname == '<stdin>':
         src = bytearray(src, 'utf-8')
     else:
@@ -412,9 +621,55 @@ def preprocess(fname, src, include_paths=[]):
     try:
         proc = subprocess.run(args, input=src, stdout=subprocess.PIPE)
         proc.check_returncode()
-        return proc.stdout.decode()
     except subprocess.CalledProcessError as e:
         raise FatalError('preprocessor failed with nonzero exit code')
+    finally:
+        if dependencies is not None and os.path.exists(depfile):
+            with open(depfile) as f:
+                rule = f.read()
+            os.remove(depfile)
+
+    if dependencies is not None:
+        if rule is None:
+            raise FatalError('preprocessor did not write a dependency file')
+
+        # make rule "target: source include1 include2 ..."
+        for path in rule.replace('\\\n', ' ').split(':', 1)[1].split():
+            if path != fname:
+                with open(path, 'rb') as f:
+                    dependencies[path] = f.read()
+
+        add_searched_paths(fname, include_paths, dependencies)
+
+    return proc.stdout.decode()
+
+
+def add_searched_paths(fname, include_paths, dependencies):
+    '''
+    Unlike the built-in preprocessor, cpp does not report the paths at which
+    it searched for included files without finding them. A file created at
+    one of those paths later would be included instead, so add every path at
+    which any of the included files could have been searched for to
+    `dependencies`, mapped to None, if nothing exists there now. These are the
+    names of the included files relative to each directory in which they can
+    be searched for (the include paths, and the directories of the source file
+    and of the included files for quoted includes), in each such directory.
+    '''
+    dirs = [os.path.dirname(fname) or '.'] + list(include_paths) + \
+           [os.path.dirname(path) or '.' for path in dependencies]
+    names = set()
+
+    for path in dependencies:
+        for dirname in dirs:
+            name = os.path.relpath(path, dirname)
+            if not name.startswith(os.pardir):
+                names.add(name)
+
+    for dirname in dirs:
+        for name in names:
+            path = os.path.join(dirname, name)
+            if path not in dependencies and not os.path.exists(path):
+                dependencies[path] = None
 
 
 if __name__ == '__main__':
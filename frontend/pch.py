@@ -0,0 +1,186 @@
+import os
+import pickle
+import cache
+import ast
+from lexer import lexer_digest
+from parser import grammar_digest, parse
+from util import LocationError, FatalError
+
+
+#
+# Precompiled headers. Most FenneC programs start by including the same .fh
+# headers with extern declarations (e.g., runtime/cstdlib.fh), which are then
+# lexed and parsed again for every compiled file. Instead, the preprocessor
+# (see `Preprocessor.include` in preprocessor.py) can leave out a header and
+# have its declarations parsed once, pickled, and spliced into the AST of the
+# including program after parsing (see `compile_file` in main.py).
+#
+# This is only done when the result is identical to textual inclusion: the
+# header must contain nothing but `FunDec` and `GlobalDec` declarations and no
+# preprocessor directives, and it must be included directly by the compiled
+# file before any code, so that its declarations end up at the start of the
+# program. The declarations keep the source locations in the header, with one
+# exception that `insert` takes care of: the parser reduces the last
+# declaration of a header after reading the next token, so that its location
+# has the file name of whatever follows the header (the next precompiled
+# header or the compiled file).
+#
+# A precompiled header is stored in the compiler's cache directory (see
+# cache.py), as pch-<header>.<hash>.pch, where the hash covers the header
+# contents, the path through which it was included (which ends up in
+# locations), and the lexer, grammar and AST definitions. Every edit of a
+# header produces a new file, so like the preprocessor cache (see ppcache.py),
+# the least recently used ones are removed when their total size exceeds
+# FENNEC_PCH_CACHE_MB megabytes (8 by default).
+#
+
+
+max_size = int(os.getenv('FENNEC_PCH_CACHE_MB') or 8) * 1024 * 1024
+prefix = 'pch-'
+
+
+# pickled declarations of precompiled headers by hash, or None for headers
+# that cannot be precompiled
+loaded = {}
+
+format_hash = None
+
+# file name of the code following a header while precompiling, which `insert`
+# replaces with the actual file name
+next_file = '<next>'
+
+
+def header_digest(header, src):
+    global format_hash
+
+    if format_hash is None:
+        with open(ast.__file__) as f:
+            format_hash = cache.digest(lexer_digest(), grammar_digest(),
+                                       f.read())
+
+    return cache.digest(header, src, format_hash)
+
+
+def pch_path(header, digest):
+    return cache.path('%s%s.%s.pch' % (prefix, os.path.basename(header),
+                                       digest))
+
+
+def precompile(header, src):
+    '''
+    Parse the header `header` with contents `src` and return its pickled
+    declarations, or None if it cannot be precompiled.
+    '''
+    try:
+        tree = parse(header, '# 1 "%s"\n%s\n# 1 "%s"\n' %
+                     (header, src, next_file))
+    except (EOFError, LocationError, FatalError):
+        # leave the error message to textual inclusion
+        return None
+
+    for decl in tree.decls:
+        if not isinstance(decl, (ast.FunDec, ast.GlobalDec)):
+            return None
+
+    return pickle.dumps(tree.decls, pickle.HIGHEST_PROTOCOL)
+
+
+def read(filename):
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        pickle.loads(data)
+        return data
+    except Exception:
+        # treat a corrupt file as a missing one
+        return None
+
+
+def write(filename, data):
+    with cache.atomic(filename) as tmpname:
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+
+    cache.evict(prefix, max_size)
+
+
+def load(header, src):
+    '''
+    Return the declarations in header file `header` with contents `src`, or
+    None if the header cannot be precompiled. A fresh copy of the declarations
+    is returned on each call, since later compiler phases modify them.
+    '''
+    digest = header_digest(header, src)
+
+    if digest not in loaded:
+        filename = pch_path(header, digest) if cache.enabled else None
+        data = read(filename) if filename and os.path.exists(filename) \
+               else None
+
+        if data is None:
+            data = precompile(header, src)
+            if data is not None and filename:
+                write(filename, data)
+        else:
+            cache.touch(filename)
+
+        loaded[digest] = data
+
+    data = loaded[digest]
+    return None if data is None else pickle.loads(data)
+
+
+def fix_locations(node, fname):
+    if node.location[0] == next_file:
+        node.location = (fname,) + node.location[1:]
+
+    for name, child in node.iter_children():
+        for c in child if isinstance(child, list) else [child]:
+            if isinstance(c, ast.Node):
+                fix_locations(c, fname)
+
+
+def declarations(fname, precompiled):
+    '''
+    Return the declarations of precompiled headers that are included by file
+    `fname`, with their locations fixed. `precompiled` is a list of (header,
+    declarations) pairs as produced by the preprocessor, or None.
+    '''
+    decls = []
+    following = [header for header, hdecls in (precompiled or [])[1:]] + \
+                [fname]
+
+    for (header, hdecls), next_fname in zip(precompiled or [], following):
+        for decl in hdecls:
+            fix_locations(decl, next_fname)
+        decls += hdecls
+
+    return decls
+
+
+def insert(tree, fname, precompiled):
+    '''
+    Insert the declarations of precompiled headers at the start of the parsed
+    program `tree` from file `fname`, with the same result as if the headers
+    had been included textually. `precompiled` is a list of (header,
+    declarations) pairs as produced by the preprocessor.
+    '''
+    if not precompiled:
+        return
+
+    prepend(tree, declarations(fname, precompiled))
+
+
+def prepend(tree, decls):
+    '''
+    Insert declarations `decls` at the start of program `tree`, and make the
+    location of the program start where the first of them starts.
+    '''
+    if not decls:
+        return
+
+    tree.decls[0:0] = decls
+
+    # the location of a program starts at its first declaration
+    tree.location = tree.location[:1] + decls[0].location[1:3] + \
+                    tree.location[3:]
@@ -0,0 +1,118 @@
+import os
+import pickle
+import cache
+import preprocessor
+
+
+#
+# Cache for preprocessed sources, used by `parser.preprocess`. Compiling the
+# same file again (e.g., when running the tests) should not preprocess it
+# again if neither the file itself nor any of the files it includes changed.
+#
+# An entry is looked up by a hash of the source file's name and contents, the
+# include paths, the working directory and the preprocessor options. It stores
+# the preprocessed source together with the paths and content hashes of all
+# files that were included while preprocessing, and the paths at which
+# included files were searched for but not found (so that a new file that
+# would now be included instead also invalidates the entry). An entry is only
+# used if all of these still match. Contents are hashed as raw bytes, both when
+# storing and when checking an entry, so that files with CRLF line endings
+# (which reading in text mode would translate) match as well.
+#
+# Entries are stored as preprocess-<hash>.pickle in the cache directory (see
+# cache.py). When their total size exceeds FENNEC_PREPROCESS_CACHE_MB megabytes
+# (32 by default), the least recently used entries are removed.
+#
+
+
+max_size = int(os.getenv('FENNEC_PREPROCESS_CACHE_MB') or 32) * 1024 * 1024
+prefix = 'preprocess-'
+
+version = None
+
+
+def entry_path(fname, src, include_paths, use_cpp, use_pch):
+    '''
+    Return the path of the cache entry for preprocessing file `fname` with
+    contents `src`, or None if caching is disabled.
+    '''
+    global version
+
+    if version is None:
+        with open(preprocessor.__file__) as f:
+            version = cache.digest(f.read())
+
+    key = cache.digest(version, os.getcwd(), fname, src,
+                       '\n'.join(include_paths), str(use_cpp), str(use_pch))
+    return cache.path(prefix + key + '.pickle')
+
+
+def content_digest(path):
+    '''
+    Return the hash of the contents of file `path`, or None if it does not
+    exist.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return cache.digest(f.read())
+    except OSError:
+        return None
+
+
+def lookup(filename, precompiled=None):
+    '''
+    Return the preprocessed source stored in cache entry `filename`, or None
+    if there is no valid entry. Precompiled headers are added to the
+    `precompiled` list as with `parser.preprocess`.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            text, dependencies, headers = pickle.load(f)
+    except Exception:
+        # treat a corrupt entry as a missing one
+        return None
+
+    for path, digest in dependencies:
+        if content_digest(path) != digest:
+            return None
+
+    if headers and precompiled is None:
+        return None
+
+    if headers:
+        import pch
+
+        for header in headers:
+            try:
+                with open(header) as f:
+                    decls = pch.load(header, f.read())
+            except OSError:
+                decls = None
+
+            if decls is None:
+                del precompiled[:]
+                return None
+
+            precompiled.append((header, decls))
+
+    cache.touch(filename)
+    return text
+
+
+def store(filename, text, dependencies, precompiled=None):
+    '''
+    Store preprocessed source `text` in cache entry `filename`, along with the
+    `dependencies` dictionary of raw file contents filled in by the
+    preprocessor (see `preprocessor.preprocess` and `parser.run_cpp`) and the
+    precompiled headers that were used.
+    '''
+    dependencies = [(path, None if data is None else cache.digest(data))
+                    for path, data in sorted(dependencies.items())]
+    headers = [header for header, decls in precompiled or []]
+
+    with cache.atomic(filename) as tmpname:
+        with open(tmpname, 'wb') as f:
+            pickle.dump((text, dependencies, headers), f,
+                        pickle.HIGHEST_PROTOCOL)
+
+    cache.evict(prefix, max_size)
@@ -0,0 +1,411 @@
+import io
+import os
+import re
+
+
+#
+# In-process C preprocessor. Running `cpp` in a subprocess for every compiled
+# file is expensive compared to compiling a small FenneC program, so this module
+# implements the subset of the preprocessor that FenneC programs use:
+#
+#   #include "file" / #include <file>  (searching the -I include paths)
+#   #define NAME body / #define NAME(params) body / #undef NAME
+#   #ifdef NAME / #ifndef NAME / #else / #endif
+#
+# It mimics `cpp -nostdinc -C -traditional-cpp`: directives must start in the
+# first column, comments are kept, and macro arguments are substituted as text
+# (also inside string literals in the macro body). Like cpp, the output starts
+# with a line marker for the source file and contains line markers around the
+# contents of included files, which the lexer uses to track source locations
+# (see `t_cpp_line_marker` in lexer.py). Directives and lines excluded by
+# conditionals are replaced with empty lines, so that the line numbers of the
+# remaining lines do not change.
+#
+# Optionally, .fh headers can be replaced by precompiled declarations instead
+# of being included textually, see pch.py.
+#
+# Anything outside this subset (other directives, macro invocations spanning
+# multiple lines, errors such as a missing include file) raises `Unsupported`,
+# in which case `parser.preprocess` falls back to running cpp, which then also
+# produces the appropriate error messages.
+#
+
+
+class Unsupported(Exception):
+    pass
+
+
+class PrecompiledHeadersUnusable(Exception):
+    pass
+
+
+# lines starting with '#'; if a source file has none, there is nothing to do
+directive_line = re.compile(r'^#', re.M)
+
+directive = re.compile(r'#\s*(\w*)\s*(.*?)\s*$')
+include_arg = re.compile(r'"([^"]+)"$|<([^>]+)>$')
+define_arg = re.compile(r'([A-Za-z_]\w*)(?:\(([^)]*)\))?\s*(.*)$', re.S)
+identifier = re.compile(r'[A-Za-z_]\w*$')
+identifier_anywhere = re.compile(r'[A-Za-z_]\w*')
+trailing_identifier = re.compile(r'([A-Za-z_]\w*)\s*$')
+
+# text is scanned as a sequence of tokens that may contain macro names,
+# skipping over string/char literals and comments like traditional cpp does
+# (note that it does not know about // comments)
+token = re.compile(r'''
+    (?P<string> "(?:\\.|[^"\\\n])*"? | '(?:\\.|[^'\\\n])*'? )
+  | (?P<comment> /\*.*?\*/ )
+  | (?P<open_comment> /\* )
+  | (?P<name> [A-Za-z_]\w* )
+''', re.S | re.X)
+comment_end = re.compile(r'.*?\*/', re.S)
+single_line_comment = re.compile(r'/\*.*?\*/')
+any_comment = re.compile(r'/\*.*?\*/|/\*.*')
+
+max_include_depth = 200
+
+
+def has_directives(src):
+    return directive_line.search(src) is not None
+
+
+def has_code(line, in_comment):
+    '''
+    Return whether `line` contains anything other than whitespace and comments.
+    '''
+    if in_comment:
+        m = comment_end.match(line)
+        if not m:
+            return False
+        line = line[m.end():]
+
+    return bool(any_comment.sub('', line).strip())
+
+
+def preprocess(fname, src, include_paths=[], precompiled=None,
+               dependencies=None):
+    '''
+    Preprocess the source `src` of the file `fname`. Raises `Unsupported` if
+    the source uses preprocessor features that are not implemented here.
+
+    If `precompiled` is a list, headers that are not included textually
+    because they are precompiled are appended to it as (header, declarations)
+    pairs, see `pch.insert`.
+
+    If `dependencies` is a dictionary, it is filled with the paths of all
+    included files mapped to their raw contents (bytes, as hashed by
+    `ppcache.content_digest`), and the paths that were searched for included
+    files but do not exist mapped to None.
+    '''
+    marker = '# 1 "%s"\n' % fname
+
+    if not has_directives(src):
+        return marker + src
+
+    try:
+        pp = Preprocessor(include_paths, precompiled, dependencies)
+        return marker + pp.process(fname, src)
+    except PrecompiledHeadersUnusable:
+        del precompiled[:]
+        pp = Preprocessor(include_paths, None, dependencies)
+        return marker + pp.process(fname, src)
+
+
+class Preprocessor:
+    def __init__(self, include_paths, precompiled=None, dependencies=None):
+        self.include_paths = include_paths
+        self.macros = {}  # name -> (list of parameter names or None, body)
+        self.depth = 0
+        self.dependencies = {} if dependencies is None else dependencies
+
+        # precompiled headers can only be used as long as the output of the
+        # compiled file does not contain anything yet
+        self.precompiled = precompiled
+        self.code_seen = False
+
+    def process(self, fname, src):
+        out = []
+        in_comment = False
+
+        # stack with an (active, in_else) pair for each enclosing #ifdef or
+        # #ifndef: whether lines outside the conditional are included, and
+        # whether #else was seen
+        conditions = []
+        active = True
+
+        lines = src.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+
+        for lineno, line in enumerate(lines, 1):
+            if in_comment or not line.startswith('#'):
+                if not active:
+                    out.append('')
+                    in_comment = self.skip_comments(line, in_comment)
+                else:
+                    if not self.code_seen and self.depth == 0:
+                        self.code_seen = has_code(line, in_comment)
+                    text, in_comment = self.expand_line(line, in_comment)
+                    out.append(text)
+                continue
+
+            m = directive.match(line)
+            name, arg = m.groups()
+
+            if '/*' in arg:
+                # strip comments, the closing */ must be on the same line
+                arg = single_line_comment.sub(' ', arg).strip()
+                if '/*' in arg:
+                    raise Unsupported('comment spanning directive')
+
+            if name in ('ifdef', 'ifndef'):
+                if not identifier.match(arg):
+                    raise Unsupported('#%s %s' % (name, arg))
+                conditions.append((active, False))
+                active = active and (arg in self.macros) == (name == 'ifdef')
+            elif name == 'else':
+                if not conditions or conditions[-1][1] or arg:
+                    raise Unsupported('#else')
+                parent_active = conditions[-1][0]
+                conditions[-1] = parent_active, True
+                active = parent_active and not active
+            elif name == 'endif':
+                if not conditions or arg:
+                    raise Unsupported('#endif')
+                active = conditions.pop()[0]
+            elif name == '' and not arg:
+                pass  # null directive
+            elif not active:
+                if name not in ('include', 'define', 'undef'):
+                    raise Unsupported('#' + name)
+            elif name == 'include':
+                text = self.include(fname, arg)
+                if text is not None:
+                    out.append(text)
+                    out.append('# %d "%s" 2' % (lineno + 1, fname))
+                    continue
+            elif name == 'define':
+                self.define(arg)
+            elif name == 'undef':
+                if not identifier.match(arg):
+                    raise Unsupported('#undef ' + arg)
+                self.macros.pop(arg, None)
+            else:
+                raise Unsupported('#' + name)
+
+            out.append('')
+
+        if conditions:
+            raise Unsupported('unterminated conditional')
+
+        if self.depth == 0 and self.precompiled and not self.code_seen:
+            # the parser does not accept a program without declarations
+            raise PrecompiledHeadersUnusable()
+
+        return '\n'.join(out) + '\n'
+
+    def include(self, fname, arg):
+        '''
+        Return the preprocessed contents of the file included by `#include
+        arg`, or None if it is replaced by precompiled declarations.
+        '''
+        m = include_arg.match(arg)
+        if not m:
+            raise Unsupported('#include ' + arg)
+
+        quoted, angled = m.groups()
+        dirs = list(self.include_paths)
+        if quoted:
+            dirs.insert(0, os.path.dirname(fname))
+
+        for dirname in dirs:
+            path = os.path.join(dirname, quoted or angled)
+            if os.path.isfile(path):
+                break
+            self.dependencies[path] = None
+        else:
+            raise Unsupported('include file not found: ' + arg)
+
+        if self.depth == max_include_depth:
+            raise Unsupported('#include nested too deeply')
+
+        # read the raw bytes for the dependencies and decode them like
+        # `open(path).read()` would, translating newlines
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            src = io.TextIOWrapper(io.BytesIO(data)).read()
+        except (OSError, UnicodeDecodeError):
+            raise Unsupported('cannot read ' + path)
+
+        self.dependencies[path] = data
+
+        if self.precompiled is not None and self.depth == 0 and \
+                not self.code_seen and not self.macros and \
+                path.endswith('.fh') and not has_directives(src):
+            import pch
+            decls = pch.load(path, src)
+            if decls is not None:
+                self.precompiled.append((path, decls))
+                return None
+
+        if self.depth == 0:
+            # the location of the last declaration in a precompiled header
+            # depends on the first token after it (see `pch.insert`), which
+            # must be in the compiled file itself
+            if self.precompiled and not self.code_seen:
+                raise PrecompiledHeadersUnusable()
+
+            # anything after textually included code cannot be precompiled
+            self.code_seen = True
+
+        self.depth += 1
+        text = self.process(path, src)
+        self.depth -= 1
+
+        text = text.rstrip('\n')
+        return '# 1 "%s" 1' % path + ('\n' + text if text else '')
+
+    def define(self, arg):
+        m = define_arg.match(arg)
+        if not m:
+            raise Unsupported('#define ' + arg)
+
+        name, params, body = m.groups()
+
+        if params is not None:
+            params = [p.strip() for p in params.split(',')]
+            if params == ['']:
+                params = []
+            if not all(identifier.match(p) for p in params):
+                raise Unsupported('#define ' + arg)
+
+        self.macros[name] = params, body
+
+    def skip_comments(self, line, in_comment):
+        '''
+        Return whether `line` ends inside a comment, given whether it starts
+        inside one.
+        '''
+        if not in_comment and '/*' not in line:
+            return False
+
+        return self.expand(line, in_comment, None)[1]
+
+    def expand_line(self, line, in_comment):
+        if not self.macros and not in_comment and '/*' not in line:
+            return line, False
+
+        return self.expand(line, in_comment, frozenset())
+
+    def expand(self, text, in_comment, disabled):
+        '''
+        Expand the macros in `text`, except those in `disabled` (which are
+        being expanded already), or none if `disabled` is None. Returns the
+        expanded text and whether `text` ends inside a comment.
+        '''
+        out = []
+        pos = scanpos = 0
+
+        if in_comment:
+            m = comment_end.match(text)
+            if not m:
+                return text, True
+            scanpos = m.end()
+
+        while True:
+            m = token.search(text, scanpos)
+            if not m:
+                break
+            scanpos = m.end()
+
+            if m.lastgroup == 'open_comment':
+                out.append(text[pos:])
+                return ''.join(out), True
+
+            name = m.group('name')
+            if disabled is None or name not in self.macros or \
+                    name in disabled:
+                continue
+
+            params, body = self.macros[name]
+
+            if params is not None:
+                args, end = self.collect_args(text, m.end())
+                if args is None:
+                    continue
+
+                if len(args) != max(len(params), 1) or \
+                        (not params and args[0].strip()):
+                    raise Unsupported('wrong number of arguments for ' + name)
+
+                # arguments are expanded before they are substituted, and like
+                # traditional cpp we also substitute inside strings
+                args = [self.expand(arg, False, disabled)[0] for arg in args]
+                replacements = dict(zip(params, args))
+                body = identifier_anywhere.sub(lambda m: replacements.get(
+                    m.group(), m.group()), body)
+                scanpos = end
+
+            expansion, in_comment = self.expand(body, False, disabled | {name})
+            if in_comment:
+                raise Unsupported('unterminated comment in macro ' + name)
+
+            # an expansion ending with a function-like macro name could be
+            # invoked with arguments that follow the original invocation
+            last = trailing_identifier.search(expansion)
+            if last and self.macros.get(last.group(1), (None,))[0] is not None:
+                raise Unsupported('macro %s expands to macro call' % name)
+
+            out.append(text[pos:m.start()])
+            out.append(expansion)
+            pos = scanpos
+
+        out.append(text[pos:])
+        return ''.join(out), False
+
+    def collect_args(self, text, pos):
+        '''
+        Split the arguments of a function-like macro invocation starting at
+        `text[pos]`. Returns (None, pos) if the name is not followed by an
+        opening parenthesis.
+        '''
+        start = pos
+        while pos < len(text) and text[pos] in ' \t':
+            pos += 1
+
+        if pos == len(text):
+            # the invocation may continue on the next line
+            raise Unsupported('macro invocation spanning lines')
+        if text[pos] != '(':
+            return None, start
+
+        args = []
+        depth = 0
+        argstart = pos + 1
+        pos += 1
+
+        while pos < len(text):
+            c = text[pos]
+
+            if c in '"\'/':
+                m = token.match(text, pos)
+                if m and m.lastgroup in ('string', 'comment'):
+                    pos = m.end()
+                    continue
+                if m and m.lastgroup == 'open_comment':
+                    break
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                if depth == 0:
+                    args.append(text[argstart:pos])
+                    return args, pos + 1
+                depth -= 1
+            elif c == ',' and depth == 0:
+                args.append(text[argstart:pos])
+                argstart = pos + 1
+
+            pos += 1
+
+        raise Unsupported('macro invocation spanning lines')
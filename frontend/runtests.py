@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import sys
 import os
+import re
 import glob
+import time
+import pickle
 import traceback
 import subprocess
 import pkg_resources
@@ -10,10 +13,15 @@ import llvmlite.binding as llvm
 from termcolor import colored
 
 from util import LocationError, FatalError
+import parser as fennec_parser
 from parser import preprocess, create_parser, parse
+import lexer
+import pch
+import arena
 from desugar import Desugarer
 from context import ContextAnalysis
 from typecheck import TypeChecker
+from semantic import SemanticAnalysis
 from irgen import IRGen
 from ast import ASTError
 from main import all_phases
@@ -26,6 +34,19 @@ tests_dir = 'test'
 fennec_ext = '.fc'
 alignment = 60
 
+# scaling tests repeat the marked part of a program this many times, and fail
+# if the time per repetition grows by more than the tolerance factor; each size
+# is compiled several times and the best time counts, so that a busy machine
+# does not make the test fail
+repeat_marker = re.compile(r'/\* repeat \*/(.*?)/\* end repeat \*/', re.S)
+scaling_sizes = (4000, 32000)
+scaling_repeats = 3
+scaling_tolerance = 2.0
+
+# deep tests repeat the marked parts of a program this many times to build
+# deeply nested ASTs, which all phases must handle without recursing as deep
+deep_repetitions = 100000
+
 root_path = os.path.dirname(os.path.abspath(__file__))
 tests_path = root_path + '/' + tests_dir
 parser = create_parser(debug=True)
@@ -41,12 +62,13 @@ class TestCase:
         self.basename = basename
         self.ferr = StringIO()
         self.generated_files = []
+        self.engine_mismatch = False
 
     def run(self):
         showpath = self.path + ':'
         sys.stdout.write('%%-%ds' % alignment % showpath)
 
-        if self.test_autodetect():
+        if self.test_autodetect() and not self.engine_mismatch:
             print(colored('ok', 'green', attrs=['bold']))
             self.cleanup()
             return True
@@ -64,6 +86,10 @@ class TestCase:
 
         if self.test_type == 'dump':
             return self.test_dump()
+        if self.test_type == 'scaling':
+            return self.test_scaling()
+        if self.test_type == 'deep':
+            return self.test_deep()
         if self.test_type == 'run':
             try:
                 return self.test_run()
@@ -92,6 +118,81 @@ class TestCase:
         expectfile = self.path.replace(fennec_ext, '-expect' + fennec_ext)
         return self.assert_equal(got + '\n', expectfile)
 
+    def test_scaling(self):
+        if self.phase != 'parser':
+            raise FatalError('scaling test in phase %s is not supported' %
+                             self.phase)
+
+        with open(self.path) as f:
+            src = f.read()
+
+        m = repeat_marker.search(src)
+        if not m:
+            raise FatalError('no /* repeat */ ... /* end repeat */ in ' +
+                             self.path)
+
+        times = []
+
+        for n in scaling_sizes:
+            prog = src[:m.start()] + m.group(1) * n + src[m.end():]
+            best = None
+
+            for i in range(scaling_repeats):
+                start = time.perf_counter()
+                if self.compile_fennec(self.path, self.phase, prog) is None:
+                    return False
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            times.append(best / n)
+
+        if times[-1] > scaling_tolerance * times[0]:
+            self.ferr.write('time per repetition grows from %.1f us (%d '
+                            'repetitions) to %.1f us (%d repetitions)\n' %
+                            (times[0] * 1e6, scaling_sizes[0],
+                             times[-1] * 1e6, scaling_sizes[-1]))
+            return False
+
+        return True
+
+    def check_flat(self, flat, basename, ir):
+        ContextAnalysis().visit(flat)
+        TypeChecker().visit(flat)
+        if str(IRGen(basename).visit(flat)) != ir:
+            print('Error: flat AST produces different IR', file=self.ferr)
+            self.engine_mismatch = True
+
+    def fused_analysis(self, tree):
+        '''
+        Run the fused semantic analysis on a copy of parsed `tree`, and return
+        the printed AST or error message to compare with the separate phases.
+        '''
+        tree = pickle.loads(pickle.dumps(tree))
+
+        try:
+            SemanticAnalysis().visit(tree)
+            return str(tree)
+        except LocationError as e:
+            return error_message(e)
+        except Exception as e:
+            return 'crashed with %s' % e.__class__.__name__
+
+    def check_fused(self, fused, result):
+        if fused != result:
+            print('Error: fused semantic analysis differs', file=self.ferr)
+            self.engine_mismatch = True
+
+    def test_deep(self):
+        with open(self.path) as f:
+            src = f.read()
+
+        if not repeat_marker.search(src):
+            raise FatalError('no /* repeat */ ... /* end repeat */ in ' +
+                             self.path)
+
+        prog = repeat_marker.sub(lambda m: m.group(1) * deep_repetitions, src)
+        return self.compile_fennec(self.path, self.phase, prog) is not None
+
     def test_run(self):
         if phase != 'irgen':
             raise FatalError('run test in phase %s makes no sense' % phase)
@@ -139,26 +240,57 @@ class TestCase:
         self.ferr.write(res.stdout.decode('ascii'))
         return res.returncode == 0
 
-    def compile_fennec(self, fcpath, stop_after=None):
+    def compile_fennec(self, fcpath, stop_after=None, origsrc=None):
+        fused = None
+
         try:
-            with open(fcpath) as f:
-                origsrc = f.read()
+            if origsrc is None:
+                with open(fcpath) as f:
+                    origsrc = f.read()
 
             include_paths = [tests_path, os.path.dirname(fcpath)]
-            src = preprocess(fcpath, None, include_paths)
+            precompiled = [] if stop_after != 'preprocess' else None
+            src = preprocess(fcpath, origsrc, include_paths,
+                             precompiled=precompiled)
             if stop_after == 'preprocess':
                 return src
 
+            # both lexer engines must produce the same tokens for every test
+            # (see `ScanLexer` in lexer.py), and both parser engines the same
+            # AST or syntax error (see descent.py)
+            if self.test_type not in ('scaling', 'deep'):
+                for module in (lexer, fennec_parser):
+                    mismatch = module.compare_engines(fcpath, src)
+                    if mismatch:
+                        print('Error: %s engines differ at %s' %
+                              (module.__name__, mismatch), file=self.ferr)
+                        self.engine_mismatch = True
+
             tree = parse(fcpath, src, parser=parser)
+            pch.insert(tree, fcpath, precompiled)
             tree.verify()
             if stop_after == 'parser':
                 return tree
 
+            # the fused semantic analysis must produce the same AST or error
+            # as the separate phases (see semantic.py)
+            if self.phase in ('typecheck', 'irgen') and \
+                    self.test_type not in ('scaling', 'deep'):
+                fused = self.fused_analysis(tree)
+
             Desugarer().visit(tree)
             tree.verify()
             if stop_after == 'desugar':
                 return tree
 
+            # the flat AST must produce the same IR as the tree of node
+            # objects (see arena.py), keep a copy to check this after IR
+            # generation
+            flat = None
+            if self.phase == 'irgen' and \
+                    self.test_type not in ('scaling', 'deep'):
+                flat = arena.flatten(tree)
+
             ContextAnalysis().visit(tree)
             tree.verify()
             if stop_after == 'context':
@@ -166,20 +298,28 @@ class TestCase:
 
             TypeChecker().visit(tree)
             tree.verify()
+            if fused is not None:
+                self.check_fused(fused, str(tree))
+                fused = None
             if stop_after == 'typecheck':
                 return tree
 
             basename = os.path.basename(fcpath).replace(fennec_ext, '')
             module = IRGen(basename).visit(tree)
+            if flat is not None:
+                self.check_flat(flat, basename, str(module))
             if stop_after == 'irgen':
                 return module
 
-            llmodule = llvm.parse_assembly(str(module))
+            # format the module once, and write that text rather than LLVM's
+            # reformatting of it (see `save_module` in main.py)
+            text = str(module)
+            llmodule = llvm.parse_assembly(text)
             llmodule.verify()
 
             llfile = fcpath.replace(fennec_ext, '.ll')
             with open(llfile, 'w') as f:
-                f.write(str(llmodule))
+                f.write(text + '\n')
             self.generated_files.append(llfile)
 
             return llmodule
@@ -187,6 +327,8 @@ class TestCase:
         except EOFError:
             print('Syntax error: unexpected end of file', file=self.ferr)
         except LocationError as e:
+            if fused is not None:
+                self.check_fused(fused, error_message(e))
             e.print(True, origsrc, fout=self.ferr)
         except (IOError, FatalError) as e:
             print('Error: %s' % e, file=self.ferr)
@@ -229,6 +371,12 @@ class TestCase:
                 os.remove(path)
 
 
+def error_message(e):
+    out = StringIO()
+    e.print(False, fout=out)
+    return out.getvalue()
+
+
 def phase_files(phase):
     for f in glob.glob('%s/%s/*/*.fc' % (tests_path, phase)):
         if not f.endswith('-expect' + fennec_ext):
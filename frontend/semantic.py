@@ -0,0 +1,195 @@
+from util import find_handlers, LocationError
+from ast import Node, FunDef
+from desugar import Desugarer
+from context import ContextAnalysis
+from typecheck import TypeChecker
+
+
+#
+# Fused semantic analysis (see the --fused-analysis option of main.py). This
+# runs the methods of `Desugarer`, `ContextAnalysis` and `TypeChecker` in a
+# single traversal of the AST, instead of traversing it once for each of them,
+# and produces the same AST or the same error:
+#
+# - The desugaring rules (the leave hooks of `Desugarer`, apart from those of
+#   `FunDef`) are applied to a node when the traversal reaches it, before any
+#   of its children are visited, and the traversal continues with the
+#   replacement. This way, context analysis and type checking only ever see
+#   desugared nodes, like after a separate desugaring pass. The desugaring
+#   rules do not depend on their children having been desugared already.
+#
+# - Like `ContextAnalysis.visitProgram`, the traversal first visits all
+#   declarations but the bodies of functions, and then the bodies of the
+#   functions. Its own visit methods take over the traversal of `Program` and
+#   `FunDef` nodes, so those of the visitors are never called.
+#
+# - The other nodes are dispatched to the visit methods and enter/leave hooks
+#   of both visitors, context analysis first. A visit method (or an enter hook
+#   that returns something) means that the visitor does not visit the children
+#   of a node, so the traversal keeps track of which visitors are active for
+#   which subtree.
+#
+# - Context analysis errors are raised right away, since the separate context
+#   analysis pass would report them before any type error. Type errors are
+#   remembered instead: type checking stops for the rest of the declaration,
+#   and when the traversal is done, the error of the first declaration in the
+#   program is raised, which is the one that the separate type checking pass
+#   (in program order) would have found. Other exceptions in the type checker
+#   are compiler bugs, which propagate right away, where they happen.
+#
+# The traversal uses an explicit stack, like the visitors in util.py, so it
+# handles arbitrarily deep expressions.
+#
+
+
+CONTEXT, TYPES = 1, 2
+
+# stack entry destination that marks pending leave hooks
+LEAVE = object()
+
+
+class SemanticAnalysis(object):
+    '''
+    Desugars the AST, resolves names and checks types in one traversal, see
+    above.
+    '''
+    def __init__(self):
+        self.desugarer = Desugarer()
+        self.context = ContextAnalysis()
+        self.typechecker = TypeChecker()
+        self.visitors = ((CONTEXT, self.context), (TYPES, self.typechecker))
+        self.dispatch = {}
+        self.decl = None
+        self.type_errors = {}
+
+    def handlers(self, cls):
+        '''
+        Return the desugaring rule for nodes of class `cls` (or None), and a
+        (bit, visitor, visit, enter, leave) tuple for each visitor that has
+        methods for them.
+        '''
+        if cls not in self.dispatch:
+            rule = find_handlers(Desugarer, cls)
+            rule = None if rule is None else rule[2]
+            methods = []
+
+            for bit, visitor in self.visitors:
+                handlers = find_handlers(visitor.__class__, cls)
+                if handlers is not None:
+                    methods.append((bit, visitor) + handlers)
+
+            self.dispatch[cls] = rule, methods
+
+        return self.dispatch[cls]
+
+    def call(self, bit, method, visitor, node):
+        if bit == CONTEXT:
+            return method(visitor, node)
+
+        if self.decl in self.type_errors:
+            return None
+
+        try:
+            return method(visitor, node)
+        except LocationError as e:
+            self.type_errors[self.decl] = e
+
+    def visit(self, program):
+        self.context.reset_scopes()
+        fundefs = []
+
+        # collect globals
+        for index, decl in enumerate(program.decls):
+            self.decl = index
+
+            if isinstance(decl, FunDef):
+                self.context.add_to_scope(decl)
+                fundefs.append((index, decl))
+            else:
+                self.walk(decl, None, CONTEXT | TYPES)
+
+        # then desugar and check function bodies, see
+        # `ContextAnalysis.visitProgram`
+        for self.decl, fundef in fundefs:
+            self.visitFunDef(fundef)
+
+        if self.type_errors:
+            raise self.type_errors[min(self.type_errors)]
+
+    def visitFunDef(self, node):
+        self.desugarer.enterFunDef(node)
+        self.call(TYPES, TypeChecker.enterFunDef, self.typechecker, node)
+        self.context.open_scope()
+        self.context.add_to_scope(node)
+
+        # the function body does not get a scope of its own, so the body
+        # statements are visited rather than the block
+        self.walk(node._type, None, CONTEXT | TYPES)
+        self.walk(node.body.statements, (node.body, 'statements'),
+                  CONTEXT | TYPES)
+
+        self.context.close_scope()
+        self.call(TYPES, TypeChecker.leaveFunDef, self.typechecker, node)
+        self.desugarer.leaveFunDef(node)
+
+    def walk(self, node, dest, active):
+        '''
+        Visit `node` and the nodes below it with the visitors whose bits are
+        set in `active`. `dest` is the (parent, attribute name) or (parent,
+        attribute name, list index) where a desugared replacement of the
+        node is stored.
+        '''
+        stack = [(node, dest, active)]
+        call = self.call
+
+        while stack:
+            node, dest, active = stack.pop()
+
+            if dest is LEAVE:
+                for bit, visitor, leave in active:
+                    call(bit, leave, visitor, node)
+                continue
+
+            if isinstance(node, list):
+                stack += [(child, dest + (i, ), active)
+                          for i, child in reversed(list(enumerate(node)))]
+                continue
+
+            rule, methods = self.handlers(node.__class__)
+
+            if rule is not None:
+                node = rule(self.desugarer, node)
+                self.replace(dest, node)
+                rule, methods = self.handlers(node.__class__)
+
+            descend = active
+            leaves = []
+
+            for bit, visitor, visit, enter, leave in methods:
+                if not active & bit:
+                    continue
+
+                if visit is not None:
+                    call(bit, visit, visitor, node)
+                    descend &= ~bit
+                elif enter is not None and \
+                        call(bit, enter, visitor, node) is not None:
+                    descend &= ~bit
+                elif leave is not None:
+                    leaves.append((bit, visitor, leave))
+
+            if leaves:
+                stack.append((node, LEAVE, leaves))
+
+            for name, child in reversed(node.iter_children()):
+                if isinstance(child, (Node, list)):
+                    stack.append((child, (node, name), descend))
+
+    def replace(self, dest, node):
+        if len(dest) == 2:
+            setattr(dest[0], dest[1], node)
+        else:
+            parent, name, index = dest
+            items = getattr(parent, name)
+            items[index] = node
+            setattr(parent, name, items)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+import sys
+import os
+import io
+import json
+import stat
+import base64
+import socket
+import signal
+import struct
+import tempfile
+import argparse
+import traceback
+import socketserver
+
+
+#
+# Compile server. Starting the compiler costs far more than compiling a small
+# source file: Python startup, importing llvmlite and loading the parser
+# tables. The server pays these costs once and then keeps the parser, lexer and
+# llvmlite state alive, handling compile requests from client.py over a Unix
+# domain socket.
+#
+# Each request carries the command-line arguments and working directory of the
+# client. The server runs `main.main` on them with redirected standard streams,
+# so that the client behaves exactly like main.py: it prints the same output
+# and exits with the same status. If the compiler reads from stdin, the server
+# asks the client for its stdin contents.
+#
+# Messages are JSON arrays, one per line, so that reading a message can never
+# run code:
+#
+#   client -> server: ['compile', argv, cwd] or ['stop']
+#   server -> client: ['stdin']  (client replies with ['stdin', data])
+#   server -> client: ['exit', status, stdout_base64, stderr]
+#
+# The server stops after being idle for --idle-timeout seconds, when it
+# receives a stop request (`./server.py --stop`), or on SIGTERM.
+#
+# Only the user that started the server may talk to it. The socket is created
+# in a directory that only that user can access (mode 0700), and both sides
+# check the user on the other end of the connection: with SO_PEERCRED where it
+# is available, and otherwise (on the client) by the owner of the socket file.
+#
+
+
+default_idle_timeout = 600
+
+
+def default_socket_path():
+    if os.getenv('FENNEC_SERVER'):
+        return os.getenv('FENNEC_SERVER')
+
+    rundir = os.getenv('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(rundir, 'fennec-%d' % os.getuid(), 'server.sock')
+
+
+class Shutdown(BaseException):
+    '''
+    Raised by the SIGTERM handler. It derives from neither Exception nor
+    SystemExit, so `CompileServer.compile` does not take it for the end of the
+    compilation it interrupts.
+    '''
+    pass
+
+
+def private_dir(path):
+    '''
+    Create directory `path` with mode 0700 if it does not exist yet, and make
+    sure that it belongs to the current user and that no other user can access
+    it.
+    '''
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        raise PermissionError('%s is not a private directory of the current '
+                              'user' % path)
+
+
+def peer_uid(sock):
+    '''
+    Return the user ID of the process on the other end of Unix domain socket
+    `sock`, or None if the platform cannot tell.
+    '''
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+
+def send(f, *message):
+    f.write(json.dumps(message).encode('utf-8') + b'\n')
+    f.flush()
+
+
+def receive(f):
+    line = f.readline()
+    if not line.endswith(b'\n'):
+        raise EOFError('connection closed unexpectedly')
+    return json.loads(line.decode('utf-8'))
+
+
+class RemoteStdin(io.StringIO):
+    '''
+    Stands in for `sys.stdin` while serving a request. The client is only
+    asked for its stdin contents when the compiler actually reads them.
+    '''
+    name = '<stdin>'
+
+    def __init__(self, rfile, wfile):
+        super(RemoteStdin, self).__init__()
+        self.rfile = rfile
+        self.wfile = wfile
+        self.fetched = False
+
+    def fetch(self):
+        if not self.fetched:
+            send(self.wfile, 'stdin')
+            tag, data = receive(self.rfile)
+            assert tag == 'stdin'
+            self.write(data)
+            self.seek(0)
+            self.fetched = True
+
+    def read(self, *args):
+        self.fetch()
+        return super(RemoteStdin, self).read(*args)
+
+    def readline(self, *args):
+        self.fetch()
+        return super(RemoteStdin, self).readline(*args)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        uid = peer_uid(self.request)
+        if uid is not None and uid != os.getuid():
+            return
+
+        message = receive(self.rfile)
+
+        if message[0] == 'stop':
+            self.server.stopped = True
+            send(self.wfile, 'exit', 0, '', '')
+        else:
+            tag, argv, cwd = message
+            assert tag == 'compile'
+            stdin = RemoteStdin(self.rfile, self.wfile)
+            status, out, err = self.server.compile(argv, cwd, stdin)
+            send(self.wfile, 'exit', status,
+                 base64.b64encode(out).decode('ascii'), err)
+
+
+class CompileServer(socketserver.UnixStreamServer):
+    def __init__(self, path, idle_timeout):
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.timeout = idle_timeout or None
+        self.stopped = False
+
+    def warmup(self):
+        # Import the compiler and initialize the parser, lexer and llvmlite by
+        # compiling a trivial program, so that the first request does not pay
+        # for it. The imports are done here rather than at the top of this
+        # module so that client.py does not pay for them either.
+        import main
+        main.load_codegen()
+
+        tree = main.parse('<warmup>', 'int main() { return 0; }')
+        main.Desugarer().visit(tree)
+        main.ContextAnalysis().visit(tree)
+        main.TypeChecker().visit(tree)
+        module = main.IRGen('<warmup>').visit(tree)
+        main.llvm.parse_assembly(str(module)).verify()
+
+    def handle_timeout(self):
+        self.stopped = True
+
+    def serve(self):
+        try:
+            self.warmup()
+            while not self.stopped:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.path)
+
+    def compile(self, argv, cwd, stdin):
+        '''
+        Run the compiler with arguments `argv` in directory `cwd`, and return
+        its exit status and everything it wrote to stdout and stderr.
+        '''
+        import main
+        import cache
+        import lexer
+
+        stdout = io.TextIOWrapper(io.BytesIO(), write_through=True)
+        stderr = io.StringIO()
+        saved_streams = sys.stdin, sys.stdout, sys.stderr
+        saved_cwd = os.getcwd()
+        saved_cache = cache.enabled
+        saved_engine = lexer.default_engine
+        status = 0
+
+        try:
+            os.chdir(cwd)
+            sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+            main.main(argv, prog=os.path.basename(main.__file__))
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code is not None:
+                print(e.code, file=stderr)
+                status = 1
+        except Exception:
+            traceback.print_exc(file=stderr)
+            status = 1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved_streams
+            os.chdir(saved_cwd)
+            cache.enabled = saved_cache
+            lexer.default_engine = saved_engine
+
+        stdout.flush()
+        return status, stdout.buffer.getvalue(), stderr.getvalue()
+
+
+def connect(path):
+    '''
+    Connect to the server listening on `path`. Raises OSError if there is no
+    server, and PermissionError if the socket or the server belongs to another
+    user.
+    '''
+    if os.stat(path).st_uid != os.getuid():
+        raise PermissionError('%s belongs to another user' % path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+        uid = peer_uid(sock)
+        if uid is not None and uid != os.getuid():
+            raise PermissionError('the server on %s belongs to another user'
+                                  % path)
+    except:
+        sock.close()
+        raise
+
+    return sock
+
+
+def request(sock, message):
+    '''
+    Send a request to the server connected to `sock` and handle its replies,
+    returning the exit status. Raises OSError or EOFError if the connection
+    fails, and ValueError on a malformed reply.
+    '''
+    with sock, sock.makefile('rb') as rfile, sock.makefile('wb') as wfile:
+        send(wfile, *message)
+
+        while True:
+            reply = receive(rfile)
+
+            if reply[0] == 'stdin':
+                send(wfile, 'stdin', sys.stdin.read())
+            else:
+                tag, status, out, err = reply
+                sys.stdout.flush()
+                sys.stdout.buffer.write(base64.b64decode(out))
+                sys.stdout.flush()
+                sys.stderr.write(err)
+                return status
+
+
+def stop_on_signal(signum, frame):
+    raise Shutdown()
+
+
+def start(path, idle_timeout):
+    private_dir(os.path.dirname(os.path.abspath(path)))
+
+    # remove the socket of a server that did not shut down cleanly
+    if os.path.exists(path):
+        try:
+            connect(path).close()
+            raise OSError('a server is already listening on %s' % path)
+        except ConnectionRefusedError:
+            os.remove(path)
+
+    # make sure that the socket is removed when the server is killed (`serve`
+    # removes it on the way out)
+    signal.signal(signal.SIGTERM, stop_on_signal)
+
+    try:
+        CompileServer(path, idle_timeout).serve()
+    except Shutdown:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--socket', metavar='PATH',
+            default=default_socket_path(),
+            help='Unix domain socket to listen on (default %(default)s, '
+                 'or set FENNEC_SERVER)')
+    parser.add_argument('-t', '--idle-timeout', metavar='SECONDS', type=float,
+            default=default_idle_timeout,
+            help='shut down after being idle for this long, 0 means never '
+                 '(default %(default)s)')
+    parser.add_argument('--stop', action='store_true',
+            help='stop the server listening on the socket')
+    args = parser.parse_args()
+
+    try:
+        if args.stop:
+            sys.exit(request(connect(args.socket), ('stop',)))
+        start(args.socket, args.idle_timeout)
+    except (OSError, EOFError, ValueError) as e:
+        print('Error: %s' % e, file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
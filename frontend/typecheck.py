@@ -1,5 +1,36 @@
 from util import ASTVisitor, NodeError, BackrefError
-from ast import Type, ArrayType, FunType, Block, If, Return, Const
+from ast import Type, ArrayType, FunType, Block, If, Return, Const, Operator, \
+        ARITHMETIC, EQUALITY, RELATIONAL, LOGICAL, ARRAY, VOID
+
+
+# Legality tables of the operators, indexed by operator code and by the type
+# code of the operand (see ast.py): the type of the result of a binary or unary
+# operation on operands of that type, or None if the operator does not apply
+# to it. Relational and equality operators produce a bool, the others a value
+# of the operand type.
+operand_type_names = {
+    LOGICAL: ('bool',),
+    ARITHMETIC: ('char', 'int', 'float'),
+    RELATIONAL: ('char', 'int', 'float'),
+    EQUALITY: ('bool', 'char', 'int', 'float'),
+}
+
+
+def legality_table(result_type):
+    table = []
+
+    for op in map(Operator.get, Operator.ops):
+        row = [None] * (ARRAY + 1)
+        for ty in map(Type.get, operand_type_names[op.kind]):
+            row[ty.code] = result_type(op, ty)
+        table.append(row)
+
+    return table
+
+
+binary_types = legality_table(lambda op, ty: Type.get('bool') if op.kind in
+                              (EQUALITY, RELATIONAL) else ty)
+unary_types = legality_table(lambda op, ty: ty)
 
 
 class TypeChecker(ASTVisitor):
@@ -15,7 +46,9 @@ class TypeChecker(ASTVisitor):
     one of the expected types.
 
     `operand_types` specifies the allowed types for operands of unary and binary
-    operators.
+    operators. Operators are checked by looking up the result type in the
+    `binary_types` and `unary_types` tables, and only if that fails,
+    `operand_types` and `check_type` find out what is wrong.
     '''
 
     def __init__(self):
@@ -25,17 +58,10 @@ class TypeChecker(ASTVisitor):
         self.tfloat = Type.get('float')
         self.tvoid = Type.get('void')
         self.curfn = None
-        self.in_loop = False
+        self.loop_depth = 0
 
     def operand_types(self, operator):
-        if operator.is_logical():
-            return [self.tbool]
-
-        if operator.is_arithmetic() or operator.is_relational():
-            return [self.tchar, self.tint, self.tfloat]
-
-        assert operator.is_equality()
-        return [self.tbool, self.tchar, self.tint, self.tfloat]
+        return [Type.get(name) for name in operand_type_names[operator.kind]]
 
     def check_type(self, node, *expected):
         if node.ty not in expected:
@@ -47,9 +73,7 @@ class TypeChecker(ASTVisitor):
         if str(node._type).startswith('void'):
             raise NodeError(node, 'Error: global must be non-void')
 
-    def visitGlobalDef(self, node):
-        self.visit_children(node)
-
+    def leaveGlobalDef(self, node):
         # global definitions cannot be arrays or void
         if node._type.is_array():
             raise NodeError(node, 'Error: global must have basic type')
@@ -65,14 +89,15 @@ class TypeChecker(ASTVisitor):
             raise NodeError(node.value,
                             'Error: global initializer must be constant')
 
-    def visitFunDef(self, node):
+    def enterFunDef(self, node):
         # functions can only return basic types
         if node._type.return_type.is_array():
             raise NodeError(node,
                             'Error: functions can only return basic type or void')
 
         self.curfn = node
-        self.visit_children(node)
+
+    def leaveFunDef(self, node):
         self.curfn = None
 
         # a non-void function must return a value
@@ -87,7 +112,7 @@ class TypeChecker(ASTVisitor):
         if str(node._type).startswith('void'):
             raise NodeError(node, 'Error: parameter must be non-void')
 
-    def visitVarDef(self, node):
+    def enterVarDef(self, node):
         # variables must be primitive type
         if node._type.is_array():
             raise NodeError(node, 'Error: missing size for array definition')
@@ -96,21 +121,19 @@ class TypeChecker(ASTVisitor):
         if node._type == self.tvoid:
             raise NodeError(node, 'Error: variable must be non-void')
 
+    def leaveVarDef(self, node):
         # Variable initialization must match variable type
-        self.visit_children(node)
         self.check_type(node.value, node._type)
 
-    def visitArrayDef(self, node):
+    def enterArrayDef(self, node):
         # cannot define void arrays
         if node._type.base == self.tvoid:
             raise NodeError(node, 'Error: array must be non-void')
 
-        self.visit_children(node)
+    def leaveArrayDef(self, node):
         self.check_type(node.size, self.tint)
 
-    def visitAssignment(self, node):
-        self.visit_children(node)
-
+    def leaveAssignment(self, node):
         # functions cannot be re-assigned
         if isinstance(node.ref.ty, FunType):
             raise NodeError(node, 'Error: cannot reassign function')
@@ -125,37 +148,31 @@ class TypeChecker(ASTVisitor):
     def visitModification(self, node):
         raise NotImplementedError  # should be desugared
 
-    def visitIf(self, node):
+    def leaveIf(self, node):
         # condition must be bool
-        self.visit_children(node)
         self.check_type(node.cond, self.tbool)
 
-    def visitWhile(self, node):
+    def enterWhile(self, node):
+        # count the enclosing loops so that break/continue are placeable
+        # inside (nested) loops
+        self.loop_depth += 1
+
+    def leaveWhile(self, node):
         # condition must be bool
-        in_nested_loop = self.in_loop
-        self.in_loop = True
-        self.visit_children(node)
-        # this condition ensures that break/continue are still placeable inside a nested loop
-        if in_nested_loop == False:
-            # if the node is not inside a nested loop, then it possibly has left the loop body
-            self.in_loop = False
+        self.loop_depth -= 1
         self.check_type(node.cond, self.tbool)
 
-    def visitFor(self, node):
-        in_nested_loop = self.in_loop
-        self.in_loop = True
-        self.visit_children(node)
-        # this condition ensures that break/continue are still placeable inside a nested loop
-        if in_nested_loop == False:
-            # if the node is not inside a nested loop, then it possibly has left the loop body
-            self.in_loop = False
+    def enterFor(self, node):
+        self.loop_depth += 1
+
+    def leaveFor(self, node):
+        self.loop_depth -= 1
         self.check_type(node.vartype, self.tint)
 
-    def visitReturn(self, node):
+    def leaveReturn(self, node):
         # returned type must match function type
-        self.visit_children(node)
         retty = self.curfn._type.return_type
-        is_void = str(retty) == 'void'
+        is_void = retty.code == VOID
 
         if node.value and is_void:
             raise NodeError(node.value,
@@ -167,21 +184,19 @@ class TypeChecker(ASTVisitor):
                             'Error: non-void function must not return void')
 
     def visitBreak(self, node):
-        if not self.in_loop:
+        if not self.loop_depth:
             raise NodeError(node, 'Error: break is defined outside of a loop')
 
     def visitContinue(self, node):
-        if not self.in_loop:
+        if not self.loop_depth:
             raise NodeError(node, 'Error: continue is defined outside of a loop')
 
-    def visitVarUse(self, node):
+    def leaveVarUse(self, node):
         # variable uses inherit the type of their declaration
         ty = node.definition._type
 
         # indexed arrays produce the array base type
         if node.index:
-            self.visit_children(node)
-
             if not ty.is_array():
                 raise BackrefError(node.location,
                                    'Error: cannot index non-array variable',
@@ -195,34 +210,34 @@ class TypeChecker(ASTVisitor):
 
         node.ty = ty
 
-    def visitIndex(self, node):
+    def leaveIndex(self, node):
         # array index must have int type, base must have array type
-        self.visit_children(node)
         if not node.base.ty.is_array():
             raise NodeError(node.base, 'Expected array type, got %s',
                             node.base.ty)
         self.check_type(node.index, self.tint)
         node.ty = node.base.ty.base
 
-    def visitBinaryOp(self, node):
+    def leaveBinaryOp(self, node):
         # operands must be legal for operand, left/right types must match
-        self.visit_children(node)
-        self.check_type(node.lhs, *self.operand_types(node.op))
-        self.check_type(node.rhs, node.lhs.ty)
+        ty = binary_types[node.op.code][node.lhs.ty.code]
 
-        if node.op.is_equality() or node.op.is_relational():
-            node.ty = self.tbool
-        else:
-            node.ty = node.lhs.ty
+        if ty is None or node.rhs.ty is not node.lhs.ty:
+            self.check_type(node.lhs, *self.operand_types(node.op))
+            self.check_type(node.rhs, node.lhs.ty)
 
-    def visitUnaryOp(self, node):
+        node.ty = ty
+
+    def leaveUnaryOp(self, node):
         # operand must be legal for operand
-        self.visit_children(node)
-        self.check_type(node.value, *self.operand_types(node.op))
-        node.ty = node.value.ty
+        ty = unary_types[node.op.code][node.value.ty.code]
+
+        if ty is None:
+            self.check_type(node.value, *self.operand_types(node.op))
+
+        node.ty = ty
 
-    def visitFunCall(self, node):
-        self.visit_children(node)
+    def leaveFunCall(self, node):
         funty = node.definition._type
 
         if not isinstance(funty, FunType):
@@ -231,13 +246,14 @@ class TypeChecker(ASTVisitor):
         typed_args = node.args
         nargs = len(node.args)
         nparams = len(funty.params)
-        defargs = (node.definition.location, 'Note: function is defined here')
+        defnote = 'Note: function is defined here'
 
         # number of arguments must match number of parameters in definition
         if funty.varargs:
             if nargs < nparams:
                 raise BackrefError(node.location,
-                                   'Not enough arguments for varargs function', *defargs)
+                                   'Not enough arguments for varargs function',
+                                   node.definition.location, defnote)
 
             typed_args = node.args[:len(funty.params)]
 
@@ -246,7 +262,7 @@ class TypeChecker(ASTVisitor):
             raise BackrefError(errnode.location,
                                'Expected %d arguments, got %d' % (
                                    nparams, nargs),
-                               *defargs)
+                               node.definition.location, defnote)
 
         # argument types must match defined parameter types
         for arg, param in zip(typed_args, funty.params):
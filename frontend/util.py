@@ -1,5 +1,6 @@
 import sys
 import os.path
+from types import GeneratorType
 from io import StringIO
 from abc import ABCMeta
 from ast import Node, DeleteNode
@@ -10,43 +11,188 @@ from ast import Node, DeleteNode
 #
 
 
+# Visitors define methods for specific node classes, e.g. `visitProgram`. There
+# are three kinds of them:
+#
+# - `visit<name>(node)` takes over the traversal of the node: the children of
+#   the node are only visited if the method calls `self.visit_children(node)`
+#   (or visits them otherwise).
+#
+# - `enter<name>(node)` and `leave<name>(node)` are pre- and post-order hooks,
+#   called before and after the children of the node are visited by the
+#   traversal itself. An enter hook can return a value other than None to skip
+#   the children and the leave hook. In an `ASTTransformer`, the value returned
+#   by the leave hook (or by the enter hook if it returns one) replaces the
+#   node, like the return value of a visit method.
+#
+# The traversal uses an explicit stack rather than recursion, so nodes that
+# are handled by hooks (or have no methods at all) can be nested arbitrarily
+# deep, e.g., a long chain of binary operators, without running into Python's
+# recursion limit. A visit method that visits the children of its node does
+# recurse, so deeply nested node classes should use hooks instead. Set the
+# class attribute `recursive` to True to use a recursive traversal with the
+# same behaviour instead, which bench.py compares against.
+#
+# In an `ASTTransformer`, a visit method or enter hook that needs to do work
+# in between visiting its children (like `IRGen.visitIf`, which emits a branch
+# after the condition) can be a generator instead: it yields the children (or
+# other nodes) to visit, one at a time, and receives the result of visiting
+# each of them, just like the return value of `self.visit(child)`. The value
+# that the generator returns is the result for its node. The traversal keeps
+# the suspended generator on its stack, so this does not recurse either.
+#
+# The methods for a node class are looked up once per visitor class and stored
+# in a dispatch table, rather than building the method names and searching the
+# class hierarchy of the node for every visited node.
+dispatch_tables = {}
+
+
+def dispatch_order(cls):
+    '''
+    Return the node classes whose methods apply to nodes of class `cls`, in
+    the order in which they are tried: `cls` itself, followed by its base
+    classes depth-first (left to right) up to `Node`.
+    '''
+    order = [cls]
+
+    if cls is not Node:
+        for base in cls.__bases__:
+            order += dispatch_order(base)
+
+    return order
+
+
+def find_handlers(visitor_class, node_class):
+    '''
+    Return the (visit, enter, leave) methods of `visitor_class` for nodes of
+    class `node_class`, or None if there are none and only the children of the
+    node should be visited. The methods are taken from the first class in the
+    dispatch order for which the visitor defines any of them, and missing ones
+    are None. The result is stored in the dispatch table of the visitor class.
+    '''
+    table = dispatch_tables.setdefault(visitor_class, {})
+
+    if node_class not in table:
+        table[node_class] = None
+
+        for cls in dispatch_order(node_class):
+            handlers = tuple(getattr(visitor_class, prefix + cls.__name__, None)
+                             for prefix in ('visit', 'enter', 'leave'))
+            handlers = tuple(func if callable(func) else None
+                             for func in handlers)
+            if any(handlers):
+                table[node_class] = handlers
+                break
+
+    return table[node_class]
+
+
 class ASTVisitor(object):
     '''
     Base class for traversing the AST. It allows you to specify custom behaviour
     for any AST node by defining a `visit<node-name>` method, e.g., `def
-    visitProgram(self, program): ...`. By default, the visitor recursively
-    visits all child nodes of a node.
+    visitProgram(self, program): ...`, or `enter<node-name>` and
+    `leave<node-name>` hooks that are called before and after visiting the
+    children of the node. By default, the visitor visits all child nodes of a
+    node.
 
     Use `self.visit_children` in a custom visitor method to traverse the child
     nodes of a node without explicitly having to specify the attribute names.
     '''
     __metaclass__ = ABCMeta
 
+    recursive = False
+
     def visit(self, node):
+        if self.recursive:
+            self.visit_recursive(node)
+        else:
+            self.walk([node])
+
+    def visit_children(self, node):
+        children = [child for name, child in node.iter_children()]
+
+        if self.recursive:
+            for child in children:
+                self.visit_recursive(child)
+        else:
+            children.reverse()
+            self.walk(children)
+
+    def walk(self, stack):
+        '''
+        Visit the nodes (or lists of nodes) on `stack`, starting at the top.
+        Pending leave hooks are kept on the stack as (hook, node) pairs.
+        '''
+        table = dispatch_tables.setdefault(self.__class__, {})
+
+        while stack:
+            node = stack.pop()
+
+            if isinstance(node, Node):
+                try:
+                    handlers = table[node.__class__]
+                except KeyError:
+                    handlers = find_handlers(self.__class__, node.__class__)
+
+                if handlers is not None:
+                    visit, enter, leave = handlers
+
+                    if visit is not None:
+                        visit(self, node)
+                        continue
+
+                    if enter is not None and enter(self, node) is not None:
+                        continue
+
+                    if leave is not None:
+                        stack.append((leave, node))
+
+                children = [child for name, child in node.iter_children()]
+                children.reverse()
+                stack += children
+
+            elif isinstance(node, list):
+                stack += reversed(node)
+
+            elif isinstance(node, tuple):
+                leave, node = node
+                leave(self, node)
+
+    def visit_recursive(self, node):
         if isinstance(node, list):
             for child in node:
-                self.visit(child)
+                self.visit_recursive(child)
         elif isinstance(node, Node):
-            if not self.visit_try_class(node, node.__class__):
+            handlers = find_handlers(self.__class__, node.__class__)
+
+            if handlers is None:
                 self.visit_children(node)
+                return
 
-    def visit_try_class(self, node, cls):
-        func = getattr(self.__class__, 'visit' + cls.__name__, None)
+            visit, enter, leave = handlers
 
-        if callable(func):
-            func(self, node)
-            return True
+            if visit is not None:
+                visit(self, node)
+            elif enter is None or enter(self, node) is None:
+                self.visit_children(node)
+                if leave is not None:
+                    leave(self, node)
 
-        if cls is Node:
-            return False
 
-        for base in cls.__bases__:
-            if self.visit_try_class(node, base):
-                return True
+class Resumption(object):
+    '''
+    Stack entry of `ASTTransformer.walk` for a generator visit method or enter
+    hook of `node` (see above), which is waiting for the result `value` of
+    visiting the node it yielded last.
+    '''
+    __slots__ = ('generator', 'node', 'dest', 'value')
 
-    def visit_children(self, node):
-        for name, child in node.iter_children():
-            self.visit(child)
+    def __init__(self, generator, node, dest):
+        self.generator = generator
+        self.node = node
+        self.dest = dest
+        self.value = None
 
 
 class ASTTransformer(object):
@@ -57,50 +203,155 @@ class ASTTransformer(object):
     '''
     __metaclass__ = ABCMeta
 
+    recursive = False
+
     def visit(self, node):
+        if self.recursive:
+            return self.visit_recursive(node)
+
+        return self.walk([(node, None)])
+
+    def visit_children(self, node):
+        if self.recursive:
+            for name, child in node.iter_children():
+                self.replace_child(node, name, self.visit_recursive(child))
+        else:
+            self.walk([(child, (node, name)) for name, child in
+                       reversed(list(node.iter_children()))])
+
+    def replace_child(self, node, name, result):
+        if result is not None:
+            if isinstance(result, DeleteNode):
+                result = None
+            setattr(node, name, result)
+
+    def add_to_list(self, replacement, child, result):
+        if isinstance(result, list):
+            replacement += result
+        elif not isinstance(result, DeleteNode):
+            replacement.append(child if result is None else result)
+
+    def walk(self, stack):
+        '''
+        Visit the nodes on `stack`, starting at the top. Stack entries are
+        (node, destination) pairs, where the destination for the result of
+        visiting the node is either a (parent, attribute name) pair, a list
+        that replaces a list of nodes, or None for the returned result. Nodes
+        whose children are being visited are kept on the stack as (node,
+        destination, leave hook) triples, lists as (list, destination,
+        replacement) triples, and suspended generators as `Resumption`s, which
+        are also the destination of the nodes that they yield.
+        '''
+        table = dispatch_tables.setdefault(self.__class__, {})
+        returned = None
+
+        while stack:
+            entry = stack.pop()
+
+            if entry.__class__ is Resumption:
+                try:
+                    child = entry.generator.send(entry.value)
+                except StopIteration as e:
+                    node, dest, result = entry.node, entry.dest, e.value
+                else:
+                    stack.append(entry)
+                    stack.append((child, entry))
+                    continue
+
+            elif len(entry) == 3:
+                node, dest, finish = entry
+                if isinstance(node, list):
+                    result = finish
+                else:
+                    result = None if finish is None else finish(self, node)
+            else:
+                node, dest = entry
+                result = None
+
+                if isinstance(node, list):
+                    replacement = []
+                    stack.append((node, dest, replacement))
+                    stack += [(child, replacement) for child in reversed(node)]
+                    continue
+
+                if isinstance(node, Node):
+                    try:
+                        handlers = table[node.__class__]
+                    except KeyError:
+                        handlers = find_handlers(self.__class__,
+                                                 node.__class__)
+
+                    visit = enter = leave = None
+                    if handlers is not None:
+                        visit, enter, leave = handlers
+
+                    if visit is not None:
+                        result = visit(self, node)
+                    else:
+                        if enter is not None:
+                            result = enter(self, node)
+
+                        if result is None:
+                            stack.append((node, dest, leave))
+                            stack += [(child, (node, name)) for name, child in
+                                      reversed(list(node.iter_children()))]
+                            continue
+
+                    if isinstance(result, GeneratorType):
+                        stack.append(Resumption(result, node, dest))
+                        continue
+
+            if dest is None:
+                returned = result
+            elif dest.__class__ is Resumption:
+                dest.value = result
+            elif isinstance(dest, list):
+                self.add_to_list(dest, node, result)
+            else:
+                self.replace_child(dest[0], dest[1], result)
+
+        return returned
+
+    def visit_recursive(self, node):
         if isinstance(node, list):
             replacement = []
-
             for child in node:
-                result = self.visit(child)
-
-                if isinstance(result, list):
-                    replacement += result
-                elif not isinstance(result, DeleteNode):
-                    replacement.append(child if result is None else result)
-
+                self.add_to_list(replacement, child,
+                                 self.visit_recursive(child))
             return replacement
 
         if not isinstance(node, Node):
             return
 
-        found, result = self.visit_try_class(node, node.__class__)
-        if found:
-            return result
+        handlers = find_handlers(self.__class__, node.__class__)
+        visit = enter = leave = None
+        if handlers is not None:
+            visit, enter, leave = handlers
 
-        self.visit_children(node)
+        if visit is not None:
+            return self.resume_recursive(visit(self, node))
 
-    def visit_try_class(self, node, cls):
-        func = getattr(self.__class__, 'visit' + cls.__name__, None)
+        if enter is not None:
+            result = enter(self, node)
+            if result is not None:
+                return self.resume_recursive(result)
 
-        if callable(func):
-            return True, func(self, node)
+        self.visit_children(node)
 
-        if cls is not Node:
-            for base in cls.__bases__:
-                found, result = self.visit_try_class(node, base)
-                if found:
-                    return True, result
+        if leave is not None:
+            return leave(self, node)
 
-        return False, None
+    def resume_recursive(self, result):
+        if not isinstance(result, GeneratorType):
+            return result
 
-    def visit_children(self, node):
-        for name, child in node.iter_children():
-            result = self.visit(child)
-            if result is not None:
-                if isinstance(result, DeleteNode):
-                    result = None
-                setattr(node, name, result)
+        value = None
+        while True:
+            try:
+                child = result.send(value)
+            except StopIteration as e:
+                return e.value
+            value = self.visit_recursive(child)
 
 
 class PrintTree(ASTVisitor):
@@ -132,7 +383,7 @@ class LocationError(Exception):
         self.location = location
         self.message = message % args
 
-    def print(self, showsrc, code=None, fout=sys.stderr):
+    def print(self, showsrc, code=None, fout=None):
         fname, ystart, xstart, yend, xend = self.location
 
         if yend != ystart:
@@ -145,6 +396,9 @@ class LocationError(Exception):
         else:
             scol = 'character %d' % xstart
 
+        if fout is None:
+            fout = sys.stderr
+
         print("File \"%s\", %s, %s:\n%s" % (fname, sline, scol, self.message),
                 file=fout)
 
@@ -196,12 +450,12 @@ class NodeError(LocationError):
         super(NodeError, self).__init__(node.location, message, *args)
         self.node = node
 
-    def print(self, showsrc, code=None, fout=sys.stderr):
+    def print(self, showsrc, code=None, fout=None):
         hasloc = self.node.location[0] is not None
         super(NodeError, self).print(showsrc and hasloc, code, fout)
 
         if showsrc and not hasloc:
-            print('node:', repr(self.node))
+            print('node:', repr(self.node), file=fout)
 
 
 class BackrefError(LocationError):
@@ -215,7 +469,7 @@ class BackrefError(LocationError):
         self.refloc = refloc
         self.refmsg = refmsg
 
-    def print(self, showsrc, code=None, fout=sys.stderr):
+    def print(self, showsrc, code=None, fout=None):
         LocationError.print(self, showsrc, code, fout)
         LocationError(self.refloc, self.refmsg).print(showsrc, code, fout)
 